@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试
+
+生成指定规模的 usr/img、usr/text 模拟目录, 分别在进程内 (Flask 测试客户端) 和
+真实的本地 gunicorn 上压测各个公开接口, 输出吞吐量、p50/p95/p99 延迟和内存占用
+
+    python bench.py gen --root /tmp/hcb --images 100000 --types 4
+    python bench.py inproc --root /tmp/hcb --requests 2000
+    python bench.py http --root /tmp/hcb --requests 5000 --concurrency 32 --workers 4
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import tomllib
+
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# (名称, 路径模板), {type} 为图片类型, {text_type} 为文本类型
+ENDPOINTS = [
+    ("random_image_direct", "/random_image/{type}"),
+    ("random_image_json", "/random_image/j/{type}"),
+    ("random_image_redirect", "/random_image/g/{type}"),
+    ("image_list_page", "/api/img/{type}/list?limit=100"),
+    ("image_list_full", "/api/img/{type}/list"),
+    ("image_count", "/api/img/count"),
+    ("image_types", "/api/img/types"),
+    ("random_text", "/random_text/{text_type}"),
+    ("text_count", "/api/text/count"),
+    ("home", "/"),
+    ("help", "/help"),
+    ("not_found", "/bench-missing-page"),
+]
+
+# 以这些前缀开头的配置值 (相对于项目根目录的路径) 改为模拟目录中对应的路径,
+# 压测不读写项目自身的 usr/img、usr/text 和 var/cache
+ROOT_REDIRECTS = (("usr/img", "img"), ("usr/text", "text"), ("var/cache", "cache"))
+
+
+def _rss_kb(pid="self"):
+    """
+    读取进程当前常驻内存 (KB), 非 Linux 平台返回 0
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid):
+    """
+    返回 pid 的所有子进程 (gunicorn 工作进程)
+    """
+    children = []
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else ():
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def _summary(name, latencies, elapsed, errors, rss_kb):
+    latencies.sort()
+    return {
+        "endpoint": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p95_ms": _percentile(latencies, 95) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "rss_mb": rss_kb / 1024,
+    }
+
+
+def _print_report(title, rows):
+    print(f"\n{title}")
+    header = f"{'endpoint':<24}{'reqs':>8}{'err':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rss MB':>10}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(
+            f"{row['endpoint']:<24}{row['requests']:>8}{row['errors']:>6}{row['rps']:>10.1f}"
+            f"{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}{row['p99_ms']:>10.3f}{row['rss_mb']:>10.1f}"
+        )
+
+
+# ---------------------------------------------------------------- 生成模拟目录
+
+
+def generate(args):
+    """
+    生成模拟的图片/文本目录
+    """
+    rng = random.Random(args.seed)
+    img_root = os.path.join(args.root, "img")
+    text_root = os.path.join(args.root, "text")
+    # 所有图片共用一块随机数据, 按不同长度截取
+    blob = os.urandom(args.image_bytes * 2)
+
+    started = time.perf_counter()
+    per_type = max(1, args.images // args.types)
+    for t in range(args.types):
+        img_type = f"type_{t}"
+        for orientation in ("horizontal", "vertical"):
+            os.makedirs(os.path.join(img_root, img_type, orientation), exist_ok=True)
+        for i in range(per_type):
+            # 约 2/3 横屏、1/3 竖屏
+            orientation = "vertical" if i % 3 == 2 else "horizontal"
+            size = rng.randint(args.image_bytes // 2, args.image_bytes * 3 // 2)
+            path = os.path.join(img_root, img_type, orientation, f"img_{i:07d}.jpg")
+            with open(path, "wb") as f:
+                f.write(b"\xff\xd8\xff" + blob[:size])
+
+        type_dir = os.path.join(text_root, img_type)
+        os.makedirs(type_dir, exist_ok=True)
+        for n in range(args.text_files):
+            lines = rng.randint(args.min_lines, args.max_lines)
+            with open(os.path.join(type_dir, f"text_{n:04d}.txt"), "w", encoding="utf-8") as f:
+                for line in range(lines):
+                    f.write(f"{img_type} 文本 {n}-{line} " + "x" * rng.randint(10, 120) + "\n")
+
+    print(
+        f"已生成 {per_type * args.types} 张图片, {args.text_files * args.types} 个文本文件, "
+        f"耗时 {time.perf_counter() - started:.1f}s -> {args.root}"
+    )
+
+
+def _redirect(root, value):
+    for prefix, target in ROOT_REDIRECTS:
+        if value == prefix or value.startswith(prefix + "/"):
+            return os.path.normpath(os.path.join(root, target, value[len(prefix) + 1:]))
+    return value
+
+
+def write_config(root, port=5000):
+    """
+    以 var/config.toml 为模板, 生成指向模拟目录、关闭限流效果的配置文件
+    """
+    with open(os.path.join(PROJECT_ROOT, "var", "config.toml"), "rb") as f:
+        config = tomllib.load(f)
+    for items in config.values():
+        for key, v in items.items():
+            if isinstance(v, str):
+                items[key] = _redirect(root, v)
+    config["paths"]["theme_dir"] = os.path.join(PROJECT_ROOT, config["paths"]["theme_dir"])
+    config["limiter"]["requests_per_minute"] = 10 ** 9
+
+    def value(v):
+        if isinstance(v, bool):
+            return "true" if v else "false"
+        if isinstance(v, (int, float)):
+            return repr(v)
+        if isinstance(v, list):
+            return "[" + ", ".join(value(x) for x in v) + "]"
+        if isinstance(v, dict):
+            return "{ " + ", ".join(f"{k} = {value(x)}" for k, x in v.items()) + " }"
+        return json.dumps(v, ensure_ascii=False)
+
+    path = os.path.join(root, "bench_config.toml")
+    with open(path, "w", encoding="utf-8") as f:
+        for section, items in config.items():
+            f.write(f"[{section}]\n")
+            for key, v in items.items():
+                f.write(f"{key} = {value(v)}\n")
+            f.write("\n")
+    return path
+
+
+def _types(root, sub):
+    base = os.path.join(root, sub)
+    return sorted(d for d in os.listdir(base) if os.path.isdir(os.path.join(base, d)))
+
+
+def _targets(args):
+    img_types = _types(args.root, "img")
+    text_types = _types(args.root, "text")
+    selected = set(args.endpoints.split(",")) if args.endpoints else None
+    targets = []
+    for name, template in ENDPOINTS:
+        if selected is not None and name not in selected:
+            continue
+        targets.append((name, template, img_types, text_types))
+    return targets
+
+
+def _path(template, img_types, text_types, rng):
+    return template.format(
+        type=rng.choice(img_types) if img_types else "none",
+        text_type=rng.choice(text_types) if text_types else "none",
+    )
+
+
+# ---------------------------------------------------------------- 进程内压测
+
+
+def run_inproc(args):
+    """
+    通过 Flask 测试客户端在进程内压测, 只测量应用本身的开销
+    """
+    os.environ["HCANRANBAPI_CONFIG"] = write_config(args.root)
+    sys.path.insert(0, PROJECT_ROOT)
+
+    started = time.perf_counter()
+    from hcanranbapi import app
+    print(f"应用初始化耗时 {time.perf_counter() - started:.3f}s, RSS {_rss_kb() / 1024:.1f} MB")
+
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    rows = []
+    for name, template, img_types, text_types in _targets(args):
+        latencies = []
+        errors = 0
+        begin = time.perf_counter()
+        for _ in range(args.requests):
+            path = _path(template, img_types, text_types, rng)
+            t0 = time.perf_counter()
+            rv = client.get(path)
+            rv.get_data()
+            rv.close()
+            latencies.append(time.perf_counter() - t0)
+            if rv.status_code >= 500 or (rv.status_code >= 400 and name != "not_found"):
+                errors += 1
+        rows.append(_summary(name, latencies, time.perf_counter() - begin, errors, _rss_kb()))
+
+    _print_report("进程内 (WSGI 测试客户端)", rows)
+    return rows
+
+
+# ---------------------------------------------------------------- HTTP 压测
+
+
+def _http_worker(host, port, paths, latencies, errors, lock):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    local, failed = [], 0
+    for path in paths:
+        t0 = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status >= 500:
+                failed += 1
+        except (OSError, http.client.HTTPException):
+            failed += 1
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+        local.append(time.perf_counter() - t0)
+    conn.close()
+    with lock:
+        latencies.extend(local)
+        errors[0] += failed
+
+
+def _wait_ready(host, port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=2)
+            conn.request("GET", "/api")
+            conn.getresponse().read()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def run_http(args):
+    """
+    启动本地 gunicorn, 使用多线程 keep-alive 连接压测真实 HTTP 路径
+    """
+    env = dict(os.environ, HCANRANBAPI_CONFIG=write_config(args.root))
+    app_path = "hcanranbapi:asgi_app" if args.server == "asgi" else "hcanranbapi:app"
+    cmd = [
+        "gunicorn", app_path, "--config", "gunicorn_config.py",
+        "--bind", f"127.0.0.1:{args.port}", "--workers", str(args.workers),
+        "--pid", os.path.join(args.root, "bench_gunicorn.pid"),
+        "--access-logfile", os.devnull,
+    ]
+    if args.server == "asgi":
+        cmd.extend(["--worker-class", "uvicorn.workers.UvicornWorker"])
+
+    started = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=PROJECT_ROOT, env=env)
+    try:
+        if not _wait_ready("127.0.0.1", args.port):
+            print("❌ gunicorn 未能在超时时间内启动")
+            return []
+        print(f"gunicorn 启动耗时 {time.perf_counter() - started:.2f}s")
+
+        rng = random.Random(args.seed)
+        rows = []
+        for name, template, img_types, text_types in _targets(args):
+            paths = [_path(template, img_types, text_types, rng) for _ in range(args.requests)]
+            chunks = [paths[i::args.concurrency] for i in range(args.concurrency)]
+            latencies, errors, lock = [], [0], threading.Lock()
+            threads = [
+                threading.Thread(
+                    target=_http_worker,
+                    args=("127.0.0.1", args.port, chunk, latencies, errors, lock),
+                )
+                for chunk in chunks
+            ]
+            begin = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - begin
+            rss = _rss_kb(proc.pid) + sum(_rss_kb(pid) for pid in _children(proc.pid))
+            rows.append(_summary(name, latencies, elapsed, errors[0], rss))
+
+        _print_report(
+            f"HTTP (gunicorn {args.server}, {args.workers} 个工作进程, 并发 {args.concurrency})",
+            rows,
+        )
+        return rows
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hcanranbapi 基准测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def common(p):
+        p.add_argument("--root", default="/tmp/hcanranbapi-bench", help="模拟目录位置")
+        p.add_argument("--seed", type=int, default=1, help="随机数种子")
+
+    p = sub.add_parser("gen", help="生成模拟的图片/文本目录")
+    common(p)
+    p.add_argument("--images", type=int, default=10000, help="图片总数 (1k - 1M)")
+    p.add_argument("--types", type=int, default=4, help="类型数量")
+    p.add_argument("--image-bytes", type=int, default=4096, help="单张图片的平均字节数")
+    p.add_argument("--text-files", type=int, default=4, help="每个类型的文本文件数")
+    p.add_argument("--min-lines", type=int, default=100, help="每个文本文件的最少行数")
+    p.add_argument("--max-lines", type=int, default=100000, help="每个文本文件的最多行数")
+
+    for name, help_text in (("inproc", "进程内压测"), ("http", "本地 gunicorn 压测")):
+        p = sub.add_parser(name, help=help_text)
+        common(p)
+        p.add_argument("--requests", type=int, default=1000, help="每个接口的请求数")
+        p.add_argument("--endpoints", default="", help="只测试指定接口, 逗号分隔")
+        p.add_argument("--output", default="", help="将结果以 JSON 写入文件")
+        if name == "http":
+            p.add_argument("--port", type=int, default=5090, help="gunicorn 监听端口")
+            p.add_argument("--workers", type=int, default=2, help="gunicorn 工作进程数")
+            p.add_argument("--concurrency", type=int, default=16, help="并发连接数")
+            p.add_argument("--server", choices=["wsgi", "asgi"], default="wsgi", help="服务模式")
+
+    args = parser.parse_args()
+    if args.command == "gen":
+        generate(args)
+        return
+
+    if not os.path.isdir(os.path.join(args.root, "img")):
+        print(f"❌ 未找到模拟目录 {args.root}, 请先运行: python bench.py gen --root {args.root}")
+        sys.exit(1)
+
+    rows = run_inproc(args) if args.command == "inproc" else run_http(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -64,3 +64,36 @@ forwarded_allow_ips = '*'  # 或者指定具体的代理IP，如 '127.0.0.1,10.0
 secure_scheme_headers = {
     'X-FORWARDED-PROTO': 'https'
 }
+
+
+def when_ready(server):
+    """
+    主进程就绪后 (守护进程化之后、fork 工作进程之前) 输出启动报告并发布共享索引,
+    之后由主进程负责目录监听
+    """
+    import sys
+    from var.toml_config import CATALOG_SHARED, CATALOG_SNAPSHOT_DIR, CATALOG_PUBLISH_DELAY
+
+    # 只在 preload_app 已加载应用时输出, 不在主进程中额外加载
+    preloaded = sys.modules.get("hcanranbapi")
+    if preloaded is not None:
+        from var.startup import format_report
+
+        server.log.info(format_report(preloaded.app.extensions["startup_report"]))
+
+    if not CATALOG_SHARED:
+        return
+    from hcanranbapi import app
+    from var.shared_catalog import serve_master
+
+    serve_master(app, CATALOG_SNAPSHOT_DIR, CATALOG_PUBLISH_DELAY)
+
+
+def post_fork(server, worker):
+    """
+    工作进程改为映射主进程发布的共享索引, 不再各自扫描 usr/img 和 usr/text
+    """
+    from hcanranbapi import app
+    from var.shared_catalog import attach_worker
+
+    attach_worker(app)
@@ -23,14 +23,22 @@ No error messages should appear !!! ()
 """
 
 
+import time
+
+# 启动报告中的导入耗时从这里开始计算
+_started = time.perf_counter()
 
 from flask import Flask
 from var.Inits import Init_module
+from var.asgi import AsgiAdapter
 
 
 
 app = Flask(__name__)
-Init_module(app)
+Init_module(app, _started)
+
+# ASGI 入口: gunicorn -k uvicorn.workers.UvicornWorker hcanranbapi:asgi_app
+asgi_app = AsgiAdapter(app)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
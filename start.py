@@ -3,6 +3,143 @@ import os
 import sys
 import argparse
 import subprocess
+import time
+
+
+def build_assets():
+    """
+    生成 /css、/js 资源的 gzip/brotli/zstd 文件和清单, 服务启动时直接读取
+    """
+    from var.toml_config import THEME_DIR, THEME_ASSET_DIR
+    from var.theme_assets import ThemeAssets
+
+    assets = ThemeAssets(os.path.join(THEME_DIR, "misstatement"), THEME_ASSET_DIR)
+    count = assets.build()
+    print(f"已生成 {count} 个静态资源 -> {THEME_ASSET_DIR}")
+    for url, hashed_url in sorted(assets.manifest.items()):
+        asset = assets.by_url[url]
+        sizes = ", ".join(f"{enc} {len(data)}" for enc, data in asset.variants.items())
+        print(f"  {url} -> {hashed_url} ({sizes})")
+
+
+def build_variants(workers=None):
+    """
+    为全部图片预生成 [derive] variants 中配置的尺寸/格式, 未变化的图片跳过
+    """
+    from var.toml_config import IMAGE_BASE, ALLOWED_EXTENSIONS, DERIVE_CACHE_DIR, DERIVE_VARIANTS
+    from var.toml_config import DERIVE_MAX_DIMENSION, DERIVE_DEFAULT_QUALITY
+    from var.img.img_variants import build_variants as build
+
+    def progress(done, total):
+        if done == total or done % 100 == 0:
+            print(f"\r  {done}/{total}", end="\n" if done == total else "", flush=True)
+
+    started = time.monotonic()
+    result = build(
+        IMAGE_BASE, ALLOWED_EXTENSIONS, DERIVE_CACHE_DIR, DERIVE_VARIANTS,
+        DERIVE_MAX_DIMENSION, DERIVE_DEFAULT_QUALITY, workers, progress,
+    )
+    print(
+        f"已处理 {result['images']} 张图片: 生成 {result['rendered']} 个版本, "
+        f"跳过 {result['skipped']} 个未变化的版本, 失败 {result['failed']} 个 "
+        f"({time.monotonic() - started:.1f}s) -> {DERIVE_CACHE_DIR}"
+    )
+
+
+def index_metadata(workers=None):
+    """
+    以全部 CPU 核心为图片生成元数据索引 (包括开启时的主色调), 未变化的图片跳过
+    """
+    from var.toml_config import IMAGE_BASE, ALLOWED_EXTENSIONS
+    from var.toml_config import METADATA_INDEX_FILE, METADATA_DOMINANT_COLOR
+    from var.img.img_utils import ImageCatalog
+    from var.img.img_meta import build_metadata
+
+    started = time.monotonic()
+    catalog = ImageCatalog(IMAGE_BASE, ALLOWED_EXTENSIONS)
+    catalog.scan()
+    index, count = build_metadata(catalog, METADATA_INDEX_FILE, METADATA_DOMINANT_COLOR, workers)
+    print(
+        f"已索引 {len(index)} 张图片, 本次读取 {count} 张 "
+        f"({time.monotonic() - started:.1f}s) -> {METADATA_INDEX_FILE}"
+    )
+
+
+def dedup_report(workers=None):
+    """
+    计算全部图片的内容哈希和感知哈希 (未变化的图片跳过), 列出完全相同和近似重复的图片
+    """
+    from var.toml_config import IMAGE_BASE, ALLOWED_EXTENSIONS
+    from var.toml_config import DEDUP_INDEX_FILE, DEDUP_NEAR_DISTANCE
+    from var.img.img_utils import ImageCatalog
+    from var.img.img_dedup import build_duplicates
+
+    started = time.monotonic()
+    catalog = ImageCatalog(IMAGE_BASE, ALLOWED_EXTENSIONS)
+    catalog.scan()
+    index, count = build_duplicates(catalog, DEDUP_INDEX_FILE, workers)
+    print(
+        f"已索引 {len(index)} 张图片, 本次读取 {count} 张 "
+        f"({time.monotonic() - started:.1f}s) -> {DEDUP_INDEX_FILE}"
+    )
+
+    exact = index.exact_groups()
+    wasted = sum(index.record(keys[0])[0][1] * (len(keys) - 1) for keys in exact)
+    print(f"\n内容完全相同: {len(exact)} 组, 重复 {len(index.canonical)} 张, 占用 {wasted / 1048576:.1f} MiB")
+    for keys in exact:
+        print(f"  {keys[0]} ({index.record(keys[0])[0][1]} 字节)")
+        for key in keys[1:]:
+            print(f"    = {key}")
+
+    near = index.near_groups(DEDUP_NEAR_DISTANCE)
+    print(f"\n近似重复 (汉明距离 <= {DEDUP_NEAR_DISTANCE}): {len(near)} 组")
+    for group in near:
+        print(f"  {group[0][0]}")
+        for key, distance in group[1:]:
+            print(f"    ~ {key} (距离 {distance})")
+
+
+def pack_images(unpack=False, remove_source=False):
+    """
+    把每个 类型/方向 目录中新增或修改的图片追加到该方向的包文件, 或把包文件还原为目录
+    """
+    from var.toml_config import IMAGE_BASE, ALLOWED_EXTENSIONS
+    from var.img.img_utils import ImageCatalog, ORIENTATIONS
+    from var.img.img_pack import pack_path, pack_directory, unpack_directory
+
+    started = time.monotonic()
+    is_allowed = ImageCatalog(IMAGE_BASE, ALLOWED_EXTENSIONS).is_allowed
+    total = 0
+    for img_type in sorted(os.listdir(IMAGE_BASE)):
+        type_path = os.path.join(IMAGE_BASE, img_type)
+        if not os.path.isdir(type_path):
+            continue
+        for orientation in ORIENTATIONS:
+            dir_path = os.path.join(type_path, orientation)
+            path = pack_path(type_path, orientation)
+            if unpack:
+                if not os.path.isfile(path):
+                    continue
+                count = unpack_directory(path, dir_path, remove_source)
+                print(f"  {img_type}/{orientation}: 还原 {count} 张")
+            else:
+                if not os.path.isdir(dir_path):
+                    continue
+                count, removed = pack_directory(dir_path, path, is_allowed, remove_source)
+                print(f"  {img_type}/{orientation}: 追加 {count} 张, 删除原文件 {removed} 个")
+            total += count
+    action = "还原" if unpack else "打包"
+    print(f"已{action} {total} 张图片 ({time.monotonic() - started:.1f}s)")
+
+
+def startup_report():
+    """
+    在本进程中加载一次应用 (与 gunicorn preload_app 相同的启动过程), 打印各阶段的耗时
+    """
+    import hcanranbapi
+    from var.startup import format_report
+
+    print(format_report(hcanranbapi.app.extensions["startup_report"]))
 
 
 def main():
@@ -18,12 +155,83 @@ def main():
         choices=["development", "production"],
         help="运行环境",
     )
+    parser.add_argument(
+        "--server",
+        type=str,
+        default="wsgi",
+        choices=["wsgi", "asgi"],
+        help="服务模式: wsgi 为同步工作进程, asgi 使用 uvicorn 工作进程异步发送文件",
+    )
+    parser.add_argument(
+        "--build-assets",
+        action="store_true",
+        help="预先生成主题静态资源的压缩版本和带哈希的文件名后退出",
+    )
+    parser.add_argument(
+        "--build-variants",
+        action="store_true",
+        help="为全部图片预生成配置的尺寸/格式版本后退出 (--workers 指定并行进程数, 默认为CPU核心数)",
+    )
+    parser.add_argument(
+        "--index-metadata",
+        action="store_true",
+        help="为全部图片生成元数据索引后退出 (--workers 指定并行进程数, 默认为CPU核心数)",
+    )
+    parser.add_argument(
+        "--dedup-report",
+        action="store_true",
+        help="为全部图片生成内容哈希索引, 列出重复和近似重复的图片后退出 (--workers 指定并行进程数, 默认为CPU核心数)",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="把各 类型/方向 目录中新增或修改的图片追加到 <方向>.pack 包文件后退出",
+    )
+    parser.add_argument(
+        "--unpack",
+        action="store_true",
+        help="把 <方向>.pack 包文件还原为目录后退出",
+    )
+    parser.add_argument(
+        "--remove-source",
+        action="store_true",
+        help="与 --pack/--unpack 一起使用: 写入完成后删除原文件/包文件",
+    )
+    parser.add_argument(
+        "--startup-report",
+        action="store_true",
+        help="加载一次应用, 打印导入、索引构建等各启动阶段的耗时后退出",
+    )
     args = parser.parse_args()
 
     # 获取当前目录
     current_dir = os.path.dirname(os.path.abspath(__file__))
     os.chdir(current_dir)
 
+    if args.build_assets:
+        build_assets()
+        return
+
+    if args.build_variants:
+        build_variants(args.workers)
+        return
+
+    if args.index_metadata:
+        index_metadata(args.workers)
+        return
+
+    if args.dedup_report:
+        dedup_report(args.workers)
+        return
+
+    if args.pack or args.unpack:
+        pack_images(args.unpack, args.remove_source)
+        return
+
+    if args.startup_report:
+        startup_report()
+        return
+
     # 构建gunicorn命令
     cmd = [
         "gunicorn",
@@ -32,6 +240,11 @@ def main():
         "gunicorn_config.py",
     ]
 
+    if args.server == "asgi":
+        # 每个uvicorn工作进程可以同时保持大量下载连接
+        cmd[1] = "hcanranbapi:asgi_app"
+        cmd.extend(["--worker-class", "uvicorn.workers.UvicornWorker"])
+
     # 根据参数调整命令
     if args.daemon:
         cmd.append("--daemon")
@@ -52,6 +265,7 @@ def main():
     print("正在启动Gunicorn服务器...")
     print(f"命令: {' '.join(cmd)}")
     print("应用: hcanranbapi.py")
+    print(f"模式: {args.server}")
     print(f"端口: {args.port}")
 
     # 检查是否安装了gunicorn
@@ -67,6 +281,14 @@ def main():
         print("请先运行: pip install -r requirements.txt")
         sys.exit(1)
 
+    if args.server == "asgi":
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            print("\n❌ 错误: 未安装uvicorn")
+            print("请先运行: pip install -r requirements.txt")
+            sys.exit(1)
+
     # 启动gunicorn
     try:
         print("\n服务器启动中...")
@@ -1,9 +1,36 @@
 # -*- coding: utf-8 -*-
-from flask import send_from_directory, request
+from flask import send_from_directory, request, abort
 from flask_cors import CORS
 from .toml_config import IMAGE_BASE, TEXT_BASE, ALLOWED_EXTENSIONS, THEME_DIR, LIMITER_BAPC
+from .toml_config import LIMITER_STORAGE, LIMITER_SHARED_FILE, LIMITER_SHARED_SETS, LIMITER_SHARED_WRITERS
+from .toml_config import WATCHER_BACKEND, WATCHER_POLL_INTERVAL
+from .toml_config import CATALOG_PERSIST, CATALOG_BOOT_SNAPSHOT
+from .toml_config import IMAGE_CACHE_BUDGET, IMAGE_CACHE_MAX_ITEM
+from .toml_config import DERIVE_CACHE_DIR, DERIVE_MAX_CACHE_BYTES, DERIVE_WORKERS
+from .toml_config import METADATA_INDEX_FILE, METADATA_DOMINANT_COLOR
+from .toml_config import DEDUP_INDEX_FILE, DEDUP_SERVE_CANONICAL
+from .toml_config import WEIGHTS_MODE, WEIGHTS_EXPLICIT, WEIGHTS_FILE
+from .toml_config import WEIGHTS_POPULARITY_HALF_LIFE, WEIGHTS_POPULARITY_INTERVAL
+from .toml_config import METRICS_ENABLED, METRICS_DIR
+from .toml_config import THEME_CHECK_INTERVAL, THEME_ASSET_DIR
 from .img.img_routes import bp as img_bp
+from .img import img_utils
+from .img.img_cache import init_image_cache
+from .img.img_derive import init_deriver
+from .img.img_variants import init_variant_index
+from .img.img_meta import init_metadata
+from .img.img_dedup import init_dedup
+from .img.img_weights import init_selector
 from .text.text_routes import bp as text_bp
+from .batch_routes import bp as batch_bp
+from .text import text_utils
+from .watcher import start_watcher
+from .shared_catalog import load_boot_snapshot, save_boot_snapshot, boot_summary
+from .startup import StartupTimer
+from .theme_cache import init_theme_cache, get_theme_cache, page_response
+from .theme_assets import init_theme_assets, asset_response
+from . import metrics
+from . import shared_limiter
 import os
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -11,72 +38,83 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 
 
 
-def Init_module(app):
+def Init_module(app, started=None):
+    """
+    Args:
+        started (float): 可选, 入口模块开始导入时的 time.perf_counter(), 计入启动报告
+    """
+    timer = StartupTimer(started)
+
     # 添加ProxyFix中间件以正确获取客户端真实IP, 告诉Flask应用信任1层代理
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
+
+    # 指标收集需在限流器之前注册, 被限流的请求也计入耗时
+    metrics.init_metrics(app, METRICS_DIR if METRICS_ENABLED else None)
     
-    def render_error_page(page_name):
+    def render_error_page(page_name, status):
         """
-        渲染错误页面
+        渲染错误页面, 页面内容按主机缓存, 不再每次读取文件
         """
-        misstatement_dir = os.path.join(app.config['THEME_DIR'], 'misstatement')
-        page_path = os.path.join(misstatement_dir, page_name)
-        
-        if not os.path.isfile(page_path):
-            return f"<h1>Error</h1><p>{page_name.replace('.html', '')} occurred</p>"
-        
-        with open(page_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            
         # 替换相对路径为绝对路径
         base_url = request.host_url.rstrip('/')
-        content = content.replace('href="/', f'href="{base_url}/')
-        content = content.replace('src="/', f'src="{base_url}/')
-        
-        return content
+        rendered = get_theme_cache().render(page_name, base_url)
+        if rendered is None:
+            return f"<h1>Error</h1><p>{page_name.replace('.html', '')} occurred</p>", status
+        return page_response(rendered, status)
+
+    def serve_theme_page(page_name, status=200):
+        """
+        原样返回 misstatement 目录中的页面
+        """
+        rendered = get_theme_cache().render(page_name)
+        if rendered is None:
+            abort(404)
+        return page_response(rendered, status, cache_control='no-cache')
     
 
 
-    # 初始化限流器，使用内存存储
-    limiter = Limiter(
-        key_func=get_remote_address,
-        app=app,
-        default_limits=[f"{LIMITER_BAPC}/minute"],
-        storage_uri="memory://"
-    )
+    # 初始化限流器, 默认使用所有工作进程共享的计数文件, 按滑动窗口计数
+    with timer.phase("limiter"):
+        if LIMITER_STORAGE == "shared":
+            limiter = Limiter(
+                key_func=get_remote_address,
+                app=app,
+                default_limits=[f"{LIMITER_BAPC}/minute"],
+                storage_uri=shared_limiter.storage_uri(LIMITER_SHARED_FILE),
+                storage_options={"sets": LIMITER_SHARED_SETS, "writers": LIMITER_SHARED_WRITERS},
+                strategy="sliding-window-counter"
+            )
+        else:
+            limiter = Limiter(
+                key_func=get_remote_address,
+                app=app,
+                default_limits=[f"{LIMITER_BAPC}/minute"],
+                storage_uri="memory://"
+            )
 
 
     # 服务首页
     @app.route('/')
     def serve_home():
-        theme_dir = app.config['THEME_DIR']
-        misstatement_dir = os.path.join(theme_dir, 'misstatement')
-        return send_from_directory(misstatement_dir, 'index.html')
+        return serve_theme_page('index.html')
     
     # 服务帮助页面
     @app.route('/help')
     def serve_help():
-        theme_dir = app.config['THEME_DIR']
-        misstatement_dir = os.path.join(theme_dir, 'misstatement')
-        help_page_path = os.path.join(misstatement_dir, 'help.html')
-        
-        # 检查帮助页面是否存在
-        if os.path.exists(help_page_path) and os.path.isfile(help_page_path):
-            return send_from_directory(misstatement_dir, 'help.html')
-        else:
-            # 如果帮助页面不存在，返回404错误页面
-            return send_from_directory(misstatement_dir, '404.html'), 404
+        # 帮助页面不存在时返回404错误页面
+        if get_theme_cache().get('help.html') is not None:
+            return serve_theme_page('help.html')
+        return serve_theme_page('404.html', 404)
     
 
     # 服务错误页面
     @app.route('/<path:path>')
     def serve_error_pages(path):
         theme_dir = app.config['THEME_DIR']
-        misstatement_dir = os.path.join(theme_dir, 'misstatement')
         
         # 特殊处理错误页面
         if path in ['429.html', '404.html', '500.html']:
-            return send_from_directory(misstatement_dir, path)
+            return serve_theme_page(path)
         
         # 其他静态文件
         full_path = os.path.join(theme_dir, path)
@@ -84,12 +122,24 @@ def Init_module(app):
             return send_from_directory(theme_dir, path)
         
         # 如果文件不存在，返回404页面
-        return send_from_directory(misstatement_dir, '404.html'), 404
+        return serve_theme_page('404.html', 404)
     
 
+    # Prometheus 指标, 汇总所有工作进程
+    if METRICS_ENABLED:
+        @app.route('/metrics')
+        @limiter.exempt
+        def serve_metrics():
+            return metrics.metrics_response()
+
+
     @app.route('/css/<path:filename>')
     @limiter.exempt
     def admin_assess_css(filename):
+        # 预压缩的资源直接从内存返回
+        rv = asset_response(f'/css/{filename}')
+        if rv is not None:
+            return rv
         theme_dir = app.config['THEME_DIR']
         misstatement_dir = os.path.join(theme_dir, 'misstatement')
         return send_from_directory(f'{misstatement_dir}/asses/css/', filename)
@@ -98,6 +148,9 @@ def Init_module(app):
     @app.route('/js/<path:filename>')
     @limiter.exempt
     def admin_assess_js(filename):
+        rv = asset_response(f'/js/{filename}')
+        if rv is not None:
+            return rv
         theme_dir = app.config['THEME_DIR']
         misstatement_dir = os.path.join(theme_dir, 'misstatement')
         return send_from_directory(f'{misstatement_dir}/asses/js/', filename)
@@ -110,18 +163,55 @@ def Init_module(app):
         'THEME_DIR': THEME_DIR
     })
 
+    # 启动时构建一次图片/文本索引, 之后由目录监听增量更新;
+    # 目录未变化的类型直接映射上次保存的启动快照, 不再扫描
+    with timer.phase("catalog"):
+        boot = None
+        if CATALOG_PERSIST:
+            boot = load_boot_snapshot(CATALOG_BOOT_SNAPSHOT, IMAGE_BASE, TEXT_BASE, ALLOWED_EXTENSIONS)
+        image_catalog = img_utils.init_catalog(app, boot)
+        text_catalog = text_utils.init_catalog(app, boot)
+    timer.notes["boot_snapshot"] = boot_summary(boot, image_catalog, text_catalog)
+    if CATALOG_PERSIST:
+        # 在开始监听之前保存, 快照与记录的目录状态一致
+        with timer.phase("catalog_persist"):
+            try:
+                save_boot_snapshot(CATALOG_BOOT_SNAPSHOT, image_catalog, text_catalog, boot)
+            except OSError:
+                pass
+    with timer.phase("watcher"):
+        start_watcher(app, [image_catalog, text_catalog], WATCHER_BACKEND, WATCHER_POLL_INTERVAL)
+    # 元数据、去重和派生版本的索引文件在第一次使用时读取
+    with timer.phase("image_services"):
+        init_image_cache(app, IMAGE_CACHE_BUDGET, IMAGE_CACHE_MAX_ITEM)
+        init_deriver(app, DERIVE_CACHE_DIR, DERIVE_MAX_CACHE_BYTES, DERIVE_WORKERS)
+        init_variant_index(app, DERIVE_CACHE_DIR)
+        init_metadata(app, METADATA_INDEX_FILE, METADATA_DOMINANT_COLOR)
+        init_dedup(app, DEDUP_INDEX_FILE, DEDUP_SERVE_CANONICAL)
+        init_selector(
+            app, WEIGHTS_MODE, WEIGHTS_EXPLICIT, WEIGHTS_FILE,
+            WEIGHTS_POPULARITY_HALF_LIFE, WEIGHTS_POPULARITY_INTERVAL,
+        )
+    with timer.phase("theme"):
+        misstatement_dir = os.path.join(THEME_DIR, 'misstatement')
+        assets = init_theme_assets(app, misstatement_dir, THEME_ASSET_DIR, THEME_CHECK_INTERVAL)
+        init_theme_cache(app, misstatement_dir, THEME_CHECK_INTERVAL, assets)
+
     # 自定义错误处理器
     @app.errorhandler(429)
     def ratelimit_handler(e):
-        return render_error_page('429.html'), 429
+        metrics.RATELIMIT_REJECTIONS.inc(request.endpoint or "none")
+        return render_error_page('429.html', 429)
     
     @app.errorhandler(404)
     def page_not_found(e):
-        return render_error_page('404.html'), 404
+        return render_error_page('404.html', 404)
     
     CORS(app)
     
     app.register_blueprint(img_bp)
     app.register_blueprint(text_bp)
-    
+    app.register_blueprint(batch_bp)
+
+    timer.finish(app)
     return app
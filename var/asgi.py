@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI 入口: 在事件循环中发送图片文件, 慢速客户端下载时不再占用工作线程
+
+路由、限流、CORS、错误页面等仍由同一个 Flask 应用在线程池中处理, 行为与 WSGI 模式一致;
+视图返回的 wsgi.file_wrapper 文件体 (见 img/img_send.py) 交回事件循环,
+由服务器的 zerocopysend 扩展或按块 pread 异步发送
+"""
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+CHUNK_SIZE = 256 * 1024
+# 线程与事件循环之间缓冲的响应块数量, 满了之后线程等待客户端读取
+QUEUE_SIZE = 8
+
+
+class _Disconnected(Exception):
+    """
+    客户端已断开, 停止生成响应
+    """
+
+
+class _FileBody:
+    """
+    作为 wsgi.file_wrapper 提供给视图, 只记录文件对象, 由事件循环负责发送
+    """
+
+    def __init__(self, filelike, block_size=CHUNK_SIZE):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        # 被其他中间件按普通可迭代对象处理时的兜底
+        while True:
+            data = self.filelike.read(self.block_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self.filelike.close()
+
+
+def _header_value(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+class AsgiAdapter:
+    """
+    把 Flask 应用包装为 ASGI 应用
+
+    Args:
+        app: Flask 应用 (WSGI 可调用对象)
+        max_threads (int): 执行视图函数的线程数
+    """
+
+    def __init__(self, app, max_threads=32):
+        self.app = app
+        self.max_threads = max_threads
+        self._executor = None
+        self._pid = None
+
+    @property
+    def executor(self):
+        # 线程池在 fork 之后的工作进程中创建
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_threads, thread_name_prefix="asgi-wsgi"
+            )
+            self._pid = os.getpid()
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _environ(self, scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            # PEP 3333 要求以 latin-1 字符串表示原始字节
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1] or 80),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "SERVER_SOFTWARE": "hcanranbapi-asgi",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": _FileBody,
+        }
+        for raw_name, raw_value in scope.get("headers", ()):
+            name = raw_name.decode("latin-1").upper().replace("-", "_")
+            value = raw_value.decode("latin-1")
+            if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+                key = name
+            else:
+                key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    def _run_wsgi(self, environ, loop, queue, cancelled):
+        """
+        在线程中执行 Flask 应用, 响应头和响应块通过 queue 交给事件循环
+        """
+        response = {}
+
+        def put(kind, payload):
+            if cancelled.is_set():
+                raise _Disconnected()
+            # 只有第一条消息携带响应头
+            headers = None if response.get("sent") else response
+            response["sent"] = True
+            asyncio.run_coroutine_threadsafe(queue.put((kind, headers, payload)), loop).result()
+
+        def put_error(exc):
+            try:
+                put("error", exc)
+            except _Disconnected:
+                pass
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = headers
+
+        try:
+            result = self.app(environ, start_response)
+        except Exception as exc:
+            put_error(exc)
+            return
+
+        if isinstance(result, _FileBody):
+            # 文件由事件循环发送并关闭
+            try:
+                put("file", result)
+            except _Disconnected:
+                result.close()
+            return
+
+        try:
+            for chunk in result:
+                if chunk:
+                    put("body", chunk)
+            put("end", None)
+        except _Disconnected:
+            pass
+        except Exception as exc:
+            put_error(exc)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    async def _http(self, scope, receive, send):
+        body = await self._read_body(receive)
+        if body is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(QUEUE_SIZE)
+        cancelled = threading.Event()
+        environ = self._environ(scope, body)
+        task = loop.run_in_executor(
+            self.executor, self._run_wsgi, environ, loop, queue, cancelled
+        )
+
+        started = False
+        try:
+            while True:
+                kind, response, payload = await queue.get()
+                if kind == "error":
+                    if not started:
+                        await send({"type": "http.response.start", "status": 500, "headers": []})
+                        await send({"type": "http.response.body", "body": b""})
+                    return
+                if response is not None:
+                    await send({
+                        "type": "http.response.start",
+                        "status": response["status"],
+                        "headers": [
+                            (k.lower().encode("latin-1"), v.encode("latin-1"))
+                            for k, v in response["headers"]
+                        ],
+                    })
+                    started = True
+                if kind == "file":
+                    length = _header_value(response["headers"], "Content-Length")
+                    await self._send_file(scope, send, payload, int(length) if length else None)
+                    return
+                if kind == "end":
+                    await send({"type": "http.response.body", "body": b""})
+                    return
+                await send({"type": "http.response.body", "body": payload, "more_body": True})
+        finally:
+            # 客户端断开等提前结束时, 让线程停止生成并释放它可能在等待的队列位置
+            cancelled.set()
+            while not task.done():
+                try:
+                    kind, _, payload = queue.get_nowait()
+                    if kind == "file":
+                        payload.close()
+                except asyncio.QueueEmpty:
+                    await asyncio.wait({task}, timeout=0.05)
+
+    async def _send_file(self, scope, send, body, length):
+        f = body.filelike
+        try:
+            offset = f.tell()
+            if length is None:
+                length = os.fstat(f.fileno()).st_size - offset
+
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": offset,
+                    "count": length,
+                })
+                return
+
+            loop = asyncio.get_running_loop()
+            fd = f.fileno()
+            while length > 0:
+                data = await loop.run_in_executor(
+                    None, os.pread, fd, min(body.block_size, length), offset
+                )
+                if not data:
+                    # 文件在发送过程中被截断
+                    break
+                offset += len(data)
+                length -= len(data)
+                if length > 0:
+                    await send({"type": "http.response.body", "body": data, "more_body": True})
+                else:
+                    await send({"type": "http.response.body", "body": data})
+                    return
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            body.close()
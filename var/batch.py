@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+批量随机接口 (?n=) 的参数解析
+"""
+from flask import abort, request
+
+
+# 每种类型最多返回的数量
+MAX_BATCH_SIZE = 100
+# /api/random 一次请求最多返回的总数
+MAX_BATCH_TOTAL = 500
+
+
+def batch_size():
+    """
+    解析 ?n= 参数, 未指定时返回 None, 超过 MAX_BATCH_SIZE 时按上限处理
+    """
+    n = request.args.get("n")
+    if n is None:
+        return None
+    try:
+        n = int(n)
+    except ValueError:
+        abort(400, description="Invalid n")
+    if n <= 0:
+        abort(400, description="Invalid n")
+    return min(n, MAX_BATCH_SIZE)
+
+
+def parse_batch_types(value, default):
+    """
+    解析 "A:10,B,C:3" 形式的类型列表, 未写数量的类型使用 default
+
+    Returns:
+        list: [(type, n), ...]
+    """
+    types = []
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, count = part.rpartition(":") if ":" in part else (part, "", "")
+        n = default
+        if count:
+            try:
+                n = int(count)
+            except ValueError:
+                abort(400, description=f"Invalid count for '{name}'")
+            if n <= 0:
+                abort(400, description=f"Invalid count for '{name}'")
+        types.append((name, min(n, MAX_BATCH_SIZE)))
+    return types
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+多类型批量随机接口
+
+    /api/random?img=A:10,B:5&text=C:3
+    /api/random?img=A,B&n=10
+    /api/random?img=all:10          (跨类型按权重选择, 见 img_weights)
+
+图片部分同样支持 orientation、min_width 等参数; 一次请求返回
+{"images": {类型: [...]}, "texts": {类型: [...]}}, 每个类型内不放回地选择.
+?session= 模式下另外返回 "sessions": {"images": {类型: 状态}, "texts": {类型: 状态}},
+各类型的状态以逗号连接后作为下一次请求的 ?session= (与 X-Shuffle-Session 响应头相同)
+"""
+from flask import Blueprint, abort, jsonify, request
+from .batch import MAX_BATCH_TOTAL, batch_size, parse_batch_types
+from .img import img_utils
+from .img.img_routes import random_image_items
+from .img.img_weights import ALL_TYPES
+from .shuffle import session_token
+from .text.text_routes import random_text_items
+
+
+bp = Blueprint("batch_routes", __name__)
+
+
+@bp.route("/api/random")
+def random_batch():
+    default = batch_size() or 1
+    img_types = parse_batch_types(request.args.get("img", ""), default)
+    text_types = parse_batch_types(request.args.get("text", ""), default)
+    if not img_types and not text_types:
+        abort(400, description="No types requested")
+    if sum(n for _, n in img_types + text_types) > MAX_BATCH_TOTAL:
+        abort(400, description=f"At most {MAX_BATCH_TOTAL} items per request")
+
+    catalog = img_utils.get_catalog()
+    images = {}
+    for img_type, n in img_types:
+        if img_type != ALL_TYPES and not catalog.has_type(img_type):
+            abort(404, description=f"Invalid image type '{img_type}'")
+        images[img_type] = random_image_items(img_type, n)
+
+    texts = {}
+    for text_type, n in text_types:
+        items = random_text_items(text_type, n)
+        if items is None:
+            abort(404, description=f"No text available for type '{text_type}'")
+        texts[text_type] = items
+
+    rv = {"images": images, "texts": texts}
+    # 每个类型各自的洗牌状态
+    sessions = {}
+    for kind, prefix, types in (("images", "img", images), ("texts", "text", texts)):
+        tokens = ((t, session_token(f"{prefix}/{t}")) for t in types)
+        sessions[kind] = {t: token for t, token in tokens if token is not None}
+    if any(sessions.values()):
+        rv["sessions"] = sessions
+    return jsonify(rv)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+热门图片的进程内 LRU 字节缓存
+
+按总字节数限制容量, 缓存值带有 ETag, 文件修改时间/大小/inode 变化后自动失效
+"""
+import threading
+from collections import OrderedDict
+from flask import current_app
+from ..metrics import CACHE_REQUESTS
+from .img_pack import read_image
+
+
+class ImageByteCache:
+    """
+    以图片路径为键的 LRU 缓存, 值为 (etag, bytes)
+    """
+
+    def __init__(self, budget, max_item_size):
+        self.budget = budget
+        self.max_item_size = max_item_size
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def accepts(self, entry):
+        return 0 < entry.size <= self.max_item_size and entry.size <= self.budget
+
+    def get(self, entry):
+        """
+        返回缓存的图片内容, 未命中或已失效时读取文件并放入缓存
+
+        Returns:
+            bytes: 文件不存在时返回 None
+        """
+        etag = entry.etag
+        with self._lock:
+            cached = self._items.get(entry.path)
+            if cached is not None:
+                if cached[0] == etag:
+                    self._items.move_to_end(entry.path)
+                    self.hits += 1
+                    CACHE_REQUESTS.inc("image_bytes", "hit")
+                    return cached[1]
+                # 文件已变化, 丢弃旧内容
+                del self._items[entry.path]
+                self.used -= len(cached[1])
+            self.misses += 1
+        CACHE_REQUESTS.inc("image_bytes", "miss")
+
+        try:
+            data = read_image(entry, entry.size + 1)
+        except OSError:
+            return None
+        if len(data) != entry.size:
+            # 索引与磁盘不一致 (文件正在写入), 本次不缓存
+            return data
+
+        with self._lock:
+            if entry.path not in self._items:
+                self._items[entry.path] = (etag, data)
+                self.used += len(data)
+                while self.used > self.budget:
+                    _, (_, evicted) = self._items.popitem(last=False)
+                    self.used -= len(evicted)
+                    self.evictions += 1
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.used = 0
+
+    def stats(self):
+        return {
+            "items": len(self._items),
+            "bytes": self.used,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def init_image_cache(app, budget, max_item_size):
+    """
+    创建缓存并挂载到 app.extensions, budget 为 0 时不启用
+    """
+    cache = ImageByteCache(budget, max_item_size) if budget > 0 else None
+    app.extensions["image_cache"] = cache
+    return cache
+
+
+def get_image_cache():
+    return current_app.extensions.get("image_cache")
@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+"""
+图片去重: 内容哈希与感知哈希索引
+
+每张图片记录内容的 BLAKE2b 哈希和 64 位感知哈希 (dHash, 需要 Pillow), 按 类型/方向/文件名
+保存在紧凑的二进制索引文件中, 以 inode、大小、修改时间校验, 只重新读取新增或修改的图片;
+运行中图片索引变化后由后台线程只计算变化图片的哈希 (见 img_sync), 请求不等待:
+
+    - 内容完全相同的图片为一组, 按 类型/方向/文件名 排序的第一张为规范文件; 开启 serve_canonical
+      后其余图片都从规范文件读取 (包括派生图片的缓存), 操作系统页缓存和进程内缓存中只保留一份
+    - 感知哈希的汉明距离不超过阈值的图片为近似重复 (缩放、重新压缩、轻微调色),
+      只在 `python start.py --dedup-report` 的报告中列出
+"""
+import hashlib
+import importlib.util
+import os
+import struct
+import threading
+from flask import current_app
+from .img_pack import image_source, read_source, source_file
+from .img_sync import BackgroundUpdater, IndexFollower, changed_types, entry_key, iter_changed, lead
+
+# Pillow 导入较慢, 只检查是否安装, 第一次计算感知哈希时才导入
+HAS_PILLOW = importlib.util.find_spec("PIL") is not None
+
+
+# 抽到重复图片时重新抽取的最多次数
+REDRAW_ATTEMPTS = 8
+
+MAGIC = b"HCRBDUPS"
+VERSION = 1
+_HEADER = struct.Struct("<8sII")
+# inode, size, mtime, 内容哈希, 感知哈希, 是否有感知哈希, 路径长度
+_RECORD = struct.Struct("<QQd16sQBH")
+DIGEST_SIZE = 16
+
+
+def content_digest(src):
+    if not isinstance(src, str):
+        return hashlib.blake2b(read_source(src), digest_size=DIGEST_SIZE).digest()
+    with open(src, "rb") as f:
+        return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=DIGEST_SIZE)).digest()
+
+
+def perceptual_hash(src):
+    """
+    dHash: 缩小为 9x8 的灰度图, 每行相邻像素比较亮度得到 64 位
+
+    Returns:
+        int: 无法识别时返回 None
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(source_file(src)) as im:
+            im.draft("L", (64, 64))
+            pixels = im.convert("L").resize((9, 8), Image.Resampling.BILINEAR, reducing_gap=2.0).tobytes()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    value = 0
+    for row in range(0, 72, 9):
+        for i in range(row, row + 8):
+            value = (value << 1) | (pixels[i] < pixels[i + 1])
+    return value
+
+
+def _hash_job(job):
+    # 进程池中执行
+    src, perceptual = job
+    try:
+        digest = content_digest(src)
+    except OSError:
+        return None
+    return digest, perceptual_hash(src) if perceptual else None
+
+
+def _stat_key(entry):
+    return entry.inode, entry.size, entry.mtime
+
+
+def _entry_key(entry):
+    return entry_key(entry.img_type, entry.orientation, entry.filename)
+
+
+def _group_add(groups, digest, key):
+    # 只有一张图片的组直接保存 key, 避免为每张图片创建集合
+    members = groups.get(digest)
+    if members is None:
+        groups[digest] = key
+    elif isinstance(members, str):
+        if members != key:
+            groups[digest] = {members, key}
+    else:
+        members.add(key)
+
+
+def _group_remove(groups, digest, key):
+    members = groups.get(digest)
+    if members == key:
+        del groups[digest]
+    elif isinstance(members, set):
+        members.discard(key)
+        if len(members) == 1:
+            groups[digest] = members.pop()
+
+
+class DuplicateIndex:
+    """
+    {img_type: {类型/方向/文件名: ((inode, size, mtime), 内容哈希, 感知哈希)}}
+
+    请求只读取最近一次发布的结果 (records/canonical 整体替换), 哈希在后台线程中计算
+
+    Args:
+        path (str): 索引文件路径
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        # {重复图片: 规范文件}, 只包含非规范文件
+        self.canonical = {}
+        # 同一 类型/方向 内已有内容相同、排序更前的图片的 key, 随机选择时跳过
+        self.shadowed = frozenset()
+        # 已对齐的图片索引版本, None 表示尚未完成第一次对齐
+        self.generation = None
+        # 已对齐的 {img_type: 类型版本}
+        self.type_generations = {}
+        # {内容哈希: key 或 {key, ...}}, 只在更新时使用
+        self._groups = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._updater = BackgroundUpdater(self.update, "image-dedup")
+        # 工作进程中跟随主进程保存的索引文件, 不自行计算哈希
+        self._follower = None
+
+    def __len__(self):
+        return sum(len(type_records) for type_records in self.records.values())
+
+    def lead(self, catalog, watcher):
+        """
+        gunicorn when_ready 中调用: 由主进程在目录变化后计算哈希并保存索引文件
+        """
+        lead(self._updater, catalog, watcher)
+
+    def follow(self):
+        """
+        gunicorn post_fork 中调用: 不再自行计算哈希, 只在主进程保存的索引文件变化后重新读取
+        """
+        # fork 时主进程的后台线程可能持有锁
+        self._lock = threading.Lock()
+        self._follower = IndexFollower(self.path, self.reload, "image-dedup")
+
+    def reload(self):
+        """
+        重新读取索引文件并重新分组
+        """
+        with self._lock:
+            self.load()
+
+    def record(self, key):
+        """
+        返回 key 的记录, 没有记录时返回 None
+        """
+        return self.records.get(key.split("/", 1)[0], {}).get(key)
+
+    def load(self):
+        """
+        读取索引文件, 文件不存在或格式不同时从空索引开始
+        """
+        records = {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            magic, version, count = _HEADER.unpack_from(data, 0)
+            if magic == MAGIC and version == VERSION:
+                offset = _HEADER.size
+                for _ in range(count):
+                    inode, size, mtime, digest, phash, has_phash, name_len = _RECORD.unpack_from(data, offset)
+                    offset += _RECORD.size
+                    key = os.fsdecode(data[offset:offset + name_len])
+                    offset += name_len
+                    records.setdefault(key.split("/", 1)[0], {})[key] = (
+                        (inode, size, mtime), digest, phash if has_phash else None
+                    )
+        except (OSError, struct.error, UnicodeDecodeError):
+            pass
+        groups = {}
+        for type_records in records.values():
+            for key, (_, digest, _) in type_records.items():
+                _group_add(groups, digest, key)
+        self.records = records
+        self._groups = groups
+        self.canonical = self._canonical_map(groups, groups, {})
+        self.shadowed = self._shadowed(self.canonical)
+        self._loaded = True
+        return self
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        parts = [_HEADER.pack(MAGIC, VERSION, len(self))]
+        for type_records in self.records.values():
+            for key, ((inode, size, mtime), digest, phash) in type_records.items():
+                name = os.fsencode(key)
+                parts.append(_RECORD.pack(
+                    inode, size, mtime, digest, phash or 0, phash is not None, len(name),
+                ))
+                parts.append(name)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(parts))
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _canonical_map(groups, digests, canonical):
+        """
+        重新计算 digests 中各组的规范文件, 其余组沿用 canonical 中的结果
+
+        Returns:
+            dict: 新的 {重复图片: 规范文件}
+        """
+        canonical = dict(canonical)
+        for digest in digests:
+            members = groups.get(digest)
+            if members is None:
+                continue
+            if isinstance(members, str):
+                # 组内只剩一张图片
+                canonical.pop(members, None)
+                continue
+            first = min(members)
+            for key in members:
+                if key != first:
+                    canonical[key] = first
+            canonical.pop(first, None)
+        return canonical
+
+    def update(self, catalog, workers=None, perceptual=False):
+        """
+        与图片索引对齐: 只检查上次对齐之后变化的图片, 补齐新增或修改的, 删除已不存在的记录,
+        只重新计算涉及的重复分组
+
+        Args:
+            catalog (ImageCatalog): 图片索引
+            workers (int): 大于 1 时以进程池并行读取
+            perceptual (bool): 同时计算感知哈希 (需要解码图片)
+
+        Returns:
+            int: 新读取的图片数量
+        """
+        perceptual = perceptual and HAS_PILLOW
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            generation = catalog.generation
+            if generation == self.generation and not perceptual:
+                return 0
+            type_generations = {t: catalog.type_generation(t) for t in catalog.types}
+            if perceptual:
+                # 补齐感知哈希时检查全部图片
+                changed = dict.fromkeys(set(catalog.types).union(self.records))
+            else:
+                changed = changed_types(catalog, self.generation, self.type_generations, self.records)
+
+            # 只复制变化的类型, 其余类型的记录继续共用
+            records = dict(self.records)
+            entries = {}
+            missing = []
+            removed = []
+            for img_type, names in changed.items():
+                type_records = dict(records.get(img_type, ()))
+                for key, entry in iter_changed(catalog, img_type, names, type_records):
+                    record = type_records.get(key)
+                    if entry is None:
+                        if record is not None:
+                            removed.append((key, record))
+                    elif (record is None or record[0] != _stat_key(entry)
+                            or (perceptual and record[2] is None)):
+                        entries[key] = entry
+                        missing.append(key)
+                records[img_type] = type_records
+
+            jobs = [(image_source(entries[key]), perceptual) for key in missing]
+            if workers and workers > 1 and len(jobs) > 1:
+                from concurrent.futures import ProcessPoolExecutor
+
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(_hash_job, jobs, chunksize=16))
+            else:
+                results = [_hash_job(job) for job in jobs]
+
+            # 重复分组只更新涉及的内容哈希
+            groups = self._groups
+            affected = set()
+            touched = set()
+            for key, result in zip(missing, results):
+                record = records[key.split("/", 1)[0]].get(key)
+                if result is None:
+                    if record is not None:
+                        removed.append((key, record))
+                    continue
+                if record is not None:
+                    _group_remove(groups, record[1], key)
+                    affected.add(record[1])
+                records[key.split("/", 1)[0]][key] = (_stat_key(entries[key]), *result)
+                _group_add(groups, result[0], key)
+                affected.add(result[0])
+                touched.add(key)
+            for key, (_, digest, _) in removed:
+                records[key.split("/", 1)[0]].pop(key, None)
+                _group_remove(groups, digest, key)
+                affected.add(digest)
+                touched.add(key)
+            for img_type in changed:
+                if not records[img_type]:
+                    del records[img_type]
+
+            canonical = self.canonical
+            if touched:
+                canonical = {k: v for k, v in canonical.items() if k not in touched}
+                canonical = self._canonical_map(groups, affected, canonical)
+
+            self.records = records
+            self.canonical = canonical
+            if touched:
+                self.shadowed = self._shadowed(canonical)
+            self.type_generations = type_generations
+            self.generation = generation
+        if touched:
+            try:
+                self.save()
+            except OSError:
+                pass
+        return len(missing)
+
+    def refresh(self, catalog):
+        """
+        图片索引变化后在后台线程中对齐, 不等待结果; 在此之前继续使用上一次的结果
+        """
+        if self._follower is not None:
+            self._follower.check()
+        elif catalog.generation != self.generation:
+            self._updater.request(catalog)
+
+    @staticmethod
+    def _shadowed(canonical):
+        """
+        每组重复图片在每个 类型/方向 内只保留排序最前的一张, 返回其余图片的 key
+        """
+        groups = {}
+        for key, target in canonical.items():
+            groups.setdefault(target, [target]).append(key)
+        shadowed = set()
+        for members in groups.values():
+            seen = set()
+            for key in sorted(members):
+                prefix = key.rsplit("/", 1)[0]
+                if prefix in seen:
+                    shadowed.add(key)
+                seen.add(prefix)
+        return frozenset(shadowed)
+
+    def resolve(self, catalog, entry):
+        """
+        返回与 entry 内容相同的规范文件的索引记录; 不是重复图片或记录已过期 (包括尚未计算哈希) 时
+        返回 entry 本身
+        """
+        key = _entry_key(entry)
+        target = self.canonical.get(key)
+        if target is None:
+            return entry
+        record = self.record(key)
+        if record is None or record[0] != _stat_key(entry):
+            return entry
+        source = catalog.lookup(*target.split("/", 2))
+        if source is None:
+            return entry
+        record = self.record(target)
+        if record is None or record[0] != _stat_key(source):
+            return entry
+        return source
+
+    def exact_groups(self):
+        """
+        Returns:
+            list: [[规范文件, 重复图片, ...], ...], 按浪费的空间从大到小排序
+        """
+        groups = {}
+        for key, target in self.canonical.items():
+            groups.setdefault(target, [target]).append(key)
+        rv = [sorted(keys) for keys in groups.values()]
+        rv.sort(key=lambda keys: -self.record(keys[0])[0][1] * (len(keys) - 1))
+        return rv
+
+    def near_groups(self, max_distance):
+        """
+        感知哈希的汉明距离不超过 max_distance 的近似重复图片, 内容完全相同的图片只取规范文件
+
+        按鸽巢原理把 64 位分为 max_distance + 1 段, 距离不超过阈值的两张图片至少有一段完全相同,
+        只比较至少一段相同的图片
+
+        Returns:
+            list: [[(key, 与第一张的距离), ...], ...]
+        """
+        hashes = {
+            key: phash
+            for type_records in self.records.values()
+            for key, (_, _, phash) in type_records.items()
+            if phash is not None and key not in self.canonical
+        }
+        keys = sorted(hashes)
+        bands = min(max_distance, 63) + 1
+        bounds = [64 * i // bands for i in range(bands + 1)]
+
+        parent = list(range(len(keys)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for b in range(bands):
+            shift = bounds[b]
+            mask = (1 << (bounds[b + 1] - shift)) - 1
+            buckets = {}
+            for i, key in enumerate(keys):
+                buckets.setdefault((hashes[key] >> shift) & mask, []).append(i)
+            for members in buckets.values():
+                for n, i in enumerate(members):
+                    for j in members[n + 1:]:
+                        if (hashes[keys[i]] ^ hashes[keys[j]]).bit_count() <= max_distance:
+                            parent[find(j)] = find(i)
+
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(find(i), []).append(key)
+        rv = []
+        for members in groups.values():
+            if len(members) > 1:
+                first = hashes[members[0]]
+                rv.append([(key, (hashes[key] ^ first).bit_count()) for key in members])
+        rv.sort(key=lambda group: -len(group))
+        return rv
+
+
+def build_duplicates(catalog, path, workers=None):
+    """
+    以进程池计算全部图片的内容哈希和感知哈希
+
+    Returns:
+        tuple: (DuplicateIndex, 新读取的图片数量)
+    """
+    index = DuplicateIndex(path).load()
+    count = index.update(catalog, workers or os.cpu_count(), perceptual=True)
+    return index, count
+
+
+def init_dedup(app, path, enabled=False):
+    """
+    创建内容哈希索引, enabled 为 False 时不启用; 索引文件在第一次使用时由后台线程读取并补齐缺少的图片,
+    不计入启动时间
+    """
+    index = None
+    if enabled:
+        index = DuplicateIndex(path)
+    app.extensions["image_dedup"] = index
+    return index
+
+
+def canonical_entry(catalog, entry):
+    """
+    开启 serve_canonical 时返回内容相同的规范文件, 否则返回 entry 本身;
+    图片索引变化后在后台计算哈希, 新图片在其记录就绪之前按原样返回
+    """
+    index = current_app.extensions.get("image_dedup")
+    if index is None:
+        return entry
+    index.refresh(catalog)
+    return index.resolve(catalog, entry)
+
+
+def distinct_entries(draw, k):
+    """
+    开启 serve_canonical 时, 同一 类型/方向 内内容相同的图片只算一张: 抽到其余重复图片时重新抽取,
+    每组重复图片被选中的概率与其他图片相同 (不同方向、不同类型中的重复图片仍各自计数)
+
+    Args:
+        draw (callable): draw(n) 不放回地随机选择至多 n 张图片
+        k (int): 数量
+
+    Returns:
+        list: [ImageEntry, ...]
+    """
+    entries = draw(k)
+    index = current_app.extensions.get("image_dedup")
+    if index is None or not index.shadowed or not entries:
+        return entries
+    shadowed = index.shadowed
+    first = entries
+    chosen = {}
+    for _ in range(REDRAW_ATTEMPTS):
+        for entry in entries:
+            key = _entry_key(entry)
+            if key not in shadowed:
+                chosen.setdefault(key, entry)
+        if len(chosen) >= k:
+            break
+        entries = draw(k - len(chosen))
+        if not entries:
+            break
+    # 多次只抽到重复图片时 (几乎全是重复图片的小目录) 退回第一次的结果
+    return list(chosen.values())[:k] or first
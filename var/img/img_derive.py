@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+按请求参数缩放/转换格式的派生图片
+
+/random_image/<type> 和 /image/<type>/<orientation>/<filename> 支持 ?w= ?h= ?fmt= ?q= 参数:
+
+    - 派生图片按 (原图 ETag, 参数) 的哈希保存在磁盘缓存目录中, 原图变化后自然换用新文件
+    - 缓存总大小超过上限时按最近访问时间删除最旧的文件
+    - 同一派生图片同时只渲染一次: 进程内的线程等待同一个 Future, 进程之间以文件锁互斥
+    - 解码/缩放/编码在进程池中执行, 不占用请求线程的 GIL
+
+Pillow 为可选依赖, 未安装时忽略这些参数并返回原图
+"""
+import fcntl
+import hashlib
+import importlib.util
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from flask import current_app
+from .img_utils import ImageEntry
+from .img_pack import image_source, source_file
+from ..metrics import CACHE_REQUESTS
+
+# Pillow 和进程池导入较慢, 只检查是否安装, 第一次渲染时才导入
+HAS_PILLOW = importlib.util.find_spec("PIL") is not None
+
+
+logger = logging.getLogger(__name__)
+
+# fmt 参数: (Pillow 格式名, 扩展名)
+FORMATS = {
+    "jpeg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+    "avif": ("AVIF", "avif"),
+    "png": ("PNG", "png"),
+}
+# 未指定 fmt 时沿用原图格式, 无法直接编码的格式转为 png
+SOURCE_FORMATS = {"jpg": "jpeg", "jpeg": "jpeg", "webp": "webp", "png": "png", "avif": "avif"}
+
+# 命中缓存时最多每隔多久更新一次访问时间（秒）
+TOUCH_INTERVAL = 60
+# 等待渲染结果的最长时间（秒）, 小于 gunicorn 的 timeout
+RENDER_TIMEOUT = 25
+# 渲染锁所在的子目录: 按缓存路径的前两位十六进制分为 256 个固定的锁文件, 不为每个派生图片创建锁文件
+LOCK_DIR = "locks"
+
+
+class DerivativeSpec(namedtuple("DerivativeSpec", ["width", "height", "fmt", "quality"])):
+    """
+    派生图片参数, width/height 为 None 表示该方向不限制, fmt 为 None 表示沿用原图格式
+    """
+
+    __slots__ = ()
+
+    def resolve(self, filename):
+        if self.fmt is not None:
+            return self
+        ext = filename.rsplit(".", 1)[-1].lower()
+        return self._replace(fmt=SOURCE_FORMATS.get(ext, "png"))
+
+
+def parse_spec(args, max_dimension, default_quality):
+    """
+    解析请求参数
+
+    Returns:
+        DerivativeSpec: 没有任何派生参数时返回 None
+
+    Raises:
+        ValueError: 参数无效
+    """
+    if not any(name in args for name in ("w", "h", "fmt", "q")):
+        return None
+
+    def integer(name, default, maximum):
+        value = args.get(name)
+        if not value:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError(f"Invalid {name}") from None
+        if not 0 < value <= maximum:
+            raise ValueError(f"Invalid {name}")
+        return value
+
+    fmt = args.get("fmt") or None
+    if fmt is not None:
+        fmt = fmt.lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt not in FORMATS:
+            raise ValueError(f"Invalid fmt '{fmt}'")
+
+    return DerivativeSpec(
+        integer("w", None, max_dimension),
+        integer("h", None, max_dimension),
+        fmt,
+        integer("q", default_quality, 100),
+    )
+
+
+def render_derivative(src, dest_path, width, height, fmt, quality):
+    """
+    在进程池中执行: 解码原图, 等比缩放到不超过 width x height (不放大), 编码后原子写入
+
+    Args:
+        src: 原图, 见 img_pack.image_source()
+
+    Returns:
+        tuple: (字节数, 宽, 高)
+    """
+    from PIL import Image, ImageOps
+
+    pil_format = FORMATS[fmt][0]
+    with Image.open(source_file(src)) as im:
+        if width or height:
+            # JPEG 在解码时直接按 1/2、1/4、1/8 缩小, 大幅减少解码量
+            longest = max(width or 0, height or 0)
+            im.draft("RGB", (longest, longest))
+        im = ImageOps.exif_transpose(im)
+        if width or height:
+            im.thumbnail((width or im.width, height or im.height), Image.Resampling.LANCZOS)
+
+        if pil_format == "JPEG":
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+        elif im.mode not in ("RGB", "RGBA", "L", "LA"):
+            im = im.convert("RGBA")
+
+        options = {}
+        if pil_format in ("JPEG", "WEBP", "AVIF"):
+            options["quality"] = quality
+        if pil_format in ("JPEG", "PNG"):
+            options["optimize"] = True
+        if pil_format == "JPEG":
+            options["progressive"] = True
+
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        try:
+            im.save(tmp_path, format=pil_format, **options)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        width, height = im.size
+    return os.path.getsize(dest_path), width, height
+
+
+class ImageDeriver:
+    """
+    派生图片的磁盘缓存
+
+    Args:
+        cache_dir (str): 缓存目录, 多个工作进程共用
+        max_bytes (int): 缓存总大小上限
+        workers (int): 每个工作进程的渲染进程数
+    """
+
+    def __init__(self, cache_dir, max_bytes, workers=2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        # 上次清理之后本进程写入的字节数
+        self._written = 0
+        self._evicting = False
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def executor(self):
+        # 进程池在 fork 之后的工作进程中创建; forkserver 避免复制带线程的工作进程
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def path_for(self, entry, spec):
+        """
+        派生图片的缓存路径, 由原图 ETag 与参数决定
+        """
+        digest = hashlib.blake2b(
+            f"{entry.etag}|{spec.width}|{spec.height}|{spec.fmt}|{spec.quality}".encode(),
+            digest_size=16,
+        ).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest[2:]}.{FORMATS[spec.fmt][1]}")
+
+    def get(self, entry, spec):
+        """
+        返回派生图片的索引记录, 渲染失败时返回 None
+
+        Args:
+            entry (ImageEntry): 原图
+            spec (DerivativeSpec): 派生参数
+        """
+        spec = spec.resolve(entry.filename)
+        path = self.path_for(entry, spec)
+        st = self._stat(path)
+        if st is not None:
+            CACHE_REQUESTS.inc("derived", "hit")
+            return self._entry(entry, spec, path, st)
+        CACHE_REQUESTS.inc("derived", "miss")
+
+        with self._lock:
+            future = self._pending.get(path)
+            owner = future is None
+            if owner:
+                future = self._pending[path] = Future()
+        if not owner:
+            st = future.result()
+            return None if st is None else self._entry(entry, spec, path, st)
+
+        st = None
+        try:
+            st = self._render(image_source(entry), path, spec)
+        except Exception:
+            logger.exception("Failed to render %s for %s", spec, entry.path)
+        finally:
+            future.set_result(st)
+            with self._lock:
+                self._pending.pop(path, None)
+        return None if st is None else self._entry(entry, spec, path, st)
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        now = time.time()
+        if now - st.st_atime > TOUCH_INTERVAL:
+            # 只更新访问时间, 修改时间参与 ETag, 不能改变
+            try:
+                os.utime(path, (now, st.st_mtime))
+            except OSError:
+                pass
+        return st
+
+    def _entry(self, entry, spec, path, st):
+        stem = entry.filename.rsplit(".", 1)[0]
+        return ImageEntry(
+            entry.img_type, entry.orientation, f"{stem}.{FORMATS[spec.fmt][1]}",
+            path, st.st_size, st.st_mtime, st.st_ino,
+        )
+
+    def _lock_path(self, path):
+        # 缓存路径的上一级目录名为摘要的前两位, 共 256 个锁文件; 不同图片偶尔共用一个锁, 只是串行渲染
+        lock_dir = os.path.join(self.cache_dir, LOCK_DIR)
+        os.makedirs(lock_dir, exist_ok=True)
+        return os.path.join(lock_dir, os.path.basename(os.path.dirname(path)))
+
+    def _render(self, src, path, spec):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(self._lock_path(path), os.O_RDWR | os.O_CREAT, 0o644)
+
+        def unlock(_=None):
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+        locked = True
+        try:
+            # 其他工作进程正在渲染同一文件时在这里等待, 之后直接使用其结果
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            st = self._stat(path)
+            if st is not None:
+                return st
+            future = self.executor.submit(render_derivative, src, path, *spec)
+            try:
+                size = future.result(timeout=RENDER_TIMEOUT)[0]
+            except TimeoutError:
+                # 渲染仍在进程池中进行, 完成后才释放锁, 其他进程不会重复渲染同一文件
+                locked = False
+                future.add_done_callback(unlock)
+                raise
+        finally:
+            if locked:
+                unlock()
+
+        with self._lock:
+            self._written += size
+            evict = self._written > self.max_bytes // 10
+            if evict:
+                self._written = 0
+        if evict:
+            self._schedule_evict()
+        return os.stat(path)
+
+    def _schedule_evict(self):
+        with self._lock:
+            if self._evicting:
+                return
+            self._evicting = True
+        threading.Thread(target=self.evict, name="derived-evict", daemon=True).start()
+
+    def evict(self):
+        """
+        缓存超过上限时, 按访问时间删除最旧的文件, 直到不超过上限的 90%
+        """
+        try:
+            files = []
+            total = 0
+            for sub in os.scandir(self.cache_dir):
+                if not sub.is_dir() or sub.name == LOCK_DIR:
+                    continue
+                for item in os.scandir(sub.path):
+                    if item.name.endswith(".lock"):
+                        # 旧版本为每个派生图片创建的锁文件
+                        try:
+                            os.remove(item.path)
+                        except OSError:
+                            pass
+                        continue
+                    if item.name.endswith(".tmp"):
+                        continue
+                    try:
+                        st = item.stat()
+                    except OSError:
+                        continue
+                    files.append((st.st_atime, st.st_size, item.path))
+                    total += st.st_size
+            if total <= self.max_bytes:
+                return 0
+            removed = 0
+            target = self.max_bytes * 9 // 10
+            for _, size, path in sorted(files):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            return removed
+        finally:
+            self._evicting = False
+
+
+def init_deriver(app, cache_dir, max_bytes, workers=2):
+    """
+    创建派生图片缓存并挂载到 app.extensions, 未安装 Pillow 或容量为 0 时不启用
+    """
+    deriver = None
+    if HAS_PILLOW and max_bytes > 0:
+        deriver = ImageDeriver(cache_dir, max_bytes, workers)
+    app.extensions["image_deriver"] = deriver
+    return deriver
+
+
+def get_deriver():
+    return current_app.extensions.get("image_deriver")
+
+
+def derive_image(entry, spec):
+    """
+    返回派生图片的索引记录; 未启用派生时返回原图
+
+    Returns:
+        ImageEntry: 渲染失败时返回 None, 由调用方返回错误, 而不是用其他格式的原图代替
+    """
+    deriver = get_deriver()
+    if deriver is None or spec is None:
+        return entry
+    return deriver.get(entry, spec)
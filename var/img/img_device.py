@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+根据客户端设备推断默认的图片方向 (请求未指定 ?orientation= 时使用)
+
+依次检查, 先得到结果的为准:
+
+    - ?screen=<宽>x<高>                            客户端自行提供的屏幕尺寸
+    - Sec-CH-Viewport-Width / Sec-CH-Viewport-Height  客户端提示中的视口尺寸
+    - Sec-CH-UA-Mobile                             ?1 为移动设备 (竖屏), ?0 为桌面设备 (横屏)
+    - User-Agent                                   关键词匹配, 结果按 UA 字符串缓存
+
+都无法判断时返回 None, 由调用方随机选择方向
+"""
+import re
+from functools import lru_cache
+from flask import abort, after_this_request, request
+
+
+# 请求浏览器在之后的请求中发送视口尺寸
+ACCEPT_CH = "Sec-CH-UA-Mobile, Sec-CH-Viewport-Width, Sec-CH-Viewport-Height"
+# 缓存的不同 UA 数量
+UA_CACHE_SIZE = 4096
+# 只匹配 UA 的前若干字符, 避免超长 UA 占用缓存
+MAX_UA_LENGTH = 512
+
+# 第一组为移动设备关键词, 其余为桌面设备关键词; 出现任一移动设备关键词即判断为移动设备
+_UA_PATTERN = re.compile(r"(iphone|ipad|symbian|mobile|android)|macos|windows", re.IGNORECASE)
+
+
+@lru_cache(maxsize=UA_CACHE_SIZE)
+def classify_user_agent(user_agent):
+    """
+    Returns:
+        str: 移动设备返回 "vertical", 桌面设备返回 "horizontal", 无法判断时返回 None
+    """
+    desktop = False
+    for match in _UA_PATTERN.finditer(user_agent):
+        if match.group(1):
+            return "vertical"
+        desktop = True
+    return "horizontal" if desktop else None
+
+
+def _by_size(width, height):
+    if width > height:
+        return "horizontal"
+    if height > width:
+        return "vertical"
+    return None
+
+
+def _screen_orientation(value):
+    width, sep, height = value.lower().partition("x")
+    try:
+        width, height = int(width), int(height)
+    except ValueError:
+        width = height = 0
+    if not sep or width <= 0 or height <= 0:
+        abort(400, description="Invalid screen")
+    return _by_size(width, height)
+
+
+def _viewport_orientation(headers):
+    width = headers.get("Sec-CH-Viewport-Width")
+    height = headers.get("Sec-CH-Viewport-Height")
+    if not width or not height:
+        return None
+    try:
+        width, height = float(width), float(height)
+    except ValueError:
+        return None
+    if width <= 0 or height <= 0:
+        return None
+    return _by_size(width, height)
+
+
+def _accept_client_hints(response):
+    response.headers["Accept-CH"] = ACCEPT_CH
+    return response
+
+
+def request_orientation():
+    """
+    当前请求的图片方向: ?orientation= 参数, 未指定时按客户端设备推断
+
+    Returns:
+        str: "horizontal" / "vertical" / 参数原值, 无法判断时返回 None
+    """
+    orientation = request.args.get("orientation")
+    if orientation:
+        return orientation
+    after_this_request(_accept_client_hints)
+
+    screen = request.args.get("screen")
+    if screen:
+        orientation = _screen_orientation(screen)
+        if orientation:
+            return orientation
+
+    headers = request.headers
+    orientation = _viewport_orientation(headers)
+    if orientation:
+        return orientation
+
+    mobile = headers.get("Sec-CH-UA-Mobile")
+    if mobile == "?1":
+        return "vertical"
+    if mobile == "?0":
+        return "horizontal"
+
+    return classify_user_agent(headers.get("User-Agent", "")[:MAX_UA_LENGTH])
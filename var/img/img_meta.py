@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+"""
+图片元数据索引: 宽、高、格式、宽高比和主色调
+
+只读取图片文件头 (Pillow 的 Image.open 不解码像素), 按 EXIF 方向换算为显示尺寸;
+主色调需要解码, JPEG 以 draft 模式按 1/8 解码后缩小取色, 默认关闭, 可以用
+`python start.py --index-metadata` 以全部 CPU 核心离线生成
+
+结果按 类型/方向/文件名 保存在紧凑的二进制索引文件中, 以 inode、大小、修改时间校验,
+重启后只处理新增或修改的图片; 图片索引变化后各进程在后台线程中只补齐变化的图片,
+请求不等待 (见 img_sync)
+
+Pillow 为可选依赖, 未安装时不提供元数据
+"""
+import importlib.util
+import os
+import random
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from flask import current_app
+from .img_utils import ORIENTATIONS
+from .img_pack import image_source, source_file
+from .img_sync import BackgroundUpdater, IndexFollower, changed_types, iter_changed, lead
+
+# Pillow 导入较慢, 只检查是否安装, 第一次读取图片时才导入
+HAS_PILLOW = importlib.util.find_spec("PIL") is not None
+
+
+MAGIC = b"HCRBMETA"
+VERSION = 1
+_HEADER = struct.Struct("<8sII")
+# inode, size, mtime, width, height, 格式编号, 是否有主色调, r, g, b, 路径长度
+_RECORD = struct.Struct("<QQdIIBBBBBH")
+
+# 格式编号, 0 表示未知
+FORMAT_CODES = ("", "jpeg", "png", "gif", "webp", "avif", "bmp", "tiff", "mpo")
+# EXIF 方向为 5~8 时图片需要旋转 90 度显示
+_ROTATED = (5, 6, 7, 8)
+_EXIF_ORIENTATION = 0x0112
+
+
+class ImageMeta(namedtuple("ImageMeta", ["width", "height", "format", "color"])):
+    """
+    单张图片的元数据, width/height 为按 EXIF 方向旋转后的显示尺寸, color 为 (r, g, b) 或 None
+    """
+
+    __slots__ = ()
+
+    @property
+    def aspect(self):
+        return round(self.width / self.height, 4) if self.height else 0.0
+
+    @property
+    def orientation(self):
+        """
+        按显示尺寸判断的方向, 正方形视为横屏
+        """
+        return "horizontal" if self.width >= self.height else "vertical"
+
+    def to_json(self):
+        return {
+            "width": self.width,
+            "height": self.height,
+            "format": self.format,
+            "aspect": self.aspect,
+            "color": "#%02x%02x%02x" % self.color if self.color else None,
+            "detected_orientation": self.orientation,
+        }
+
+
+def _dominant_color(im):
+    """
+    缩小到 32x32 后聚为 4 种颜色, 取像素最多的一种
+    """
+    im.draft("RGB", (64, 64))
+    small = im.convert("RGB")
+    small.thumbnail((32, 32))
+    quantized = small.quantize(colors=4)
+    palette = quantized.getpalette()
+    _, index = max(quantized.getcolors())
+    return tuple(palette[index * 3:index * 3 + 3])
+
+
+def read_metadata(src, dominant_color=False):
+    """
+    读取一张图片的元数据, 无法识别时返回 None
+
+    Args:
+        src: 图片路径, 或 img_pack.image_source() 返回的包内位置
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(source_file(src)) as im:
+            width, height = im.size
+            fmt = (im.format or "").lower()
+            try:
+                exif_orientation = im.getexif().get(_EXIF_ORIENTATION, 1)
+            except Exception:
+                exif_orientation = 1
+            if exif_orientation in _ROTATED:
+                width, height = height, width
+            color = _dominant_color(im) if dominant_color else None
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return ImageMeta(width, height, fmt if fmt in FORMAT_CODES else "", color)
+
+
+def _read_job(job):
+    # 进程池中执行
+    src, dominant_color = job
+    return read_metadata(src, dominant_color)
+
+
+# aspect 筛选允许的相对误差
+ASPECT_TOLERANCE = 0.02
+# 筛选时先在最小的候选范围内随机抽取并检查其余条件, 抽取失败后才逐个检查该范围
+_SAMPLE_ATTEMPTS = 32
+
+
+class ImageFilter(namedtuple("ImageFilter", ["min_width", "max_bytes", "aspect", "format"])):
+    """
+    随机图片的筛选条件, 未指定的为 None
+    """
+
+    __slots__ = ()
+
+
+def parse_filters(args):
+    """
+    解析 ?min_width= ?max_bytes= ?aspect= ?format= 参数, aspect 可写作 16:9 或 1.78
+
+    Returns:
+        ImageFilter: 没有筛选参数时返回 None
+
+    Raises:
+        ValueError: 参数无效
+    """
+    if not any(args.get(name) for name in ImageFilter._fields):
+        return None
+
+    def positive(name, parse):
+        value = args.get(name)
+        if not value:
+            return None
+        try:
+            value = parse(value)
+        except ValueError:
+            raise ValueError(f"Invalid {name}") from None
+        if not value > 0:
+            raise ValueError(f"Invalid {name}")
+        return value
+
+    def ratio(value):
+        if ":" in value:
+            width, height = value.split(":", 1)
+            return float(width) / float(height) if float(height) else 0.0
+        return float(value)
+
+    fmt = args.get("format") or None
+    if fmt is not None:
+        fmt = fmt.lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt not in FORMAT_CODES[1:]:
+            raise ValueError(f"Invalid format '{fmt}'")
+    return ImageFilter(
+        positive("min_width", int), positive("max_bytes", int), positive("aspect", ratio), fmt
+    )
+
+
+class _FilterIndex:
+    """
+    单个类型的筛选索引
+
+    宽度、大小、宽高比各有一个按值排序的位置列表, 条件对应其中一段连续范围 (二分查找);
+    格式和方向按值分组. 筛选时选出最小的一段, 在其中随机抽取并检查其余条件
+    """
+
+    __slots__ = (
+        "items", "widths", "sizes", "aspects", "formats", "detected",
+        "by_width", "sorted_widths", "by_size", "sorted_sizes", "by_aspect", "sorted_aspects",
+        "by_format", "by_folder", "by_detected",
+    )
+
+    def __init__(self, rows):
+        """
+        Args:
+            rows (list): [(目录方向, filename, size, ImageMeta), ...]
+        """
+        self.items = [(folder, filename) for folder, filename, _, _ in rows]
+        self.widths = array("I", (meta.width for _, _, _, meta in rows))
+        self.sizes = array("Q", (size for _, _, size, _ in rows))
+        self.aspects = array("d", (meta.aspect for _, _, _, meta in rows))
+        self.formats = [meta.format for _, _, _, meta in rows]
+        self.detected = [meta.orientation for _, _, _, meta in rows]
+
+        positions = range(len(rows))
+        self.by_width = array("I", sorted(positions, key=self.widths.__getitem__))
+        self.sorted_widths = array("I", (self.widths[p] for p in self.by_width))
+        self.by_size = array("I", sorted(positions, key=self.sizes.__getitem__))
+        self.sorted_sizes = array("Q", (self.sizes[p] for p in self.by_size))
+        self.by_aspect = array("I", sorted(positions, key=self.aspects.__getitem__))
+        self.sorted_aspects = array("d", (self.aspects[p] for p in self.by_aspect))
+
+        self.by_format = {}
+        self.by_folder = {o: array("I") for o in ORIENTATIONS}
+        self.by_detected = {o: array("I") for o in ORIENTATIONS}
+        for p, (folder, _, _, meta) in enumerate(rows):
+            self.by_format.setdefault(meta.format, array("I")).append(p)
+            self.by_folder[folder].append(p)
+            self.by_detected[meta.orientation].append(p)
+
+    def sample(self, filters, orientation=None, detected=False, k=1):
+        """
+        不放回地随机选择至多 k 张符合条件的图片
+
+        Args:
+            filters (ImageFilter): 筛选条件, 可以为 None
+            orientation (str): 方向
+            detected (bool): 方向按实际宽高判断, 否则按所在目录
+            k (int): 数量
+
+        Returns:
+            list: [(目录方向, filename), ...]
+        """
+        filters = filters or ImageFilter(None, None, None, None)
+        # (位置列表, 起, 止)
+        ranges = [(self.by_width, 0, len(self.by_width))]
+        if filters.min_width:
+            start = bisect_left(self.sorted_widths, filters.min_width)
+            ranges.append((self.by_width, start, len(self.by_width)))
+        if filters.max_bytes:
+            ranges.append((self.by_size, 0, bisect_right(self.sorted_sizes, filters.max_bytes)))
+        if filters.aspect:
+            low = filters.aspect * (1 - ASPECT_TOLERANCE)
+            high = filters.aspect * (1 + ASPECT_TOLERANCE)
+            ranges.append((
+                self.by_aspect,
+                bisect_left(self.sorted_aspects, low),
+                bisect_right(self.sorted_aspects, high),
+            ))
+        if filters.format:
+            group = self.by_format.get(filters.format, ())
+            ranges.append((group, 0, len(group)))
+        if orientation:
+            group = (self.by_detected if detected else self.by_folder).get(orientation, ())
+            ranges.append((group, 0, len(group)))
+
+        positions, start, stop = min(ranges, key=lambda r: r[2] - r[1])
+        if start >= stop:
+            return []
+
+        def matches(p):
+            return (
+                (not filters.min_width or self.widths[p] >= filters.min_width)
+                and (not filters.max_bytes or self.sizes[p] <= filters.max_bytes)
+                and (not filters.aspect or abs(self.aspects[p] - filters.aspect) <= filters.aspect * ASPECT_TOLERANCE)
+                and (not filters.format or self.formats[p] == filters.format)
+                and (not orientation or (
+                    self.detected[p] if detected else self.items[p][0]
+                ) == orientation)
+            )
+
+        chosen = {}
+        for _ in range(_SAMPLE_ATTEMPTS * k):
+            if len(chosen) >= k:
+                break
+            p = positions[random.randrange(start, stop)]
+            if p not in chosen and matches(p):
+                chosen[p] = None
+        if len(chosen) < k:
+            candidates = [p for p in positions[start:stop] if matches(p)]
+            chosen = random.sample(candidates, min(k, len(candidates)))
+        return [self.items[p] for p in chosen]
+
+
+def _filter_rows(type_records):
+    rows = []
+    for key, ((_, size, _), meta) in type_records.items():
+        _, folder, filename = key.split("/", 2)
+        rows.append((folder, filename, size, meta))
+    return rows
+
+
+def _stat_key(entry):
+    return entry.inode, entry.size, entry.mtime
+
+
+class ImageMetadataIndex:
+    """
+    {img_type: {类型/方向/文件名: ((inode, size, mtime), ImageMeta)}}
+
+    请求只读取最近一次发布的结果 (records/filters 整体替换), 与图片索引的对齐在后台线程中进行
+
+    Args:
+        path (str): 索引文件路径
+        dominant_color (bool): 是否计算主色调
+    """
+
+    def __init__(self, path, dominant_color=False):
+        self.path = path
+        self.dominant_color = dominant_color
+        self.records = {}
+        # {img_type: _FilterIndex}
+        self.filters = {}
+        # 已对齐的图片索引版本, None 表示尚未完成第一次对齐
+        self.generation = None
+        # 已对齐的 {img_type: 类型版本}
+        self.type_generations = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._updater = BackgroundUpdater(self.update, "image-metadata")
+        # 工作进程中跟随主进程保存的索引文件, 不自行对齐
+        self._follower = None
+
+    def __len__(self):
+        return sum(len(type_records) for type_records in self.records.values())
+
+    @property
+    def ready(self):
+        if self._follower is not None:
+            return self._follower.stamp is not None
+        return self.generation is not None
+
+    def lead(self, catalog, watcher):
+        """
+        gunicorn when_ready 中调用: 由主进程在目录变化后对齐并保存索引文件
+        """
+        lead(self._updater, catalog, watcher)
+
+    def follow(self):
+        """
+        gunicorn post_fork 中调用: 不再自行对齐, 只在主进程保存的索引文件变化后重新读取
+        """
+        # fork 时主进程的后台线程可能持有锁
+        self._lock = threading.Lock()
+        self._follower = IndexFollower(self.path, self.reload, "image-metadata")
+
+    def reload(self):
+        """
+        重新读取索引文件, 只重建记录有变化的类型的筛选索引
+        """
+        with self._lock:
+            previous = self.records
+            self.load()
+            filters = {}
+            for img_type, type_records in self.records.items():
+                index = self.filters.get(img_type)
+                if index is None or previous.get(img_type) != type_records:
+                    index = _FilterIndex(_filter_rows(type_records))
+                filters[img_type] = index
+            self.filters = filters
+
+    def load(self):
+        """
+        读取索引文件, 文件不存在或格式不同时从空索引开始
+        """
+        records = {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            magic, version, count = _HEADER.unpack_from(data, 0)
+            if magic == MAGIC and version == VERSION:
+                offset = _HEADER.size
+                for _ in range(count):
+                    (inode, size, mtime, width, height, fmt, has_color,
+                     r, g, b, name_len) = _RECORD.unpack_from(data, offset)
+                    offset += _RECORD.size
+                    key = os.fsdecode(data[offset:offset + name_len])
+                    offset += name_len
+                    meta = ImageMeta(width, height, FORMAT_CODES[fmt], (r, g, b) if has_color else None)
+                    records.setdefault(key.split("/", 1)[0], {})[key] = ((inode, size, mtime), meta)
+        except (OSError, struct.error, UnicodeDecodeError, IndexError):
+            pass
+        self.records = records
+        self._loaded = True
+        return self
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        parts = [_HEADER.pack(MAGIC, VERSION, len(self))]
+        for type_records in self.records.values():
+            for key, ((inode, size, mtime), meta) in type_records.items():
+                name = os.fsencode(key)
+                r, g, b = meta.color or (0, 0, 0)
+                parts.append(_RECORD.pack(
+                    inode, size, mtime, meta.width, meta.height, FORMAT_CODES.index(meta.format),
+                    meta.color is not None, r, g, b, len(name),
+                ))
+                parts.append(name)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(parts))
+        os.replace(tmp_path, self.path)
+
+    def _is_current(self, record, entry):
+        if record is None or record[0] != _stat_key(entry):
+            return False
+        return not self.dominant_color or record[1].color is not None
+
+    def update(self, catalog, workers=None):
+        """
+        与图片索引对齐: 只检查上次对齐之后变化的图片, 补齐新增或修改的, 删除已不存在的记录,
+        只重建变化类型的筛选索引
+
+        Args:
+            catalog (ImageCatalog): 图片索引
+            workers (int): 大于 1 时以进程池并行读取
+
+        Returns:
+            int: 新读取的图片数量
+        """
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            generation = catalog.generation
+            if generation == self.generation:
+                return 0
+            type_generations = {t: catalog.type_generation(t) for t in catalog.types}
+            changed = changed_types(catalog, self.generation, self.type_generations, self.records)
+
+            # 只复制变化的类型, 其余类型的记录继续共用
+            records = dict(self.records)
+            entries = {}
+            missing = []
+            removed = 0
+            for img_type, names in changed.items():
+                type_records = dict(records.get(img_type, ()))
+                for key, entry in iter_changed(catalog, img_type, names, type_records):
+                    if entry is None:
+                        removed += type_records.pop(key, None) is not None
+                    elif not self._is_current(type_records.get(key), entry):
+                        entries[key] = entry
+                        missing.append(key)
+                records[img_type] = type_records
+
+            jobs = [(image_source(entries[key]), self.dominant_color) for key in missing]
+            if workers and workers > 1 and len(jobs) > 1:
+                from concurrent.futures import ProcessPoolExecutor
+
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(_read_job, jobs, chunksize=64))
+            else:
+                results = [_read_job(job) for job in jobs]
+
+            for key, meta in zip(missing, results):
+                type_records = records[key.split("/", 1)[0]]
+                if meta is None:
+                    removed += type_records.pop(key, None) is not None
+                else:
+                    type_records[key] = (_stat_key(entries[key]), meta)
+            for img_type in changed:
+                if not records[img_type]:
+                    del records[img_type]
+
+            filters = dict(self.filters)
+            for img_type in changed:
+                if img_type in records:
+                    filters[img_type] = _FilterIndex(_filter_rows(records[img_type]))
+                else:
+                    filters.pop(img_type, None)
+
+            self.records = records
+            self.filters = filters
+            self.type_generations = type_generations
+            self.generation = generation
+        if missing or removed:
+            try:
+                self.save()
+            except OSError:
+                pass
+        return len(missing)
+
+    def refresh(self, catalog):
+        """
+        图片索引变化后在后台线程中对齐, 不等待结果; 在此之前继续使用上一次的结果
+        """
+        if self._follower is not None:
+            self._follower.check()
+        elif catalog.generation != self.generation:
+            self._updater.request(catalog)
+
+    def get(self, img_type, orientation, filename):
+        """
+        返回 ImageMeta, 没有记录时返回 None
+        """
+        record = self.records.get(img_type, {}).get(f"{img_type}/{orientation}/{filename}")
+        return None if record is None else record[1]
+
+    def sample(self, catalog, img_type, orientation=None, filters=None, detected=False, k=1):
+        """
+        按筛选条件不放回地随机选择至多 k 张图片
+
+        Args:
+            catalog (ImageCatalog): 图片索引
+            orientation (str): 方向, 为 None 时不限
+            filters (ImageFilter): 筛选条件
+            detected (bool): 方向按实际宽高判断, 而不是按所在目录
+            k (int): 数量
+
+        Returns:
+            list: [ImageEntry, ...]
+        """
+        index = self.filters.get(img_type)
+        if index is None:
+            return []
+        entries = (catalog.lookup(img_type, *item) for item in index.sample(filters, orientation, detected, k))
+        # 与增量删除并发时个别记录可能已不存在
+        return [entry for entry in entries if entry is not None]
+
+    def pick(self, catalog, img_type, orientation=None, filters=None, detected=False):
+        """
+        按筛选条件随机选择一张图片, 没有符合的图片时返回 None
+        """
+        entries = self.sample(catalog, img_type, orientation, filters, detected, 1)
+        return entries[0] if entries else None
+
+
+def build_metadata(catalog, path, dominant_color=False, workers=None):
+    """
+    以进程池为全部图片生成元数据索引
+
+    Returns:
+        tuple: (ImageMetadataIndex, 新读取的图片数量)
+    """
+    index = ImageMetadataIndex(path, dominant_color).load()
+    count = index.update(catalog, workers or os.cpu_count())
+    return index, count
+
+
+def init_metadata(app, path, dominant_color=False):
+    """
+    创建元数据索引, 未安装 Pillow 时不启用; 索引文件在第一次使用时由后台线程读取并补齐缺少的图片,
+    不计入启动时间
+    """
+    index = None
+    if HAS_PILLOW:
+        index = ImageMetadataIndex(path, dominant_color)
+    app.extensions["image_metadata"] = index
+    return index
+
+
+def get_metadata_index(catalog=None):
+    """
+    返回元数据索引, 未启用时返回 None; 指定 catalog 时若图片索引已变化, 在后台开始对齐,
+    本次请求仍使用上一次的结果
+    """
+    index = current_app.extensions.get("image_metadata")
+    if index is not None and catalog is not None:
+        index.refresh(catalog)
+    return index
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+打包存储: 每个 类型/方向 一个只追加的包文件, 代替目录中的大量小文件
+
+    usr/img/<type>/<orientation>.pack       文件头之后依次为 (记录头, 文件名, 图片内容)
+    usr/img/<type>/<orientation>.pack.idx   包内各图片的 (偏移, 长度, 修改时间, 文件名)
+
+索引文件记录生成时包文件的长度, 包文件之后追加的部分按记录头补齐; 索引文件缺失或损坏时
+从头扫描包文件. 同名图片以最后追加的为准, 方向目录中的同名文件优先于包内的图片
+
+包内图片在图片索引中与普通文件一样按 类型/方向/文件名 访问, 其 inode 字段为
+PACKED_FLAG | 图片内容在包文件中的偏移; 包文件只追加不改写, 偏移在包文件存在期间
+一直有效, 发送时直接把包文件定位到该偏移交给 sendfile
+
+`python start.py --pack` 把方向目录中的新增或修改的图片追加到包文件,
+`python start.py --unpack` 把包文件还原为目录
+"""
+import fcntl
+import io
+import os
+import struct
+
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".pack.idx"
+# 图片索引中包内图片的 inode 标记, 低位为偏移
+PACKED_FLAG = 1 << 63
+_OFFSET_MASK = PACKED_FLAG - 1
+
+MAGIC = b"HCRBPACK"
+INDEX_MAGIC = b"HCRBPIDX"
+VERSION = 1
+_PACK_HEADER = struct.Struct("<8sI")
+# 文件名长度, 内容长度, 修改时间
+_ENTRY = struct.Struct("<HQd")
+# 包文件 inode, 已索引的包文件长度, 记录数
+_INDEX_HEADER = struct.Struct("<8sIQQI")
+# 内容偏移, 内容长度, 修改时间, 文件名长度
+_INDEX_RECORD = struct.Struct("<QQdH")
+
+_ORIENTATIONS = ("horizontal", "vertical")
+
+
+def pack_path(type_path, orientation):
+    return os.path.join(type_path, orientation + PACK_SUFFIX)
+
+
+def _index_path(path):
+    return path[:-len(PACK_SUFFIX)] + INDEX_SUFFIX
+
+
+def pack_orientation(name):
+    """
+    类型目录中的包文件/包索引文件名对应的方向, 其他文件返回 None
+    """
+    for suffix in (PACK_SUFFIX, INDEX_SUFFIX):
+        if name.endswith(suffix) and name[:-len(suffix)] in _ORIENTATIONS:
+            return name[:-len(suffix)]
+    return None
+
+
+def is_valid_name(name):
+    """
+    包内记录的文件名必须是单个目录项: 不含路径分隔符, 不为空、"." 或 ".."
+    (损坏或伪造的包文件不能借此写出或引用方向目录之外的路径)
+    """
+    return (
+        name not in ("", ".", "..")
+        and "/" not in name
+        and "\0" not in name
+        and (os.altsep is None or os.altsep not in name)
+    )
+
+
+def is_packed(entry):
+    return entry.inode & PACKED_FLAG != 0
+
+
+def packed_location(entry):
+    """
+    Returns:
+        tuple: (包文件路径, 内容偏移), entry 不在包文件中时返回 None
+    """
+    if not entry.inode & PACKED_FLAG:
+        return None
+    return os.path.dirname(entry.path) + PACK_SUFFIX, entry.inode & _OFFSET_MASK
+
+
+def _scan(f, offset, end, records):
+    """
+    从 offset 开始读取记录头, 补齐 records; 末尾写入未完成的记录忽略
+
+    Returns:
+        int: 最后一条完整记录之后的偏移
+    """
+    while offset + _ENTRY.size <= end:
+        f.seek(offset)
+        header = f.read(_ENTRY.size)
+        if len(header) < _ENTRY.size:
+            break
+        name_len, length, mtime = _ENTRY.unpack(header)
+        data_offset = offset + _ENTRY.size + name_len
+        if data_offset + length > end:
+            break
+        name = f.read(name_len).decode("utf-8", "surrogateescape")
+        records[name] = (data_offset, length, mtime)
+        offset = data_offset + length
+    return offset
+
+
+def _load_index(path, st):
+    """
+    读取与包文件 st 对应的索引文件
+
+    Returns:
+        tuple: ({filename: (offset, length, mtime)}, 已索引的长度), 无效时返回 (None, 0)
+    """
+    try:
+        with open(_index_path(path), "rb") as f:
+            data = f.read()
+        magic, version, inode, covered, count = _INDEX_HEADER.unpack_from(data, 0)
+        if magic != INDEX_MAGIC or version != VERSION or inode != st.st_ino or covered > st.st_size:
+            return None, 0
+        records = {}
+        offset = _INDEX_HEADER.size
+        for _ in range(count):
+            data_offset, length, mtime, name_len = _INDEX_RECORD.unpack_from(data, offset)
+            offset += _INDEX_RECORD.size
+            name = data[offset:offset + name_len].decode("utf-8", "surrogateescape")
+            offset += name_len
+            records[name] = (data_offset, length, mtime)
+        return records, covered
+    except (OSError, struct.error, UnicodeDecodeError):
+        return None, 0
+
+
+def _write_index(path, inode, covered, records):
+    parts = [_INDEX_HEADER.pack(INDEX_MAGIC, VERSION, inode, covered, len(records))]
+    for name, (data_offset, length, mtime) in records.items():
+        encoded = name.encode("utf-8", "surrogateescape")
+        parts.append(_INDEX_RECORD.pack(data_offset, length, mtime, len(encoded)))
+        parts.append(encoded)
+    index_path = _index_path(path)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"".join(parts))
+    os.replace(tmp_path, index_path)
+
+
+def _read_pack(f, path):
+    """
+    Returns:
+        tuple: ({filename: (offset, length, mtime)}, 最后一条完整记录之后的偏移), 包文件无效时返回 (None, 0)
+    """
+    st = os.fstat(f.fileno())
+    records, covered = _load_index(path, st)
+    if records is None:
+        f.seek(0)
+        header = f.read(_PACK_HEADER.size)
+        if len(header) < _PACK_HEADER.size or _PACK_HEADER.unpack(header) != (MAGIC, VERSION):
+            return None, 0
+        records, covered = {}, _PACK_HEADER.size
+    if covered == st.st_size:
+        return records, covered
+    end = _scan(f, covered, st.st_size, records)
+    try:
+        _write_index(path, st.st_ino, end, records)
+    except OSError:
+        pass
+    return records, end
+
+
+def read_pack(path):
+    """
+    读取包文件中的图片列表, 索引文件过期时补齐并写回
+
+    Returns:
+        dict: {filename: (offset, length, mtime)}, 包文件不存在或无效时返回 None
+    """
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    with f:
+        return _read_pack(f, path)[0]
+
+
+def pack_stat(path):
+    """
+    包文件的 (inode, 长度, 修改时间), 用于判断是否有追加; 不存在时返回 None
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def image_source(entry):
+    """
+    传给进程池读取原图的参数: 普通文件为路径, 包内图片为 (包文件路径, 偏移, 长度)
+    """
+    location = packed_location(entry)
+    if location is None:
+        return entry.path
+    return location[0], location[1], entry.size
+
+
+def read_source(source, limit=None):
+    """
+    读取 image_source() 对应的全部内容, limit 为最多读取的字节数
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return f.read(-1 if limit is None else limit)
+    path, offset, length = source
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.pread(fd, length if limit is None else min(length, limit), offset)
+    finally:
+        os.close(fd)
+
+
+def source_file(source):
+    """
+    供 Pillow 打开的对象: 普通文件直接传路径, 包内图片读入内存
+    """
+    if isinstance(source, str):
+        return source
+    return io.BytesIO(read_source(source))
+
+
+def open_image(entry, start=0):
+    """
+    打开图片并定位到第 start 字节, 包内图片打开包文件并定位到对应偏移
+
+    Raises:
+        OSError: 文件不存在
+    """
+    location = packed_location(entry)
+    if location is None:
+        f = open(entry.path, "rb")
+        offset = start
+    else:
+        f = open(location[0], "rb")
+        offset = location[1] + start
+    if offset:
+        f.seek(offset)
+    return f
+
+
+def read_image(entry, limit=None):
+    return read_source(image_source(entry), limit)
+
+
+def pack_directory(dir_path, path, is_allowed, remove_source=False):
+    """
+    把方向目录中新增或修改 (大小/修改时间与包内记录不同) 的图片追加到包文件
+
+    Args:
+        is_allowed (callable): 按文件名判断是否为图片
+        remove_source (bool): 写入后删除目录中已在包内的图片, 目录为空时一并删除
+
+    Returns:
+        tuple: (追加数量, 删除数量)
+    """
+    names = sorted(
+        entry.name for entry in os.scandir(dir_path)
+        if entry.is_file() and is_allowed(entry.name)
+    )
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, "r+b") as f:
+        # 与其他 --pack 进程互斥, 读取方不需要加锁
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        if os.fstat(f.fileno()).st_size == 0:
+            f.write(_PACK_HEADER.pack(MAGIC, VERSION))
+            records, end = {}, _PACK_HEADER.size
+        else:
+            # 之前被中断的追加留下的不完整记录直接覆盖
+            records, end = _read_pack(f, path)
+            if records is None:
+                raise ValueError(f"Invalid pack file '{path}'")
+
+        appended = 0
+        packed = []
+        for name in names:
+            file_path = os.path.join(dir_path, name)
+            try:
+                st = os.stat(file_path)
+                with open(file_path, "rb") as src:
+                    data = src.read()
+            except OSError:
+                continue
+            if len(data) != st.st_size:
+                # 正在写入
+                continue
+            record = records.get(name)
+            if record is None or record[1] != st.st_size or record[2] != st.st_mtime:
+                encoded = name.encode("utf-8", "surrogateescape")
+                f.seek(end)
+                f.write(_ENTRY.pack(len(encoded), len(data), st.st_mtime))
+                f.write(encoded)
+                data_offset = end + _ENTRY.size + len(encoded)
+                f.write(data)
+                end = data_offset + len(data)
+                records[name] = (data_offset, len(data), st.st_mtime)
+                appended += 1
+            packed.append((file_path, st))
+
+        f.truncate(end)
+        f.flush()
+        os.fsync(f.fileno())
+        _write_index(path, os.fstat(f.fileno()).st_ino, end, records)
+
+    removed = 0
+    if remove_source:
+        for file_path, st in packed:
+            try:
+                current = os.stat(file_path)
+                if (current.st_size, current.st_mtime) == (st.st_size, st.st_mtime):
+                    os.remove(file_path)
+                    removed += 1
+            except OSError:
+                pass
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            pass
+    return appended, removed
+
+
+def unpack_directory(path, dir_path, remove_source=False):
+    """
+    把包文件中的图片还原到方向目录 (保留修改时间), 目录中已有的同名文件不覆盖,
+    文件名不是单个目录项的记录跳过
+
+    Args:
+        remove_source (bool): 全部还原后删除包文件和索引文件
+
+    Returns:
+        int: 写出的图片数量
+    """
+    records = read_pack(path)
+    if records is None:
+        raise ValueError(f"Invalid pack file '{path}'")
+    os.makedirs(dir_path, exist_ok=True)
+    written = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for name, (data_offset, length, mtime) in records.items():
+            if not is_valid_name(name):
+                continue
+            file_path = os.path.join(dir_path, name)
+            if os.path.exists(file_path):
+                continue
+            tmp_path = f"{file_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(os.pread(fd, length, data_offset))
+            os.utime(tmp_path, (mtime, mtime))
+            os.replace(tmp_path, file_path)
+            written += 1
+    finally:
+        os.close(fd)
+
+    if remove_source:
+        for file_path in (path, _index_path(path)):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+    return written
@@ -1,13 +1,36 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, jsonify, send_file, redirect, abort, current_app, request
+import json
+from itertools import islice
+from flask import Blueprint, jsonify, redirect, abort, current_app, request, stream_with_context
 from . import img_utils as utils
-from ..toml_config import STWQMC_NAME, STWQMC_VERSION
-import os
+from .img_send import send_image, RANDOM_CACHE_CONTROL
+from .img_derive import parse_spec, derive_image
+from .img_variants import get_variant_index
+from .img_meta import get_metadata_index, parse_filters
+from .img_device import request_orientation
+from .img_dedup import canonical_entry, distinct_entries
+from .img_weights import ALL_TYPES, get_selector
+from ..response_cache import cached_json
+from ..batch import batch_size
+from ..shuffle import current_bag, session_token
+from ..toml_config import STWQMC_NAME, STWQMC_VERSION, DERIVE_MAX_DIMENSION, DERIVE_DEFAULT_QUALITY
+from ..toml_config import METADATA_AUTO_ORIENTATION
 
 
 bp = Blueprint("img_routes", __name__)
 
+# /api/img/<type>/list 分页参数
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# 流式输出时每次写出的图片条数
+STREAM_BATCH = 256
+
+
+def _dumps(obj):
+    # 与 jsonify 相同的紧凑格式
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True)
+
 
 @bp.route("/api")
 def api_status():
@@ -16,42 +39,277 @@ def api_status():
 
 @bp.route("/api/img/types")
 def get_image_types_api():
-    return jsonify(
-        {"types": utils.get_image_types(), "count": len(utils.get_image_types())}
-    )
+    def build():
+        types = utils.get_image_types()
+        return {"types": types, "count": len(types)}
+
+    return cached_json("img_types", utils.get_catalog().generation, build)
 
 
 @bp.route("/api/img/count")
 def all_image_types_count():
-    count_info = utils.get_all_image_types_count()
-    return jsonify(count_info)
+    return cached_json(
+        "img_count", utils.get_catalog().generation, utils.get_all_image_types_count
+    )
+
+
+def _derivative_spec():
+    """
+    解析 ?w= ?h= ?fmt= ?q= 参数, 没有这些参数时返回 None
+    """
+    try:
+        return parse_spec(request.args, DERIVE_MAX_DIMENSION, DERIVE_DEFAULT_QUALITY)
+    except ValueError as e:
+        abort(400, description=str(e))
+
+
+def _detail_indexes():
+    """
+    返回 (预生成版本索引, 元数据索引), 未启用的为 None
+    """
+    return get_variant_index(), get_metadata_index(utils.get_catalog())
+
+
+def _add_details(item, indexes, img_type, orientation, filename, base_url, etag=None):
+    """
+    附加图片元数据 (宽、高、格式、宽高比、主色调) 和预生成版本的 variants/srcset,
+    没有记录的部分不输出
+    """
+    variant_index, meta_index = indexes
+    if meta_index is not None:
+        meta = meta_index.get(img_type, orientation, filename)
+        if meta is not None:
+            item.update(meta.to_json())
+    if variant_index:
+        variants, srcset = variant_index.describe(img_type, orientation, filename, base_url, etag)
+        if variants:
+            item["variants"] = variants
+            item["srcset"] = srcset
+    return item
+
+
+def _image_filters():
+    """
+    解析 ?min_width= ?max_bytes= ?aspect= ?format= 参数, 没有这些参数时返回 None
+    """
+    try:
+        return parse_filters(request.args)
+    except ValueError as e:
+        abort(400, description=str(e))
+
+
+def _random_images(img_type, orientation, filters=None, k=1):
+    """
+    不放回地随机选择至多 k 张图片, 开启 serve_canonical 时内容相同的图片只算一张
+
+    Returns:
+        list: [ImageEntry, ...]
+    """
+    return distinct_entries(lambda n: _draw_images(img_type, orientation, filters, n), k)
+
+
+def _draw_images(img_type, orientation, filters=None, k=1):
+    """
+    不放回地随机选择至多 k 张图片
+
+    有筛选条件时在元数据索引中按条件选择, 由 UA 推断的方向没有符合的图片时不再限制方向;
+    开启 session 模式时按客户端的洗牌序列选择 (忽略 auto_orientation);
+    开启 auto_orientation 时按图片实际尺寸而不是所在目录判断方向;
+    其余情况按 [weights] 配置的权重选择, img_type 为 "all" 时跨类型选择
+
+    Returns:
+        list: [ImageEntry, ...]
+    """
+    if orientation and orientation not in utils.ORIENTATIONS:
+        return []
+    selector = get_selector()
+    if img_type == ALL_TYPES and not utils.get_catalog().has_type(ALL_TYPES):
+        if filters is not None:
+            abort(400, description=f"Image filters are not available for '{ALL_TYPES}'")
+        return selector.sample_any(utils.get_catalog(), orientation, k)
+    if filters is None:
+        bag = current_bag(f"img/{img_type}/{orientation or ''}")
+        if bag is not None:
+            return utils.sample_images(img_type, orientation, k, bag)
+    if filters is not None or (orientation and METADATA_AUTO_ORIENTATION):
+        catalog = utils.get_catalog()
+        index = get_metadata_index(catalog)
+        if index is None:
+            if filters is not None:
+                abort(400, description="Image filters are not available")
+        elif not index.ready:
+            # 第一次对齐在后台进行, 完成之前筛选条件无法判断, 方向回退到按目录判断
+            if filters is not None:
+                abort(503, description="Image metadata is not ready yet")
+        else:
+            entries = index.sample(catalog, img_type, orientation, filters, METADATA_AUTO_ORIENTATION, k)
+            if not entries and filters is not None and orientation and not request.args.get("orientation"):
+                entries = index.sample(catalog, img_type, None, filters, k=k)
+            if entries or filters is not None:
+                return entries
+    if selector is not None and selector.active:
+        return selector.sample(utils.get_catalog(), img_type, orientation, k)
+    if k == 1:
+        # 单张时沿用原有规则: 未指定方向时先随机选择方向
+        entry = utils.get_random_image(img_type, orientation)
+        return [] if entry is None else [entry]
+    return utils.sample_images(img_type, orientation, k)
+
+
+def _random_image(img_type, orientation, filters=None):
+    entries = _random_images(img_type, orientation, filters)
+    return entries[0] if entries else None
+
+
+def _batched(items, size):
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _stream_legacy_list(img_type, base_url):
+    """
+    不带分页参数时的原有格式 {"images": {"horizontal": [...], "vertical": [...]}, "type": ...},
+    按块生成, 不在内存中构建完整列表
+    """
+    indexes = _detail_indexes()
+    yield '{"images":{'
+    for i, orientation in enumerate(utils.ORIENTATIONS):
+        yield ("," if i else "") + f'"{orientation}":['
+        prefix = f"{base_url}/image/{img_type}/{orientation}/"
+        separator = ""
+        for batch in _batched(utils.iter_images(img_type, orientation), STREAM_BATCH):
+            yield separator + ",".join(
+                _dumps(_add_details(
+                    {"filename": filename, "path": prefix + filename, "size": size},
+                    indexes, img_type, orientation, filename, base_url,
+                ))
+                for _, filename, size in batch
+            )
+            separator = ","
+        yield "]"
+    yield f'}},"type":{_dumps(img_type)}}}\n'
+
+
+def _stream_ndjson(img_type, items, base_url):
+    """
+    每行一张图片, 附带可用于断点续传的游标
+    """
+    indexes = _detail_indexes()
+    for batch in _batched(items, STREAM_BATCH):
+        yield "".join(
+            _dumps(_add_details({
+                "cursor": utils.encode_cursor(orientation, filename),
+                "filename": filename,
+                "orientation": orientation,
+                "path": f"{base_url}/image/{img_type}/{orientation}/{filename}",
+                "size": size,
+            }, indexes, img_type, orientation, filename, base_url)) + "\n"
+            for orientation, filename, size in batch
+        )
 
 
 @bp.route("/api/img/<img_type>/list")
 def image_list(img_type):
-    if img_type not in utils.get_image_types():
+    """
+    图片列表
+
+    Query:
+        limit: 每页数量, 指定后返回分页格式 {"images": [...], "next_cursor": ...}
+        cursor: 上一页返回的 next_cursor
+        orientation: 只列出 horizontal 或 vertical
+        format: ndjson 时以换行分隔的 JSON 流式返回
+    """
+    if not utils.get_catalog().has_type(img_type):
         abort(404, description=f"Invalid image type '{img_type}'")
 
-    base_url = request.host_url.rstrip("/")
+    orientation = request.args.get("orientation") or None
+    if orientation is not None and orientation not in utils.ORIENTATIONS:
+        abort(400, description=f"Invalid orientation '{orientation}'")
 
-    info = utils.get_images_info(img_type, base_url)
-    return jsonify({"type": img_type, "images": info})
+    cursor = request.args.get("cursor") or None
+    after = None
+    if cursor is not None:
+        after = utils.decode_cursor(cursor)
+        if after is None:
+            abort(400, description="Invalid cursor")
+
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            abort(400, description="Invalid limit")
+        if limit <= 0:
+            abort(400, description="Invalid limit")
+        limit = min(limit, MAX_PAGE_SIZE)
+
+    base_url = request.host_url.rstrip("/")
+    fmt = request.args.get("format", "json")
+
+    if fmt == "ndjson":
+        items = utils.iter_images(img_type, orientation, after)
+        if limit is not None:
+            items = islice(items, limit)
+        return current_app.response_class(
+            stream_with_context(_stream_ndjson(img_type, items, base_url)),
+            mimetype="application/x-ndjson",
+        )
+    if fmt != "json":
+        abort(400, description=f"Invalid format '{fmt}'")
+
+    if limit is None and after is None and orientation is None:
+        return current_app.response_class(
+            stream_with_context(_stream_legacy_list(img_type, base_url)),
+            mimetype="application/json",
+        )
+
+    # 分页格式, 多取一条用于判断是否还有下一页
+    page = list(islice(
+        utils.iter_images(img_type, orientation, after), (limit or DEFAULT_PAGE_SIZE) + 1
+    ))
+    next_cursor = None
+    if len(page) > (limit or DEFAULT_PAGE_SIZE):
+        page.pop()
+        next_cursor = utils.encode_cursor(page[-1][0], page[-1][1])
+
+    indexes = _detail_indexes()
+    return jsonify(
+        {
+            "type": img_type,
+            "images": [
+                _add_details({
+                    "filename": filename,
+                    "orientation": current,
+                    "path": f"{base_url}/image/{img_type}/{current}/{filename}",
+                    "size": size,
+                }, indexes, img_type, current, filename, base_url)
+                for current, filename, size in page
+            ],
+            "next_cursor": next_cursor,
+        }
+    )
 
 
 @bp.route("/api/img/<img_type>/count")
 def image_count(img_type):
-    if img_type not in utils.get_image_types():
+    if not utils.get_catalog().has_type(img_type):
         abort(404, description=f"Invalid image type '{img_type}'")
 
-    info = utils.get_images_info(img_type)
-    return jsonify(
-        {
+    catalog = utils.get_catalog()
+
+    def build():
+        counts = catalog.count(img_type)
+        return {
             "type": img_type,
-            "horizontal_count": len(info["horizontal"]),
-            "vertical_count": len(info["vertical"]),
-            "total_count": len(info["horizontal"]) + len(info["vertical"]),
+            "horizontal_count": counts["horizontal"],
+            "vertical_count": counts["vertical"],
+            "total_count": counts["horizontal"] + counts["vertical"],
         }
-    )
+
+    return cached_json(f"img_count:{img_type}", catalog.generation, build)
 
 
 
@@ -61,26 +319,24 @@ def image_count(img_type):
 """
 @bp.route("/random_image/<img_type>", methods=["GET"])
 def random_image_direct(img_type):
-    # 获取orientation参数
-    orientation = request.args.get("orientation", None)
-
-    # 如果未指定orientation，根据设备UA判断
-    if not orientation:
-        user_agent = request.user_agent.string.lower()
-        # 检测移动设备关键词
-        mobile_keywords = ["iphone", "ipad", "symbian", "mobile", "android"]
-        if any(keyword in user_agent for keyword in mobile_keywords):
-            orientation = "vertical"  # 移动设备默认返回竖屏
-        elif "macos" in user_agent or "windows" in user_agent:
-            orientation = "horizontal"  # 桌面设备默认返回横屏
-        # 无UA或未匹配到则保持为None，让utils处理随机选择
-
-    result = utils.get_random_image_path(img_type, orientation)
-    if not result:
+    spec = _derivative_spec()
+    filters = _image_filters()
+
+    # 获取orientation参数, 未指定时根据设备推断; 无法判断时为None，让utils处理随机选择
+    orientation = request_orientation()
+
+    entry = _random_image(img_type, orientation, filters)
+    if entry is None:
         abort(404, description=f"No images found for type '{img_type}'")
 
-    image_path, _ = result
-    return send_file(image_path)
+    entry = canonical_entry(utils.get_catalog(), entry)
+    derived = derive_image(entry, spec)
+    if derived is None:
+        abort(500, description="Failed to render image")
+    rv = send_image(derived, RANDOM_CACHE_CONTROL)
+    if rv is None:
+        abort(404, description="Image not found")
+    return rv
 
 
 """
@@ -89,47 +345,61 @@ def random_image_direct(img_type):
 """
 @bp.route("/random_image/j/<img_type>", methods=["GET"])
 def random_image_json(img_type):
-    # 获取orientation参数
-    orientation = request.args.get("orientation", None)
-
-    # 如果未指定orientation，根据设备UA判断
-    if not orientation:
-        user_agent = request.user_agent.string.lower()
-        # 检测移动设备关键词
-        mobile_keywords = ["iphone", "ipad", "symbian", "mobile", "android"]
-        if any(keyword in user_agent for keyword in mobile_keywords):
-            orientation = "vertical"  # 移动设备默认返回竖屏
-        elif "macos" in user_agent or "windows" in user_agent:
-            orientation = "horizontal"  # 桌面设备默认返回横屏
-        # 无UA或未匹配到则保持为None，让utils处理随机选择
-
-    result = utils.get_random_image_path(img_type, orientation)
-    if not result:
+    """
+    Query:
+        n: 指定时不放回地随机选择 n 张, 返回 JSON 数组
+    """
+    n = batch_size()
+    items = random_image_items(img_type, n or 1)
+    if not items:
         abort(404, description=f"No images found for type '{img_type}'")
+    if n is not None:
+        return jsonify(items)
 
-    image_path, actual_orientation = result
-    filename = os.path.basename(image_path)
+    rv = items[0]
+    token = session_token()
+    if token is not None:
+        rv["session"] = token
+    return jsonify(rv)
 
-    try:
-        size = os.path.getsize(image_path)
-    except OSError:
-        size = 0
+
+def random_image_items(img_type, n=1):
+    """
+    不放回地随机选择至多 n 张图片, 返回 /random_image/j 格式的信息列表
+    """
+    filters = _image_filters()
+
+    # 获取orientation参数, 未指定时根据设备推断; 无法判断时为None，让utils处理随机选择
+    orientation = request_orientation()
+
+    entries = _random_images(img_type, orientation, filters, n)
+    if not entries:
+        return []
 
     # 获取当前请求的基地址
     base_url = request.host_url.rstrip("/")
-
-    return jsonify(
-        {
-            "type": img_type,
-            "orientation": actual_orientation,
-            "filename": filename,
-            "path": f"{base_url}/image/{img_type}/{actual_orientation}/{filename}",
-            "size": size,
-            "direct_url": f"{base_url}/random_image/{img_type}?orientation={actual_orientation}",
-            "redirect_url": f"{base_url}/random_image/g/{img_type}?orientation={actual_orientation}",
-            "requested_orientation": orientation,  # 返回客户端请求的方向
-        }
-    )
+    indexes = _detail_indexes()
+
+    items = []
+    for entry in entries:
+        # img_type 为 "all" 时各张图片的类型不同
+        actual_type = entry.img_type
+        actual_orientation = entry.orientation
+        filename = entry.filename
+        items.append(_add_details(
+            {
+                "type": actual_type,
+                "orientation": actual_orientation,
+                "filename": filename,
+                "path": f"{base_url}/image/{actual_type}/{actual_orientation}/{filename}",
+                "size": entry.size,
+                "direct_url": f"{base_url}/random_image/{img_type}?orientation={actual_orientation}",
+                "redirect_url": f"{base_url}/random_image/g/{img_type}?orientation={actual_orientation}",
+                "requested_orientation": orientation,  # 返回客户端请求的方向
+            },
+            indexes, actual_type, actual_orientation, filename, base_url, entry.etag,
+        ))
+    return items
 
 
 """
@@ -138,49 +408,48 @@ def random_image_json(img_type):
 """
 @bp.route("/random_image/g/<img_type>", methods=["GET"])
 def random_image_redirect(img_type):
-    # 获取orientation参数
-    orientation = request.args.get("orientation", None)
-
-    # 如果未指定orientation，根据设备UA判断
-    if not orientation:
-        user_agent = request.user_agent.string.lower()
-        # 检测移动设备关键词
-        mobile_keywords = ["iphone", "ipad", "symbian", "mobile", "android"]
-        if any(keyword in user_agent for keyword in mobile_keywords):
-            orientation = "vertical"  # 移动设备默认返回竖屏
-        elif "macos" in user_agent or "windows" in user_agent:
-            orientation = "horizontal"  # 桌面设备默认返回横屏
-        # 无UA或未匹配到则保持为None，让utils处理随机选择
-
-    result = utils.get_random_image_path(img_type, orientation)
-    if not result:
+    filters = _image_filters()
+
+    # 获取orientation参数, 未指定时根据设备推断; 无法判断时为None，让utils处理随机选择
+    orientation = request_orientation()
+
+    entry = _random_image(img_type, orientation, filters)
+    if entry is None:
         abort(404, description=f"No images found for type '{img_type}'")
 
-    image_path, actual_orientation = result
-    filename = os.path.basename(image_path)
-    return redirect(f"/image/{img_type}/{actual_orientation}/{filename}")
+    return redirect(f"/image/{entry.img_type}/{entry.orientation}/{entry.filename}")
 
 
 @bp.route("/image/<img_type>/<orientation>/<filename>")
 def serve_image(img_type, orientation, filename):
+    spec = _derivative_spec()
+
     # 安全验证
-    if img_type not in utils.get_image_types():
+    if not utils.get_catalog().has_type(img_type):
         abort(404, description=f"Invalid image type '{img_type}'")
 
     if orientation not in ["horizontal", "vertical"]:
         abort(400, description=f"Invalid orientation '{orientation}'")
 
-    # 构建路径
-    image_base = current_app.config["IMAGE_BASE"]
-    image_path = os.path.join(image_base, img_type, orientation, filename)
-
-    # 验证文件存在
-    if not os.path.isfile(image_path):
+    # 在索引中查找, 索引只包含允许的扩展名, 同时避免路径穿越
+    catalog = utils.get_catalog()
+    entry = catalog.lookup(img_type, orientation, filename)
+    if entry is None:
+        # 验证文件扩展名
+        ext = filename.split(".")[-1].lower()
+        if ext not in current_app.config["ALLOWED_EXTENSIONS"]:
+            abort(400, description="Invalid file type")
         abort(404, description="Image not found")
 
-    # 验证文件扩展名
-    ext = filename.split(".")[-1].lower()
-    if ext not in current_app.config["ALLOWED_EXTENSIONS"]:
-        abort(400, description="Invalid file type")
-
-    return send_file(image_path)
+    selector = get_selector()
+    if selector is not None:
+        selector.record_hit(entry)
+    # 内容相同的图片从同一个文件读取
+    entry = canonical_entry(catalog, entry)
+    derived = derive_image(entry, spec)
+    if derived is None:
+        abort(500, description="Failed to render image")
+    rv = send_image(derived)
+    if rv is None:
+        abort(404, description="Image not found")
+    return rv
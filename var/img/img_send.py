@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+图片发送: 基于索引记录的条件请求、Range 请求和零拷贝传输
+
+ETag / Last-Modified 直接取自 ImageCatalog, 304 响应不需要打开文件;
+小图片优先从进程内 LRU 缓存返回, 其余文件交给服务器的 wsgi.file_wrapper,
+gunicorn 同步工作进程会用 os.sendfile 发送
+"""
+import mimetypes
+from flask import current_app, request
+from werkzeug.datastructures import ContentRange
+from .img_cache import get_image_cache
+from .img_pack import open_image
+
+
+# /image/<type>/<orientation>/<filename> 的地址对应固定文件, 可以长期缓存
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 随机图片每次返回的文件不同, 只允许带 ETag 重新验证
+RANDOM_CACHE_CONTROL = "no-cache"
+
+CHUNK_SIZE = 64 * 1024
+
+_mimetypes = {}
+
+# 部分 Python 版本的 mimetypes 没有收录这两种格式
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+
+def guess_mimetype(filename):
+    ext = filename.rsplit(".", 1)[-1].lower()
+    mimetype = _mimetypes.get(ext)
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        _mimetypes[ext] = mimetype
+    return mimetype
+
+
+def _is_not_modified(etag, mtime):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
+
+def _requested_range(etag, mtime, size):
+    """
+    解析 Range 请求头
+
+    Returns:
+        tuple: (start, stop); 不是单段 Range 或 If-Range 不匹配时返回 None,
+        Range 无法满足时返回 False
+    """
+    rng = request.range
+    if rng is None or rng.units != "bytes" or len(rng.ranges) != 1:
+        return None
+
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and int(mtime) != int(if_range.date.timestamp()):
+        return None
+
+    return rng.range_for_length(size) or False
+
+
+def _iter_file(f, length):
+    """
+    服务器没有提供 wsgi.file_wrapper 时, 按块读取指定长度
+    """
+    try:
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def send_image(entry, cache_control=IMMUTABLE_CACHE_CONTROL):
+    """
+    发送一张图片
+
+    Args:
+        entry (ImageEntry): 图片索引记录
+        cache_control (str): Cache-Control 响应头
+    """
+    response_class = current_app.response_class
+    etag = entry.etag
+    size = entry.size
+
+    rv = response_class(mimetype=guess_mimetype(entry.filename))
+    rv.set_etag(etag)
+    rv.last_modified = entry.mtime
+    rv.headers["Cache-Control"] = cache_control
+    rv.accept_ranges = "bytes"
+
+    if _is_not_modified(etag, entry.mtime):
+        rv.status_code = 304
+        return rv
+
+    byte_range = _requested_range(etag, entry.mtime, size)
+    if byte_range is False:
+        rv.status_code = 416
+        rv.content_range = ContentRange("bytes", None, None, size)
+        return rv
+
+    if byte_range is None:
+        start, stop = 0, size
+    else:
+        start, stop = byte_range
+        rv.status_code = 206
+        rv.content_range = ContentRange("bytes", start, stop, size)
+    length = stop - start
+
+    cache = get_image_cache()
+    if cache is not None and cache.accepts(entry):
+        data = cache.get(entry)
+        if data is None:
+            return None
+        rv.set_data(data if byte_range is None else data[start:stop])
+        return rv
+
+    try:
+        # 包内图片定位到其在包文件中的偏移
+        f = open_image(entry, start)
+    except OSError:
+        # 索引还未来得及处理文件删除
+        return None
+
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None:
+        # 服务器按 Content-Length 截断, gunicorn 从当前偏移开始 sendfile
+        rv.response = file_wrapper(f, CHUNK_SIZE)
+    else:
+        rv.response = _iter_file(f, length)
+    rv.direct_passthrough = True
+    rv.content_length = length
+    rv.call_on_close(f.close)
+    return rv
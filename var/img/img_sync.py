@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+派生索引的后台对齐
+
+元数据索引、内容哈希索引需要读取图片文件, 不在请求中与图片索引对齐: 请求只读取最近一次
+发布的结果, 发现图片索引版本变化时唤醒本进程的后台线程; 后台线程只检查变化的图片
+(目录监听的增量变更) 或变化的类型 (变更记录不完整时), 完成后整体替换发布
+
+共享索引模式下只由 gunicorn 主进程对齐并保存索引文件, 工作进程只在文件变化后重新读取
+"""
+import logging
+import os
+import threading
+import time
+from .img_utils import ORIENTATIONS
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundUpdater:
+    """
+    在后台线程中执行 update(catalog), 多次请求合并为一次
+
+    Args:
+        update (callable): 更新函数, 参数为图片索引
+        name (str): 线程名
+    """
+
+    def __init__(self, update, name):
+        self.update = update
+        self.name = name
+        self._catalog = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._event = None
+        self._thread = None
+
+    def request(self, catalog):
+        """
+        请求按 catalog 的当前状态更新, 立即返回
+        """
+        self._catalog = catalog
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                # 第一次使用, 或 fork 之后子进程中没有后台线程
+                self._pid = os.getpid()
+                self._event = threading.Event()
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._event,), name=self.name, daemon=True
+                )
+                self._thread.start()
+            self._event.set()
+
+    def _run(self, event):
+        while True:
+            event.wait()
+            event.clear()
+            try:
+                self.update(self._catalog)
+            except Exception:
+                # 下一次请求时重试
+                logger.exception("Failed to update %s", self.name)
+
+
+class IndexFollower:
+    """
+    工作进程侧: 每隔 interval 秒检查一次索引文件, 变化后在后台线程中调用 reload()
+
+    Args:
+        path (str): 索引文件路径
+        reload (callable): 重新读取索引文件, 无参数
+        name (str): 线程名
+        interval (float): 检查间隔 (秒)
+    """
+
+    def __init__(self, path, reload, name, interval=1.0):
+        self.path = path
+        self.reload = reload
+        self.interval = interval
+        # 最近一次读取的索引文件的 (inode, size, mtime), None 表示尚未读取
+        self.stamp = None
+        self._checked = 0.0
+        self._updater = BackgroundUpdater(self._reload, name)
+
+    def check(self):
+        """
+        索引文件变化时请求重新读取, 立即返回
+        """
+        now = time.monotonic()
+        if now - self._checked < self.interval:
+            return
+        self._checked = now
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # 主进程尚未完成第一次对齐
+            return
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stamp != self.stamp:
+            self._updater.request(stamp)
+
+    def _reload(self, stamp):
+        self.reload()
+        self.stamp = stamp
+
+
+def lead(updater, catalog, watcher):
+    """
+    主进程侧: 开始第一次对齐, 之后每次目录变化后由 updater 在后台对齐并保存索引文件
+
+    Args:
+        updater (BackgroundUpdater): 索引的后台更新
+        catalog (ImageCatalog): 主进程的图片索引
+        watcher (CatalogWatcher): 主进程的目录监听
+    """
+    def notify():
+        updater.request(catalog)
+
+    watcher.listeners.append(notify)
+    notify()
+
+
+def entry_key(img_type, orientation, filename):
+    return f"{img_type}/{orientation}/{filename}"
+
+
+def changed_types(catalog, generation, type_generations, known=()):
+    """
+    上次对齐之后需要检查的图片
+
+    Args:
+        catalog (ImageCatalog): 图片索引
+        generation (int): 上次对齐时的图片索引版本, None 表示从未对齐
+        type_generations (dict): 上次对齐时 {img_type: catalog.type_generation()}
+        known: 已有记录的类型, 包括从索引文件读取、尚未对齐过的类型
+
+    Returns:
+        dict: {img_type: {(orientation, filename), ...}}, 值为 None 表示检查该类型的全部图片;
+            包括已被删除的类型
+    """
+    types = set(catalog.types).union(type_generations, known)
+    types = {t for t in types if catalog.type_generation(t) != type_generations.get(t)}
+    changes = None if generation is None else catalog.changes_since(generation)
+    if changes is None:
+        return dict.fromkeys(types)
+    # 变更记录完整时, 类型版本变化的每个类型都有对应的记录
+    return {t: changes.get(t) for t in types}
+
+
+def iter_changed(catalog, img_type, names, known):
+    """
+    依次返回需要检查的 (key, ImageEntry), 图片已不存在时 ImageEntry 为 None
+
+    Args:
+        names (set): changed_types() 中该类型的值
+        known (dict): 该类型已有的记录, 以 key 为键
+    """
+    if names is not None:
+        for orientation, filename in names:
+            yield (
+                entry_key(img_type, orientation, filename),
+                catalog.lookup(img_type, orientation, filename),
+            )
+        return
+
+    seen = set()
+    complete = True
+    for orientation in ORIENTATIONS if catalog.has_type(img_type) else ():
+        bucket = catalog.get_bucket(img_type, orientation)
+        if bucket is None:
+            continue
+        for pos in range(len(bucket)):
+            try:
+                entry = catalog.entry_at(img_type, orientation, bucket, pos)
+            except IndexError:
+                # 与增量删除并发, 该类型的版本已经变化, 下一次对齐时再检查其余图片
+                complete = False
+                break
+            key = entry_key(img_type, orientation, entry.filename)
+            seen.add(key)
+            yield key, entry
+    if complete:
+        for key in [key for key in known if key not in seen]:
+            yield key, None
@@ -1,77 +1,710 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import binascii
 import os
 import random
+import stat
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import deque, namedtuple
+from itertools import islice
 from flask import current_app
+from ..metrics import timed_scan
+from .img_pack import PACKED_FLAG, is_valid_name, pack_path, pack_orientation, pack_stat, read_pack
+
+
+ORIENTATIONS = ("horizontal", "vertical")
+# 修改时间距今不足该值 (纳秒) 的目录不记录状态: 同一时间粒度内的后续修改可能不改变修改时间
+RACY_NS = 2 * 10 ** 9
+# 保留的增量变更条数, 派生索引 (元数据、内容哈希) 据此只处理变化的图片
+CHANGE_LOG_SIZE = 4096
+
+class ImageEntry(
+    namedtuple(
+        "ImageEntry",
+        ["img_type", "orientation", "filename", "path", "size", "mtime", "inode"],
+    )
+):
+    """
+    单张图片的索引记录
+    """
+
+    __slots__ = ()
+
+    @property
+    def etag(self):
+        """
+        由 inode、大小和修改时间组成的强 ETag, 不需要读取文件内容
+        """
+        return f"{self.inode:x}-{self.size:x}-{int(self.mtime * 1000000):x}"
+
+
+class _ImageBucket:
+    """
+    单个 类型/方向 目录的图片索引
+
+    文件名、大小、修改时间按位置平行存放, 随机选择只需一次下标访问
+    """
+
+    __slots__ = ("names", "sizes", "mtimes", "inodes", "positions", "_sorted")
+
+    def __init__(self):
+        self.names = []
+        self.sizes = array("Q")
+        self.mtimes = array("d")
+        self.inodes = array("Q")
+        self.positions = {}
+        # 按文件名排序的列表, 分页时按需生成, 增删文件后失效
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def find(self, filename):
+        """
+        返回文件名所在位置, 不存在时返回 -1
+        """
+        return self.positions.get(filename, -1)
+
+    def record(self, pos):
+        """
+        返回 (filename, size, mtime, inode)
+        """
+        return self.names[pos], self.sizes[pos], self.mtimes[pos], self.inodes[pos]
+
+    def items(self):
+        """
+        依次返回 (filename, size)
+        """
+        return zip(self.names, self.sizes)
+
+    def iter_sorted(self, after=None):
+        """
+        按文件名顺序返回 (filename, size), 从 after 之后开始
+        """
+        names = self._sorted
+        if names is None:
+            names = self._sorted = sorted(self.names)
+        start = 0 if after is None else bisect_right(names, after)
+        for name in islice(names, start, None):
+            pos = self.positions.get(name)
+            # 排序列表生成之后被删除的文件直接跳过
+            if pos is not None:
+                yield name, self.sizes[pos]
+
+    def add(self, filename, size, mtime, inode):
+        pos = self.positions.get(filename)
+        if pos is not None:
+            # 已存在则只更新文件属性
+            self.sizes[pos] = size
+            self.mtimes[pos] = mtime
+            self.inodes[pos] = inode
+            return
+        self._sorted = None
+        self.positions[filename] = len(self.names)
+        self.names.append(filename)
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.inodes.append(inode)
+
+    @classmethod
+    def copy_of(cls, bucket):
+        """
+        复制只读索引 (shared_catalog._MappedImageBucket) 中的全部记录
+        """
+        copy = cls()
+        for pos in range(len(bucket)):
+            copy.add(*bucket.record(pos))
+        return copy
+
+    def remove(self, filename):
+        """
+        删除一条记录, 用末尾记录填补空位, O(1)
+        """
+        pos = self.positions.pop(filename, None)
+        if pos is None:
+            return False
+        self._sorted = None
+        last = len(self.names) - 1
+        if pos != last:
+            moved = self.names[last]
+            self.names[pos] = moved
+            self.sizes[pos] = self.sizes[last]
+            self.mtimes[pos] = self.mtimes[last]
+            self.inodes[pos] = self.inodes[last]
+            self.positions[moved] = pos
+        self.names.pop()
+        self.sizes.pop()
+        self.mtimes.pop()
+        self.inodes.pop()
+        return True
+
+
+class ImageCatalog:
+    """
+    图片目录索引
+
+    启动时扫描一次 IMAGE_BASE, 之后的类型列表、随机选择和统计都读取内存中的数据,
+    不再在每次请求时遍历目录; 目录变更由 watcher 以增量方式应用
+    """
+
+    def __init__(self, image_base, allowed_extensions):
+        self.image_base = image_base
+        self.allowed_extensions = frozenset(ext.lower() for ext in allowed_extensions)
+        # {img_type: {orientation: _ImageBucket}}, 只记录实际存在的方向目录
+        self.buckets = {}
+        self.types = ()
+        # 每次索引变化时递增
+        self.generation = 0
+        # {img_type: 该类型最后一次变化时的 generation}
+        self.type_generations = {}
+        self.lock = threading.Lock()
+        # {(img_type, orientation): 包文件状态}, 用于发现包文件的追加
+        self.pack_stats = {}
+        # 最近读取的一个包文件 (路径, 状态, 内容), 目录中的文件被删除时查找包内的同名图片
+        self._last_pack = None
+        # {img_type: 扫描时的目录状态}, 用于判断启动快照中的记录是否仍然有效
+        self.dir_stamps = {}
+        # 最近的增量变更 (generation, img_type, orientation, filename), 每次变化一条且 generation 连续;
+        # orientation 为 None 表示该类型的方向目录或包文件变化, 整个类型都需要重新检查
+        self.changes = deque(maxlen=CHANGE_LOG_SIZE)
+
+    def is_allowed(self, filename):
+        return filename.rsplit(".", 1)[-1].lower() in self.allowed_extensions
+
+    def scan(self, boot=None):
+        """
+        完整扫描 IMAGE_BASE 并重建索引
+
+        Args:
+            boot (BootSnapshot): 可选, 上次保存的启动快照; 方向目录修改时间和包文件状态与保存时
+                相同的类型直接使用快照中映射的只读索引, 第一次修改时再复制到内存
+        """
+        buckets = {}
+        dir_stamps = {}
+        with timed_scan("image", "full"):
+            if os.path.isdir(self.image_base):
+                for type_entry in os.scandir(self.image_base):
+                    if not type_entry.is_dir():
+                        continue
+                    img_type = type_entry.name
+                    # 在读取目录之前记录状态, 扫描期间的修改在下次启动时重新扫描
+                    stamp = self._dir_stamp(type_entry.path)
+                    if (boot is not None and stamp is not None
+                            and boot.image_stamps.get(img_type) == stamp
+                            and img_type in boot.snapshot.image_buckets):
+                        buckets[img_type] = dict(boot.snapshot.image_buckets[img_type])
+                        for orientation, (_, st) in zip(ORIENTATIONS, stamp):
+                            self.pack_stats[img_type, orientation] = None if st is None else tuple(st)
+                    else:
+                        buckets[img_type] = self._scan_type(type_entry.path)
+                    if stamp is not None:
+                        dir_stamps[img_type] = stamp
+
+        with self.lock:
+            self.buckets = buckets
+            self.types = tuple(sorted(buckets))
+            self.generation += 1
+            self.type_generations = dict.fromkeys(buckets, self.generation)
+            self.dir_stamps = dir_stamps
+            self.changes.clear()
+
+    @staticmethod
+    def _dir_stamp(type_path):
+        """
+        类型目录的状态: 每个方向 [方向目录的修改时间, 包文件状态], 不存在的为 None;
+        有刚刚修改过的目录或包文件时返回 None
+
+        Returns:
+            list: 可直接保存为 JSON
+        """
+        recent = time.time_ns() - RACY_NS
+        stamp = []
+        for orientation in ORIENTATIONS:
+            try:
+                mtime = os.stat(os.path.join(type_path, orientation)).st_mtime_ns
+            except OSError:
+                mtime = None
+            st = pack_stat(pack_path(type_path, orientation))
+            if (mtime or 0) > recent or (st is not None and st[2] > recent):
+                return None
+            stamp.append([mtime, None if st is None else list(st)])
+        return stamp
+
+    def _writable_bucket(self, img_type, orientation):
+        """
+        返回可修改的索引, 来自启动快照的只读索引在第一次修改时复制; 需持有 self.lock
+        """
+        bucket = self.get_bucket(img_type, orientation)
+        if bucket is not None and not isinstance(bucket, _ImageBucket):
+            bucket = self.buckets[img_type][orientation] = _ImageBucket.copy_of(bucket)
+        return bucket
+
+    def _scan_type(self, type_path):
+        orientations = {}
+        for orientation in ORIENTATIONS:
+            bucket = self._scan_bucket(type_path, orientation)
+            if bucket is not None:
+                orientations[orientation] = bucket
+        return orientations
+
+    def _read_pack(self, type_path, orientation):
+        """
+        读取 类型/方向 的包文件, 不存在时返回 None
+        """
+        path = pack_path(type_path, orientation)
+        st = pack_stat(path)
+        if st is None:
+            return None
+        last = self._last_pack
+        if last is not None and last[0] == path and last[1] == st:
+            return last[2]
+        records = read_pack(path)
+        if records is not None:
+            self._last_pack = (path, st, records)
+        return records
+
+    def _scan_bucket(self, type_path, orientation):
+        """
+        方向目录和包文件合并为一个索引, 目录中的同名文件优先; 两者都不存在时返回 None
+        """
+        img_type = os.path.basename(type_path)
+        type_dir = os.path.join(type_path, orientation)
+        self.pack_stats[img_type, orientation] = pack_stat(pack_path(type_path, orientation))
+        records = self._read_pack(type_path, orientation)
+        if records is None and not os.path.isdir(type_dir):
+            return None
+        bucket = _ImageBucket()
+        for name, (offset, length, mtime) in (records or {}).items():
+            if self.is_allowed(name) and is_valid_name(name):
+                bucket.add(name, length, mtime, PACKED_FLAG | offset)
+        if os.path.isdir(type_dir):
+            self._scan_dir(type_dir, bucket)
+        return bucket
+
+    def _scan_dir(self, type_dir, bucket=None):
+        if bucket is None:
+            bucket = _ImageBucket()
+        for entry in os.scandir(type_dir):
+            if not entry.is_file() or not self.is_allowed(entry.name):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            bucket.add(entry.name, st.st_size, st.st_mtime, st.st_ino)
+        return bucket
+
+    def watch_dirs(self):
+        """
+        需要监听的目录: IMAGE_BASE、类型目录以及方向目录
+        """
+        dirs = [self.image_base]
+        for img_type, orientations in self.buckets.items():
+            type_path = os.path.join(self.image_base, img_type)
+            dirs.append(type_path)
+            dirs.extend(os.path.join(type_path, o) for o in orientations)
+        return dirs
+
+    def _locate(self, dir_path):
+        """
+        将目录路径解析为 (img_type, orientation), 层级不足的部分为 None
+        """
+        rel = os.path.relpath(dir_path, self.image_base)
+        if rel == ".":
+            return None, None
+        parts = rel.split(os.sep)
+        if len(parts) == 1:
+            return parts[0], None
+        if len(parts) == 2:
+            return parts[0], parts[1]
+        return False, False
+
+    def apply_change(self, dir_path, name):
+        """
+        根据 dir_path/name 的当前状态增量更新索引
+
+        Returns:
+            list: 新出现、需要加入监听的目录
+        """
+        img_type, orientation = self._locate(dir_path)
+        if img_type is False:
+            return []
+        path = os.path.join(dir_path, name)
+        new_dirs = []
+
+        with self.lock:
+            if img_type is None:
+                # 类型目录的增删
+                if os.path.isdir(path):
+                    if name in self.buckets:
+                        return new_dirs
+                    orientations = self._scan_type(path)
+                    self.buckets[name] = orientations
+                    new_dirs.append(path)
+                    new_dirs.extend(os.path.join(path, o) for o in orientations)
+                elif self.buckets.pop(name, None) is None:
+                    return new_dirs
+                self.types = tuple(sorted(self.buckets))
+
+            elif orientation is None:
+                # 方向目录或包文件的增删改
+                orientations = self.buckets.get(img_type)
+                if orientations is None:
+                    return new_dirs
+                type_path = os.path.dirname(path)
+                if name in ORIENTATIONS:
+                    is_dir = os.path.isdir(path)
+                    has_pack = self.pack_stats.get((img_type, name)) is not None
+                    if is_dir and name in orientations and not has_pack:
+                        return new_dirs
+                    if not is_dir and name not in orientations:
+                        return new_dirs
+                    if is_dir:
+                        new_dirs.append(path)
+                else:
+                    name = pack_orientation(name)
+                    if name is None:
+                        return new_dirs
+                    st = pack_stat(pack_path(type_path, name))
+                    if st == self.pack_stats.get((img_type, name)):
+                        return new_dirs
+                bucket = self._scan_bucket(type_path, name)
+                if bucket is not None:
+                    orientations[name] = bucket
+                elif orientations.pop(name, None) is None:
+                    return new_dirs
+
+            else:
+                # 单个图片文件的增删改
+                if not self.is_allowed(name):
+                    return new_dirs
+                bucket = self._writable_bucket(img_type, orientation)
+                if bucket is None:
+                    return new_dirs
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    st = None
+                if st is not None and stat.S_ISREG(st.st_mode):
+                    bucket.add(name, st.st_size, st.st_mtime, st.st_ino)
+                else:
+                    pos = bucket.find(name)
+                    if pos < 0 or bucket.record(pos)[3] & PACKED_FLAG:
+                        return new_dirs
+                    # 包内有同名图片时改为指向包内
+                    records = self._read_pack(os.path.dirname(dir_path), orientation)
+                    packed = None if records is None else records.get(name)
+                    if packed is None:
+                        bucket.remove(name)
+                    else:
+                        offset, length, mtime = packed
+                        bucket.add(name, length, mtime, PACKED_FLAG | offset)
+
+            self.generation += 1
+            changed_type = name if img_type is None else img_type
+            self.type_generations[changed_type] = self.generation
+            self.dir_stamps.pop(changed_type, None)
+            if orientation is None:
+                self.changes.append((self.generation, changed_type, None, None))
+            else:
+                self.changes.append((self.generation, img_type, orientation, name))
+        return new_dirs
+
+    def resync_dir(self, dir_path):
+        """
+        将单个目录与磁盘内容对齐, 只处理增删的差异部分
+        """
+        img_type, orientation = self._locate(dir_path)
+        if img_type is False:
+            return []
+        with timed_scan("image", "resync"):
+            try:
+                names = set(os.listdir(dir_path))
+            except OSError:
+                names = set()
+
+            changed = set()
+            if img_type is None:
+                known = set(self.buckets)
+            elif orientation is None:
+                # 包文件的追加不改变文件名, 按包文件状态判断
+                changed = {
+                    o + ".pack" for o in ORIENTATIONS
+                    if pack_stat(pack_path(dir_path, o)) != self.pack_stats.get((img_type, o))
+                }
+                names &= set(ORIENTATIONS)
+                known = set(self.buckets.get(img_type, ()))
+            else:
+                with self.lock:
+                    bucket = self._writable_bucket(img_type, orientation)
+                if bucket is None:
+                    return []
+                names = {n for n in names if self.is_allowed(n)}
+                # 包内的图片不在目录中
+                known = {
+                    n for n, pos in bucket.positions.items()
+                    if not bucket.inodes[pos] & PACKED_FLAG or n in names
+                }
+
+            new_dirs = []
+            for name in names.symmetric_difference(known) | changed:
+                new_dirs.extend(self.apply_change(dir_path, name))
+        return new_dirs
+
+    def sync(self):
+        """
+        与共享索引对齐, 本进程自行维护的索引无需处理
+        """
+
+    def type_generation(self, img_type):
+        """
+        类型的图片变化时改变, 用于只重建变化类型的派生数据
+        """
+        return self.type_generations.get(img_type, 0)
+
+    def changes_since(self, generation):
+        """
+        返回 generation 之后变化的图片
+
+        Returns:
+            dict: {img_type: {(orientation, filename), ...}}, 值为 None 表示整个类型都可能变化;
+                变更记录已不完整 (重新扫描过或超出保留条数) 时返回 None
+        """
+        with self.lock:
+            changes = list(self.changes)
+            current = self.generation
+        first = changes[0][0] if changes else current + 1
+        if generation > current or first > generation + 1:
+            return None
+        rv = {}
+        for change_generation, img_type, orientation, filename in changes:
+            if change_generation <= generation:
+                continue
+            names = rv.setdefault(img_type, set())
+            if orientation is None:
+                rv[img_type] = None
+            elif names is not None:
+                names.add((orientation, filename))
+        return rv
+
+    def has_type(self, img_type):
+        return img_type in self.buckets
+
+    def get_bucket(self, img_type, orientation):
+        return self.buckets.get(img_type, {}).get(orientation)
+
+    def entry_at(self, img_type, orientation, bucket, pos):
+        filename, size, mtime, inode = bucket.record(pos)
+        return ImageEntry(
+            img_type,
+            orientation,
+            filename,
+            os.path.join(self.image_base, img_type, orientation, filename),
+            size,
+            mtime,
+            inode,
+        )
+
+    def lookup(self, img_type, orientation, filename):
+        """
+        按文件名查找索引记录, 不存在时返回 None
+        """
+        bucket = self.get_bucket(img_type, orientation)
+        if bucket is None:
+            return None
+        pos = bucket.find(filename)
+        if pos < 0:
+            return None
+        return self.entry_at(img_type, orientation, bucket, pos)
+
+    def pick(self, img_type, orientation=None):
+        """
+        随机选择一张图片, 规则与原先的目录扫描一致:
+        未指定方向时随机选择, 方向目录不存在时回退到另一个方向
+        """
+        orientations = self.buckets.get(img_type)
+        if orientations is None:
+            return None
+
+        if not orientation:
+            orientation = random.choice(ORIENTATIONS)
+
+        bucket = orientations.get(orientation)
+        if bucket is None:
+            # 如果指定方向不存在，尝试另一个方向
+            orientation = "vertical" if orientation == "horizontal" else "horizontal"
+            bucket = orientations.get(orientation)
+            if bucket is None:
+                return None
+
+        # 与增量删除并发时下标可能失效, 重试即可
+        for _ in range(3):
+            if not bucket:
+                return None
+            try:
+                return self.entry_at(
+                    img_type, orientation, bucket, random.randrange(len(bucket))
+                )
+            except IndexError:
+                continue
+        return None
+
+    def sample(self, img_type, orientation=None, k=1, bag=None):
+        """
+        不放回地随机选择至多 k 张图片: 未指定方向时在两个方向的全部图片中选择,
+        方向目录不存在时回退到另一个方向
+
+        Args:
+            bag (ShuffleBag): 可选, 按客户端的洗牌序列 (shuffle.ShuffleBag) 依次选择,
+                一轮剩余不足 k 张时只返回剩余的部分
+
+        Returns:
+            list: [ImageEntry, ...]
+        """
+        orientations = self.buckets.get(img_type)
+        if orientations is None:
+            return []
+        if orientation and orientation not in orientations:
+            orientation = "vertical" if orientation == "horizontal" else "horizontal"
+        buckets = [
+            (o, orientations[o])
+            for o in ((orientation,) if orientation else ORIENTATIONS)
+            if o in orientations
+        ]
+        total = sum(len(bucket) for _, bucket in buckets)
+        k = min(k, total)
+        if k <= 0:
+            return []
+
+        if bag is not None:
+            ranks = bag.draw(total, k)
+        else:
+            ranks = random.sample(range(total), k)
+        entries = []
+        for rank in ranks:
+            for current, bucket in buckets:
+                if rank < len(bucket):
+                    try:
+                        entries.append(self.entry_at(img_type, current, bucket, rank))
+                    except IndexError:
+                        # 与增量删除并发, 跳过这一张
+                        pass
+                    break
+                rank -= len(bucket)
+        return entries
+
+    def count(self, img_type):
+        """
+        返回 {orientation: 数量}
+        """
+        orientations = self.buckets.get(img_type, {})
+        return {o: len(orientations[o]) if o in orientations else 0 for o in ORIENTATIONS}
+
+
+class SharedImageCatalog(ImageCatalog):
+    """
+    工作进程中的只读索引, 数据来自主进程发布并以 mmap 映射的共享索引文件
+    """
+
+    def __init__(self, image_base, allowed_extensions, reader):
+        super().__init__(image_base, allowed_extensions)
+        self.reader = reader
+        self.sync()
+
+    def sync(self):
+        snapshot = self.reader.current()
+        if snapshot.generation != self.generation:
+            self.buckets = snapshot.image_buckets
+            self.types = snapshot.image_types
+            self.type_generations = snapshot.type_generations
+            self.generation = snapshot.generation
+
+    def changes_since(self, generation):
+        # 工作进程收不到目录监听的事件, 由调用方按类型检查
+        return None
+
+
+def init_catalog(app, boot=None):
+    """
+    构建图片索引并挂载到 app.extensions, 在 Init_module 中调用一次
+
+    Args:
+        boot (BootSnapshot): 可选, 见 ImageCatalog.scan()
+    """
+    catalog = ImageCatalog(app.config["IMAGE_BASE"], app.config["ALLOWED_EXTENSIONS"])
+    catalog.scan(boot)
+    app.extensions["image_catalog"] = catalog
+    return catalog
+
+
+def get_catalog():
+    catalog = current_app.extensions["image_catalog"]
+    catalog.sync()
+    return catalog
 
 
 def get_image_types():
     """
     获取所有图片类型
     """
-    image_base = current_app.config["IMAGE_BASE"]
-    types = []
-    for item in os.listdir(image_base):
-        if os.path.isdir(os.path.join(image_base, item)):
-            types.append(item)
-    return sorted(types)
+    return list(get_catalog().types)
 
 
-def get_random_image_path(img_type, orientation=None):
+def get_random_image(img_type, orientation=None, bag=None):
     """
-    获取随机图片路径
+    获取随机图片的索引记录
 
     Args:
         img_type (str): 图片类型
         orientation (str): 可选，'horizontal'或'vertical'
-    """
-    image_base = current_app.config["IMAGE_BASE"]
-    allowed_extensions = current_app.config["ALLOWED_EXTENSIONS"]
-
-    # 验证图片类型
-    if img_type not in get_image_types():
-        return None
+        bag (ShuffleBag): 可选, 按客户端的洗牌序列选择, 取完之前不重复
 
+    Returns:
+        ImageEntry: 未找到时返回 None
+    """
     # 验证orientation参数
-    valid_orientations = ["horizontal", "vertical"]
-    if orientation and orientation not in valid_orientations:
+    if orientation and orientation not in ORIENTATIONS:
         return None
+    if bag is not None:
+        entries = get_catalog().sample(img_type, orientation, 1, bag)
+        return entries[0] if entries else None
+    return get_catalog().pick(img_type, orientation)
 
-    # 如果没有指定方向，随机选择
-    if not orientation:
-        orientation = random.choice(valid_orientations)
 
-    # 构建完整路径
-    type_dir = os.path.join(image_base, img_type, orientation)
+def sample_images(img_type, orientation=None, k=1, bag=None):
+    """
+    不放回地随机选择至多 k 张图片
 
-    # 检查目录是否存在
-    if not os.path.exists(type_dir):
-        # 如果指定方向不存在，尝试另一个方向
-        if orientation == "horizontal":
-            fallback_orientation = "vertical"
-        else:
-            fallback_orientation = "horizontal"
+    Args:
+        img_type (str): 图片类型
+        orientation (str): 可选，'horizontal'或'vertical'
+        k (int): 数量
+        bag (ShuffleBag): 可选, 按客户端的洗牌序列选择
 
-        type_dir = os.path.join(image_base, img_type, fallback_orientation)
-        if not os.path.exists(type_dir):
-            return None
+    Returns:
+        list: [ImageEntry, ...]
+    """
+    if orientation and orientation not in ORIENTATIONS:
+        return []
+    return get_catalog().sample(img_type, orientation, k, bag)
 
-        orientation = fallback_orientation
 
-    # 获取该目录下所有图片
-    images = []
-    for file in os.listdir(type_dir):
-        if os.path.isfile(os.path.join(type_dir, file)):
-            ext = file.split(".")[-1].lower()
-            if ext in allowed_extensions:
-                images.append(file)
+def get_random_image_path(img_type, orientation=None):
+    """
+    获取随机图片路径
 
-    if not images:
+    Args:
+        img_type (str): 图片类型
+        orientation (str): 可选，'horizontal'或'vertical'
+    """
+    entry = get_random_image(img_type, orientation)
+    if entry is None:
         return None
-
-    # 随机选择一张图片
-    selected_image = random.choice(images)
-    return os.path.join(type_dir, selected_image), orientation
+    return entry.path, entry.orientation
 
 
 def get_images_info(img_type, base_url=""):
@@ -82,50 +715,86 @@ def get_images_info(img_type, base_url=""):
         img_type (str): 图片类型
         base_url (str): 基础URL, 用于构建绝对路径
     """
-    image_base = current_app.config["IMAGE_BASE"]
-    allowed_extensions = current_app.config["ALLOWED_EXTENSIONS"]
+    catalog = get_catalog()
 
     images = {"horizontal": [], "vertical": []}
-    for orientation in ["horizontal", "vertical"]:
-        type_dir = os.path.join(image_base, img_type, orientation)
-        if not os.path.exists(type_dir):
+    for orientation in ORIENTATIONS:
+        bucket = catalog.get_bucket(img_type, orientation)
+        if bucket is None:
             continue
 
-        for file in os.listdir(type_dir):
-            file_path = os.path.join(type_dir, file)
-            if os.path.isfile(file_path):
-                ext = file.split(".")[-1].lower()
-                if ext in allowed_extensions:
-                    # 使用基础URL构建绝对路径
-                    absolute_path = (
-                        f"{base_url}/image/{img_type}/{orientation}/{file}"
-                        if base_url
-                        else f"/image/{img_type}/{orientation}/{file}"
-                    )
-
-                    images[orientation].append(
-                        {
-                            "filename": file,
-                            "path": absolute_path,
-                            "size": os.path.getsize(file_path),
-                        }
-                    )
+        # 使用基础URL构建绝对路径
+        prefix = f"{base_url}/image/{img_type}/{orientation}/"
+        images[orientation] = [
+            {"filename": name, "path": prefix + name, "size": size}
+            for name, size in bucket.items()
+        ]
     return images
 
 
+def encode_cursor(orientation, filename):
+    """
+    分页游标: 上一页最后一张图片的 方向/文件名, 文件增删不影响后续分页
+    """
+    raw = f"{orientation}/{filename}".encode("utf-8", "surrogateescape")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Returns:
+        tuple: (orientation, filename), 游标无效时返回 None
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        orientation, filename = raw.decode("utf-8", "surrogateescape").split("/", 1)
+    except (binascii.Error, ValueError):
+        return None
+    if orientation not in ORIENTATIONS:
+        return None
+    return orientation, filename
+
+
+def iter_images(img_type, orientation=None, cursor=None):
+    """
+    按 方向、文件名 的顺序遍历图片, 直接读取索引, 不生成完整列表
+
+    Args:
+        img_type (str): 图片类型
+        orientation (str): 可选, 只遍历该方向
+        cursor (tuple): 可选, decode_cursor 的结果, 从该图片之后开始
+
+    Yields:
+        tuple: (orientation, filename, size)
+    """
+    catalog = get_catalog()
+    after_orientation, after_name = cursor or (None, None)
+    orientations = ORIENTATIONS if orientation is None else (orientation,)
+
+    for current in orientations:
+        if after_orientation is not None and (
+            ORIENTATIONS.index(current) < ORIENTATIONS.index(after_orientation)
+        ):
+            continue
+        bucket = catalog.get_bucket(img_type, current)
+        if bucket is None:
+            continue
+        after = after_name if current == after_orientation else None
+        for filename, size in bucket.iter_sorted(after):
+            yield current, filename, size
+
+
 def get_all_image_types_count():
     """
     获取所有类型的图片数量统计
     """
-    # image_base = current_app.config['IMAGE_BASE']
-    types = get_image_types()
+    catalog = get_catalog()
 
     total_count = 0
     type_counts = {}
 
-    for img_type in types:
-        info = get_images_info(img_type)
-        type_count = len(info["horizontal"]) + len(info["vertical"])
+    for img_type in catalog.types:
+        type_count = sum(catalog.count(img_type).values())
         type_counts[img_type] = type_count
         total_count += type_count
 
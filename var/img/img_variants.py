@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+预生成的响应式图片版本
+
+`python start.py --build-variants` 按 [derive] variants 中配置的尺寸/格式, 用全部 CPU 核心
+为 IMAGE_BASE 下的每张图片生成派生图片, 写入与 ?w= ?h= ?fmt= ?q= 参数相同的磁盘缓存,
+并把各版本的地址、实际尺寸和大小记录在 cache_dir/variants.json 中:
+
+    - 原图 ETag (inode、大小、修改时间) 与上次记录一致且文件仍在时跳过, 只处理新增或修改的图片
+    - /api/img/<type>/list 和 /random_image/j/<type> 直接读取该清单返回 variants/srcset,
+      请求时不需要解码图片; 版本地址即带参数的图片地址, 被缓存清理后访问时会重新生成
+"""
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode
+from flask import current_app
+from .img_derive import HAS_PILLOW, ImageDeriver, parse_spec, render_derivative
+from .img_utils import ImageCatalog, ORIENTATIONS
+from .img_pack import image_source
+
+
+MANIFEST_NAME = "variants.json"
+# 检查清单文件是否被重新生成的最短间隔（秒）
+CHECK_INTERVAL = 5.0
+# 批量生成时每个子进程最多排队的任务数, 不一次提交全部任务
+IN_FLIGHT_PER_WORKER = 4
+# 批量生成时写入中间清单的间隔（秒）, 中断后重新运行时不再生成已完成的版本
+CHECKPOINT_INTERVAL = 60.0
+# 配置中每个版本可用的参数, 顺序即地址中参数的顺序
+_SPEC_KEYS = ("w", "h", "fmt", "q")
+
+
+def variant_query(variant):
+    """
+    配置中的一个版本, 如 {"w": 480, "fmt": "webp"}, 转为图片地址的查询参数
+    """
+    unknown = set(variant) - set(_SPEC_KEYS)
+    if unknown:
+        raise ValueError(f"Invalid variant option {sorted(unknown)}")
+    return urlencode([(key, variant[key]) for key in _SPEC_KEYS if key in variant])
+
+
+def _image_key(img_type, orientation, filename):
+    return f"{img_type}/{orientation}/{filename}"
+
+
+class VariantIndex:
+    """
+    variants.json 的只读视图, 文件被重新生成后自动重新加载
+
+    Args:
+        manifest_path (str): 清单文件路径
+    """
+
+    def __init__(self, manifest_path, check_interval=CHECK_INTERVAL):
+        self.manifest_path = manifest_path
+        self.check_interval = check_interval
+        # {"type/orientation/filename": {"etag": ..., "variants": [...]}}
+        self.images = {}
+        self._stat_key = None
+        # 清单文件在第一次查询时读取, 不计入启动时间
+        self._checked = float("-inf")
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            st = os.stat(self.manifest_path)
+        except OSError:
+            self.images = {}
+            self._stat_key = None
+            return
+        stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stat_key == self._stat_key:
+            return
+        with self._lock:
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    images = json.load(f)["images"]
+            except (OSError, ValueError, KeyError):
+                return
+            self.images = images
+            self._stat_key = stat_key
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, img_type, orientation, filename, etag=None):
+        """
+        Args:
+            etag (str): 原图当前的 ETag, 指定时只返回与之一致的记录
+
+        Returns:
+            list: [{"query", "format", "width", "height", "size"}, ...], 没有记录时返回空列表
+        """
+        self.refresh()
+        record = self.images.get(_image_key(img_type, orientation, filename))
+        if record is None or (etag is not None and record["etag"] != etag):
+            return []
+        return record["variants"]
+
+    def describe(self, img_type, orientation, filename, base_url="", etag=None):
+        """
+        返回 API 中的 variants 列表和按格式分组的 srcset 字符串
+
+        Returns:
+            tuple: (variants, srcset), 没有记录时返回 (None, None)
+        """
+        variants = self.get(img_type, orientation, filename, etag)
+        if not variants:
+            return None, None
+        path = f"{base_url}/image/{img_type}/{orientation}/{filename}"
+        described = []
+        srcset = {}
+        for variant in variants:
+            url = f"{path}?{variant['query']}"
+            described.append({
+                "url": url,
+                "format": variant["format"],
+                "width": variant["width"],
+                "height": variant["height"],
+                "size": variant["size"],
+            })
+            srcset.setdefault(variant["format"], []).append(f"{url} {variant['width']}w")
+        return described, {fmt: ", ".join(items) for fmt, items in srcset.items()}
+
+
+def _variant(query, spec, width, height, size):
+    return {"query": query, "format": spec.fmt, "width": width, "height": height, "size": size}
+
+
+def _describe_file(path, query, spec):
+    from PIL import Image
+
+    try:
+        with Image.open(path) as im:
+            width, height = im.size
+        return _variant(query, spec, width, height, os.path.getsize(path))
+    except (OSError, ValueError):
+        return None
+
+
+def _load_manifest(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["images"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def _save_manifest(path, queries, images):
+    """
+    写入清单, 只包含已生成的版本
+    """
+    manifest = {
+        "variants": queries,
+        "images": {
+            key: {"etag": record["etag"], "variants": [v for v in record["variants"] if v is not None]}
+            for key, record in images.items()
+        },
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def build_variants(image_base, allowed_extensions, cache_dir, variants,
+                   max_dimension, default_quality, workers=None, progress=None):
+    """
+    为全部图片生成配置的版本并写入清单
+
+    Args:
+        variants (list): 配置中的版本列表, 如 [{"w": 480, "fmt": "webp"}, ...]
+        workers (int): 并行的进程数, 默认为 CPU 核心数
+        progress (callable): 每完成一张图片的一个版本时调用 progress(done, total)
+
+    Returns:
+        dict: {"images", "rendered", "skipped", "failed"}
+    """
+    if not HAS_PILLOW:
+        raise RuntimeError("Pillow is required to build image variants")
+
+    queries = [variant_query(variant) for variant in variants]
+    specs = [
+        parse_spec({k: str(v) for k, v in variant.items()}, max_dimension, default_quality)
+        for variant in variants
+    ]
+    catalog = ImageCatalog(image_base, allowed_extensions)
+    catalog.scan()
+    deriver = ImageDeriver(cache_dir, 0)
+    manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+    previous = _load_manifest(manifest_path)
+
+    images = {}
+    jobs = []
+    skipped = 0
+    for img_type in catalog.types:
+        for orientation in ORIENTATIONS:
+            bucket = catalog.get_bucket(img_type, orientation)
+            if bucket is None:
+                continue
+            for filename, _ in bucket.items():
+                entry = catalog.lookup(img_type, orientation, filename)
+                if entry is None:
+                    continue
+                key = _image_key(img_type, orientation, filename)
+                old = previous.get(key)
+                old_variants = {}
+                if old is not None and old["etag"] == entry.etag:
+                    old_variants = {v["query"]: v for v in old["variants"]}
+                record = images[key] = {"etag": entry.etag, "variants": [None] * len(specs)}
+                for i, (query, spec) in enumerate(zip(queries, specs)):
+                    spec = spec.resolve(entry.filename)
+                    path = deriver.path_for(entry, spec)
+                    variant = old_variants.get(query)
+                    if variant is None and os.path.exists(path):
+                        # 已按需生成过, 只读取文件头
+                        variant = _describe_file(path, query, spec)
+                    if variant is not None and os.path.exists(path):
+                        record["variants"][i] = variant
+                        skipped += 1
+                        continue
+                    jobs.append((record, i, query, spec, image_source(entry), path))
+
+    rendered = failed = 0
+    total = len(jobs)
+    if jobs:
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+        workers = workers or os.cpu_count()
+        limit = workers * IN_FLIGHT_PER_WORKER
+        pending = iter(jobs)
+        futures = {}
+        done = 0
+        checkpoint = time.monotonic()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # 完成一部分再补充提交, 排队的任务和结果不随图片数量增长
+                for job in pending:
+                    record, i, query, spec, src, path = job
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    futures[executor.submit(render_derivative, src, path, *spec)] = job
+                    if len(futures) >= limit:
+                        break
+                if not futures:
+                    break
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record, i, query, spec, _, _ = futures.pop(future)
+                    try:
+                        size, width, height = future.result()
+                    except Exception:
+                        failed += 1
+                    else:
+                        record["variants"][i] = _variant(query, spec, width, height, size)
+                        rendered += 1
+                    done += 1
+                    if progress is not None:
+                        progress(done, total)
+                if time.monotonic() - checkpoint >= CHECKPOINT_INTERVAL:
+                    _save_manifest(manifest_path, queries, images)
+                    checkpoint = time.monotonic()
+
+    _save_manifest(manifest_path, queries, images)
+    return {"images": len(images), "rendered": rendered, "skipped": skipped, "failed": failed}
+
+
+def init_variant_index(app, cache_dir):
+    index = VariantIndex(os.path.join(cache_dir, MANIFEST_NAME))
+    app.extensions["image_variants"] = index
+    return index
+
+
+def get_variant_index():
+    return current_app.extensions.get("image_variants")
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+加权随机选择
+
+每张图片的权重为 基础权重 x 显式权重:
+
+    - 基础权重由 [weights] mode 决定:
+        "directory"   每个 类型/方向 目录的总权重相同, 即先随机选择方向再在目录中均匀选择 (原有行为)
+        "file"        每张图片相同, 图片多的方向/类型被选中的概率按数量增加
+        "popularity"  1 + 本进程中该图片被访问 (/image/...) 的次数, 按半衰期随时间衰减
+    - 显式权重来自 config.toml 的 [weights] explicit 和 weights 文件 (同名键以文件为准),
+      键为 "类型"、"类型/方向" 或 "类型/方向/文件名", 三级的倍数相乘, 0 表示不参与随机
+
+每个类型和每个 类型/方向 各有一张 Vose 别名表, 选择一次为 O(1); 图片索引中某个类型变化后
+只在下次选择该类型时重建该类型的表. /random_image/all 先按各类型的总权重选择类型,
+再在类型内选择
+"""
+import os
+import random
+import threading
+import time
+import tomllib
+from array import array
+from flask import current_app
+from .img_utils import ORIENTATIONS
+
+
+MODES = ("directory", "file", "popularity")
+# 跨类型随机选择使用的类型名
+ALL_TYPES = "all"
+# 检查权重文件是否修改的最短间隔（秒）
+CHECK_INTERVAL = 5.0
+# 不放回选择时重复抽取的次数上限 (每张)
+_SAMPLE_ATTEMPTS = 32
+
+
+class AliasTable:
+    """
+    Vose 别名表: 按给定权重随机选择下标, O(n) 构建, O(1) 选择
+
+    Args:
+        weights (list): 非负权重, 总和需大于 0
+    """
+
+    __slots__ = ("prob", "alias", "total")
+
+    def __init__(self, weights):
+        n = len(weights)
+        self.total = total = float(sum(weights))
+        prob = array("d", bytes(8 * n))
+        alias = array("I", bytes(4 * n))
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] += scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+        # 剩余项的概率只因浮点误差偏离 1
+        for i in large + small:
+            prob[i] = 1.0
+            alias[i] = i
+        self.prob = prob
+        self.alias = alias
+
+    def __len__(self):
+        return len(self.prob)
+
+    def pick(self):
+        i = random.randrange(len(self.prob))
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+
+class _Table:
+    """
+    一个类型 (或 类型/方向) 的别名表及其下标到 (方向, 目录内位置) 的对应关系
+    """
+
+    __slots__ = ("stamp", "alias", "layout", "total")
+
+    def __init__(self, stamp, alias, layout, total):
+        self.stamp = stamp
+        # 所有权重相同时为 None, 直接均匀选择
+        self.alias = alias
+        # [(orientation, bucket, 起始下标), ...]
+        self.layout = layout
+        self.total = total
+
+    def locate(self, index):
+        for orientation, bucket, start in reversed(self.layout):
+            if index >= start:
+                return orientation, bucket, index - start
+        raise IndexError(index)
+
+    def size(self):
+        orientation, bucket, start = self.layout[-1]
+        return start + len(bucket)
+
+    def pick(self):
+        if self.alias is None:
+            return self.locate(random.randrange(self.size()))
+        return self.locate(self.alias.pick())
+
+
+class WeightedSelector:
+    """
+    Args:
+        mode (str): 基础权重, 见 MODES
+        explicit (dict): config.toml 中的显式权重
+        weights_file (str): 显式权重文件, 不存在时忽略
+        half_life (float): popularity 模式下访问次数的半衰期（秒）
+        interval (float): popularity 模式下重新计算权重的最短间隔（秒）
+    """
+
+    def __init__(self, mode="directory", explicit=None, weights_file=None, half_life=86400, interval=60):
+        if mode not in MODES:
+            raise ValueError(f"Invalid weights mode '{mode}'")
+        self.mode = mode
+        self.config_weights = {key: float(value) for key, value in (explicit or {}).items()}
+        self.weights_file = weights_file
+        self.half_life = half_life
+        self.interval = interval
+        self.explicit = dict(self.config_weights)
+        # 有文件级显式权重的目录
+        self._file_dirs = frozenset()
+        self._file_key = None
+        self._checked = 0.0
+        # 显式权重每次变化时递增
+        self._version = 0
+        # {"类型/方向/文件名": (访问次数, 更新时间)}
+        self._hits = {}
+        # {(img_type, orientation): _Table}, orientation 为 None 表示整个类型
+        self._tables = {}
+        # {orientation: (各类型的表, 类型别名表)}
+        self._type_tables = {}
+        self._lock = threading.Lock()
+        self._refresh_explicit(force=True)
+
+    @property
+    def active(self):
+        """
+        为 False 时各类型内的选择与原有规则完全一致, 不需要别名表
+        """
+        return self.mode != "directory" or bool(self.explicit)
+
+    def _refresh_explicit(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked < CHECK_INTERVAL:
+            return
+        self._checked = now
+        try:
+            st = os.stat(self.weights_file) if self.weights_file else None
+        except OSError:
+            st = None
+        file_key = None if st is None else (st.st_mtime_ns, st.st_size, st.st_ino)
+        if file_key == self._file_key and not force:
+            return
+        explicit = dict(self.config_weights)
+        if st is not None:
+            try:
+                with open(self.weights_file, "rb") as f:
+                    explicit.update({key: float(value) for key, value in tomllib.load(f).items()})
+            except (OSError, ValueError, TypeError):
+                # 文件正在编辑, 保留上一次的权重
+                return
+        self.explicit = explicit
+        self._file_dirs = frozenset(key.rsplit("/", 1)[0] for key in explicit if key.count("/") == 2)
+        self._file_key = file_key
+        self._version += 1
+
+    def _score(self, key, now):
+        hit = self._hits.get(key)
+        if hit is None:
+            return 0.0
+        count, updated = hit
+        return count * 0.5 ** ((now - updated) / self.half_life)
+
+    def record_hit(self, entry):
+        """
+        popularity 模式下记录一次访问
+        """
+        if self.mode != "popularity":
+            return
+        key = f"{entry.img_type}/{entry.orientation}/{entry.filename}"
+        now = time.time()
+        self._hits[key] = (self._score(key, now) + 1.0, now)
+
+    def _dir_weights(self, img_type, orientation, bucket, now):
+        """
+        Returns:
+            list: 目录中每张图片的权重, 所有权重相同时返回 (权重, 数量)
+        """
+        explicit = self.explicit
+        prefix = f"{img_type}/{orientation}"
+        factor = explicit.get(img_type, 1.0) * explicit.get(prefix, 1.0)
+        if self.mode == "directory":
+            factor /= len(bucket)
+        if self.mode != "popularity" and prefix not in self._file_dirs:
+            return factor, len(bucket)
+        weights = []
+        for name, _ in bucket.items():
+            key = f"{prefix}/{name}"
+            weight = factor * explicit.get(key, 1.0)
+            if self.mode == "popularity":
+                weight *= 1.0 + self._score(key, now)
+            weights.append(weight)
+        return weights
+
+    def _stamp(self, catalog, img_type):
+        stamp = (catalog.type_generation(img_type), self._version)
+        if self.mode == "popularity":
+            stamp += (int(time.time() // self.interval),)
+        return stamp
+
+    def _build(self, catalog, img_type, orientation, stamp):
+        orientations = catalog.buckets.get(img_type, {})
+        now = time.time()
+        layout = []
+        parts = []
+        start = 0
+        for o in (orientation,) if orientation else ORIENTATIONS:
+            bucket = orientations.get(o)
+            if not bucket:
+                continue
+            layout.append((o, bucket, start))
+            parts.append(self._dir_weights(img_type, o, bucket, now))
+            start += len(bucket)
+        if not layout:
+            return _Table(stamp, None, layout, 0.0)
+
+        if all(isinstance(part, tuple) for part in parts) and len({w for w, _ in parts}) == 1:
+            weight, _ = parts[0]
+            if weight <= 0:
+                return _Table(stamp, None, [], 0.0)
+            return _Table(stamp, None, layout, weight * start)
+        weights = []
+        for part in parts:
+            weights.extend([part[0]] * part[1] if isinstance(part, tuple) else part)
+        total = sum(weights)
+        if total <= 0:
+            return _Table(stamp, None, [], 0.0)
+        return _Table(stamp, AliasTable(weights), layout, total)
+
+    def table(self, catalog, img_type, orientation=None):
+        """
+        返回类型 (或 类型/方向) 的别名表, 图片或权重变化后重建
+        """
+        self._refresh_explicit()
+        stamp = self._stamp(catalog, img_type)
+        table = self._tables.get((img_type, orientation))
+        if table is None or table.stamp != stamp:
+            with self._lock:
+                table = self._tables.get((img_type, orientation))
+                if table is None or table.stamp != stamp:
+                    table = self._tables[img_type, orientation] = self._build(
+                        catalog, img_type, orientation, stamp
+                    )
+        return table
+
+    def _entry(self, catalog, img_type, table):
+        # 与增量删除并发时下标可能失效, 重试即可
+        for _ in range(3):
+            if not table.layout:
+                return None
+            orientation, bucket, pos = table.pick()
+            try:
+                return catalog.entry_at(img_type, orientation, bucket, pos)
+            except IndexError:
+                continue
+        return None
+
+    def pick(self, catalog, img_type, orientation=None):
+        """
+        按权重选择一张图片, 指定方向没有图片时回退到另一个方向
+
+        Returns:
+            ImageEntry: 没有图片时返回 None
+        """
+        if not self.active:
+            return catalog.pick(img_type, orientation)
+        table = self.table(catalog, img_type, orientation)
+        if not table.layout and orientation:
+            table = self.table(catalog, img_type)
+        return self._entry(catalog, img_type, table)
+
+    def sample(self, catalog, img_type, orientation=None, k=1):
+        """
+        按权重依次不放回地选择至多 k 张图片
+
+        Returns:
+            list: [ImageEntry, ...]
+        """
+        if k == 1:
+            entry = self.pick(catalog, img_type, orientation)
+            return [] if entry is None else [entry]
+        table = self.table(catalog, img_type, orientation)
+        if not table.layout and orientation:
+            table = self.table(catalog, img_type)
+        chosen = {}
+        for _ in range(_SAMPLE_ATTEMPTS * k):
+            if len(chosen) >= k or not table.layout:
+                break
+            entry = self._entry(catalog, img_type, table)
+            if entry is not None:
+                chosen.setdefault((entry.orientation, entry.filename), entry)
+        return list(chosen.values())
+
+    def _type_table(self, catalog, orientation):
+        tables = [(t, self.table(catalog, t, orientation)) for t in catalog.types]
+        tables = [(t, table) for t, table in tables if table.total > 0]
+        cached = self._type_tables.get(orientation)
+        # 各类型的表未重建时沿用
+        if cached is not None and len(cached[0]) == len(tables) and all(
+            a is b for (_, a), (_, b) in zip(cached[0], tables)
+        ):
+            return cached[1], cached[0]
+        alias = AliasTable([table.total for _, table in tables]) if tables else None
+        self._type_tables[orientation] = (tables, alias)
+        return alias, tables
+
+    def sample_any(self, catalog, orientation=None, k=1):
+        """
+        跨类型按权重选择至多 k 张图片: 先按各类型的总权重选择类型, 再在类型内选择;
+        指定方向没有图片时不限方向
+
+        Returns:
+            list: [ImageEntry, ...]
+        """
+        alias, tables = self._type_table(catalog, orientation)
+        if alias is None and orientation:
+            alias, tables = self._type_table(catalog, None)
+        if alias is None:
+            return []
+        chosen = {}
+        for _ in range(_SAMPLE_ATTEMPTS * k):
+            if len(chosen) >= k:
+                break
+            img_type, table = tables[alias.pick()]
+            entry = self._entry(catalog, img_type, table)
+            if entry is not None:
+                chosen.setdefault((img_type, entry.orientation, entry.filename), entry)
+        return list(chosen.values())
+
+
+def init_selector(app, mode, explicit, weights_file, half_life, interval):
+    selector = WeightedSelector(mode, explicit, weights_file, half_life, interval)
+    app.extensions["image_selector"] = selector
+    return selector
+
+
+def get_selector():
+    return current_app.extensions.get("image_selector")
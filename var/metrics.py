@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+运行指标与 Prometheus 文本格式的 /metrics 接口
+
+每个进程 (gunicorn 主进程和各工作进程) 把自己的计数写入指标目录下独立的 mmap 文件,
+写入只在本进程内加锁; /metrics 被任意工作进程处理时读取目录下全部文件并求和,
+因此得到的是所有工作进程的汇总值
+
+文件布局 (小端):
+    header  : 已使用字节数
+    entries : 键长度 (u32), 键 (JSON, 补齐到 8 字节), 值 (f64)
+"""
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+from flask import Response, g, request
+
+
+FILE_PREFIX = "metrics_"
+INITIAL_SIZE = 64 * 1024
+
+# 延迟直方图的上界（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SCAN_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+_USED = struct.Struct("<Q")
+_KEY_LEN = struct.Struct("<I")
+_VALUE = struct.Struct("<d")
+
+_directory = None
+_store = None
+_store_lock = threading.Lock()
+
+
+class _ValueFile:
+    """
+    单个进程的指标文件, {key: offset} 记录每个值在文件中的位置
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.positions = {}
+        # 同一 pid 的旧文件 (上次运行遗留) 直接覆盖
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, INITIAL_SIZE)
+            self.mm = mmap.mmap(fd, INITIAL_SIZE)
+        finally:
+            os.close(fd)
+        self.used = _USED.size
+        _USED.pack_into(self.mm, 0, self.used)
+
+    def _grow(self, needed):
+        size = len(self.mm)
+        while size < needed:
+            size *= 2
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            os.ftruncate(fd, size)
+            mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.mm.close()
+        self.mm = mm
+
+    def _position(self, key):
+        pos = self.positions.get(key)
+        if pos is None:
+            encoded = json.dumps(key).encode("utf-8")
+            padded = len(encoded) + (-(_KEY_LEN.size + len(encoded)) % 8)
+            entry_size = _KEY_LEN.size + padded + _VALUE.size
+            if self.used + entry_size > len(self.mm):
+                self._grow(self.used + entry_size)
+            _KEY_LEN.pack_into(self.mm, self.used, len(encoded))
+            start = self.used + _KEY_LEN.size
+            self.mm[start:start + len(encoded)] = encoded
+            pos = start + padded
+            _VALUE.pack_into(self.mm, pos, 0.0)
+            # 条目写完之后再更新已使用字节数, 读取方不会看到不完整的条目
+            self.used += entry_size
+            _USED.pack_into(self.mm, 0, self.used)
+            self.positions[key] = pos
+        return pos
+
+    def inc(self, key, amount):
+        with self.lock:
+            pos = self._position(key)
+            _VALUE.pack_into(self.mm, pos, _VALUE.unpack_from(self.mm, pos)[0] + amount)
+
+
+def _read_file(path):
+    """
+    读取一个指标文件, 返回 [(key, value), ...]
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return []
+    if len(data) < _USED.size:
+        return []
+    used = min(_USED.unpack_from(data, 0)[0], len(data))
+    values = []
+    pos = _USED.size
+    while pos + _KEY_LEN.size <= used:
+        key_len = _KEY_LEN.unpack_from(data, pos)[0]
+        start = pos + _KEY_LEN.size
+        value_pos = start + key_len + (-(_KEY_LEN.size + key_len) % 8)
+        if value_pos + _VALUE.size > used:
+            break
+        name, suffix, labelvalues, index = json.loads(data[start:start + key_len])
+        key = (name, suffix, tuple(labelvalues), index)
+        values.append((key, _VALUE.unpack_from(data, value_pos)[0]))
+        pos = value_pos + _VALUE.size
+    return values
+
+
+def _get_store():
+    """
+    返回当前进程的指标文件, fork 之后的子进程创建自己的文件
+    """
+    global _store
+    if _directory is None:
+        return None
+    store = _store
+    if store is None or store.pid != os.getpid():
+        with _store_lock:
+            store = _store
+            if store is None or store.pid != os.getpid():
+                store = _ValueFile(os.path.join(_directory, f"{FILE_PREFIX}{os.getpid()}.db"))
+                _store = store
+    return store
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _METRICS[name] = self
+
+
+class Counter(_Metric):
+    """
+    只增不减的计数器
+    """
+
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        store = _get_store()
+        if store is not None:
+            store.inc((self.name, "", labelvalues, None), amount)
+
+
+class Histogram(_Metric):
+    """
+    直方图, 每个区间单独计数, 输出时再累加为 Prometheus 的累计区间
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        store = _get_store()
+        if store is None:
+            return
+        index = bisect_left(self.buckets, value)
+        store.inc((self.name, "_bucket", labelvalues, index), 1)
+        store.inc((self.name, "_sum", labelvalues, None), value)
+        store.inc((self.name, "_count", labelvalues, None), 1)
+
+
+_METRICS = {}
+
+REQUEST_SECONDS = Histogram(
+    "hcanranbapi_request_duration_seconds",
+    "Time spent handling a request until the response headers are ready",
+    ("endpoint", "method"),
+)
+REQUESTS = Counter(
+    "hcanranbapi_requests_total", "Handled requests", ("endpoint", "method", "status")
+)
+RESPONSE_BYTES = Counter(
+    "hcanranbapi_response_bytes_total", "Response body bytes sent", ("endpoint",)
+)
+CACHE_REQUESTS = Counter(
+    "hcanranbapi_cache_requests_total", "Cache lookups", ("cache", "result")
+)
+CATALOG_SCANS = Counter(
+    "hcanranbapi_catalog_scans_total", "Directory scans", ("catalog", "kind")
+)
+CATALOG_SCAN_SECONDS = Histogram(
+    "hcanranbapi_catalog_scan_duration_seconds",
+    "Directory scan duration",
+    ("catalog", "kind"),
+    SCAN_BUCKETS,
+)
+RATELIMIT_REJECTIONS = Counter(
+    "hcanranbapi_ratelimit_rejections_total", "Requests rejected by the rate limiter", ("endpoint",)
+)
+
+
+class timed_scan:
+    """
+    记录一次目录扫描的次数和耗时
+
+        with timed_scan("image", "full"):
+            ...
+    """
+
+    def __init__(self, catalog, kind):
+        self.labels = (catalog, kind)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        CATALOG_SCANS.inc(*self.labels)
+        CATALOG_SCAN_SECONDS.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'le="{"+Inf" if extra == math.inf else repr(float(extra))}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def collect():
+    """
+    汇总指标目录下所有进程的指标, 生成 Prometheus 文本格式
+    """
+    totals = {}
+    if _directory is not None and os.path.isdir(_directory):
+        for name in os.listdir(_directory):
+            if name.startswith(FILE_PREFIX):
+                for key, value in _read_file(os.path.join(_directory, name)):
+                    totals[key] = totals.get(key, 0.0) + value
+
+    grouped = {}
+    for (name, suffix, labelvalues, index), value in totals.items():
+        grouped.setdefault(name, {}).setdefault(labelvalues, {})[(suffix, index)] = value
+
+    lines = []
+    for name, metric in _METRICS.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for labelvalues, values in sorted(grouped.get(name, {}).items()):
+            if metric.kind == "counter":
+                lines.append(
+                    f"{name}{_format_labels(metric.labelnames, labelvalues)} "
+                    f"{_format_value(values[('', None)])}"
+                )
+                continue
+            cumulative = 0.0
+            for index, bound in enumerate(metric.buckets + (math.inf,)):
+                cumulative += values.get(("_bucket", index), 0.0)
+                lines.append(
+                    f"{name}_bucket{_format_labels(metric.labelnames, labelvalues, bound)} "
+                    f"{_format_value(cumulative)}"
+                )
+            for suffix in ("_sum", "_count"):
+                lines.append(
+                    f"{name}{suffix}{_format_labels(metric.labelnames, labelvalues)} "
+                    f"{_format_value(values.get((suffix, None), 0.0))}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+def _remove_stale_files(directory):
+    """
+    删除已退出进程 (上次运行) 留下的指标文件
+    """
+    for name in os.listdir(directory):
+        if not name.startswith(FILE_PREFIX):
+            continue
+        try:
+            pid = int(name[len(FILE_PREFIX):].split(".", 1)[0])
+            os.kill(pid, 0)
+        except (ValueError, ProcessLookupError):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+        except PermissionError:
+            # 进程存在但属于其他用户
+            pass
+
+
+def _record_request(response):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return response
+    endpoint = request.endpoint or "none"
+    REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, request.method)
+    REQUESTS.inc(endpoint, request.method, str(response.status_code))
+
+    length = response.content_length
+    if length is not None:
+        RESPONSE_BYTES.inc(endpoint, amount=length)
+    elif response.is_streamed and not response.direct_passthrough:
+        response.response = _count_bytes(response.response, endpoint)
+    return response
+
+
+def _count_bytes(body, endpoint):
+    """
+    流式响应按实际发出的字节数计数
+    """
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+        RESPONSE_BYTES.inc(endpoint, amount=sent)
+
+
+def init_metrics(app, directory):
+    """
+    启用指标收集, 注册请求计时钩子
+
+    Args:
+        app: Flask 应用
+        directory (str): 各进程指标文件所在目录, 为空时不启用
+    """
+    global _directory
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    _remove_stale_files(directory)
+    _directory = directory
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    app.after_request(_record_request)
+    app.extensions["metrics_dir"] = directory
+    return directory
+
+
+def metrics_response():
+    return Response(collect(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+汇总类接口的响应缓存
+
+/api/img/count、/api/img/types 等接口的结果只随索引变化, 按索引代数缓存序列化好的
+JSON 字节串和 ETag, 同一代数内的请求直接返回缓存内容, 客户端带 ETag 时返回 304
+"""
+import hashlib
+from flask import current_app, request
+from .metrics import CACHE_REQUESTS
+
+
+# 仪表盘轮询的接口, 每次都重新验证, 未变化时为 304
+CACHE_CONTROL = "no-cache"
+
+
+class ResponseCache:
+    """
+    {key: (generation, body, etag)}
+    """
+
+    def __init__(self):
+        self._items = {}
+
+    def get(self, key, generation, build):
+        """
+        返回 (body, etag), 代数变化时调用 build() 重新生成
+        """
+        cached = self._items.get(key)
+        if cached is not None and cached[0] == generation:
+            CACHE_REQUESTS.inc("response", "hit")
+            return cached[1], cached[2]
+        CACHE_REQUESTS.inc("response", "miss")
+
+        # 与 jsonify 的输出保持一致
+        body = current_app.json.response(build()).get_data()
+        etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+        self._items[key] = (generation, body, etag)
+        return body, etag
+
+    def clear(self):
+        self._items.clear()
+
+
+def get_response_cache():
+    cache = current_app.extensions.get("response_cache")
+    if cache is None:
+        cache = current_app.extensions["response_cache"] = ResponseCache()
+    return cache
+
+
+def cached_json(key, generation, build):
+    """
+    以缓存的 JSON 字节串构建响应
+
+    Args:
+        key (str): 缓存键, 通常为接口路径
+        generation (int): 数据所依赖的索引代数
+        build (callable): 生成响应数据的函数, 只在代数变化时调用
+    """
+    body, etag = get_response_cache().get(key, generation, build)
+
+    rv = current_app.response_class(mimetype="application/json")
+    rv.set_etag(etag)
+    rv.headers["Cache-Control"] = CACHE_CONTROL
+    if request.if_none_match.contains_weak(etag):
+        rv.status_code = 304
+        return rv
+    rv.set_data(body)
+    return rv
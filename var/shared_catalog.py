@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 多工作进程共享的索引文件
+
+主进程 (preload 之后) 负责扫描目录和监听变化, 把图片/文本索引序列化为只读的
+紧凑文件 (定长记录 + 字符串表), 各工作进程以 mmap 方式映射同一份文件;
+catalog.gen 中的代数计数器变化时, 工作进程在下一次访问索引时切换到新文件
+
+同一格式也用作启动快照 ([catalog] persist): 启动时保存索引和各类型目录的状态,
+下次启动时目录状态未变化的类型直接映射快照中的记录, 不再扫描目录
+
+文件布局 (小端):
+    header   : magic, version, flags, generation, group 数量, 字符串表偏移
+    groups   : 每个 类型/方向 一条定长记录, 指向该组的记录区间; 每个图片类型另有一条类型标记组,
+               其 count 字段为该类型最后一次变化时的版本 (低 32 位), 工作进程据此判断哪些类型变化了
+    records  : 图片为 (name_off, name_len, size, mtime, inode), 文本为 (name_off, name_len);
+               组内按文件名字节序排序, 按名查找为二分查找
+    strings  : 文件名/类型名的字节串
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+
+MAGIC = b"HCRBCAT\0"
+VERSION = 1
+
+KIND_IMAGE = 0
+KIND_TEXT = 1
+# 类型标记组, 用来记录没有任何方向目录的图片类型
+NO_ORIENTATION = 255
+ORIENTATION_CODES = {"horizontal": 0, "vertical": 1}
+ORIENTATION_NAMES = {code: name for name, code in ORIENTATION_CODES.items()}
+
+SNAPSHOT_NAME = "catalog.bin"
+GENERATION_NAME = "catalog.gen"
+# 启动快照的目录状态文件格式版本
+BOOT_VERSION = 1
+# 由主进程对齐、工作进程读取索引文件的派生索引 (app.extensions 中的名称)
+DERIVED_INDEXES = ("image_metadata", "image_dedup")
+
+_HEADER = struct.Struct("<8sIIQQQ")
+_GROUP = struct.Struct("<BBHIIIQ")
+_IMAGE_RECORD = struct.Struct("<IIQdQ")
+_TEXT_RECORD = struct.Struct("<II")
+_GENERATION = struct.Struct("<Q")
+
+
+class _MappedImageBucket:
+    """
+    映射文件中的一个 类型/方向 组, 接口与 img_utils._ImageBucket 的只读部分一致
+    """
+
+    __slots__ = ("mm", "strings_off", "records_off", "count")
+
+    def __init__(self, mm, strings_off, records_off, count):
+        self.mm = mm
+        self.strings_off = strings_off
+        self.records_off = records_off
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def _name_bytes(self, pos):
+        # 图片记录的前两个字段与文本记录相同, 只解出文件名部分
+        name_off, name_len = _TEXT_RECORD.unpack_from(
+            self.mm, self.records_off + pos * _IMAGE_RECORD.size
+        )
+        start = self.strings_off + name_off
+        return self.mm[start:start + name_len]
+
+    def record(self, pos):
+        if not 0 <= pos < self.count:
+            raise IndexError(pos)
+        name_off, name_len, size, mtime, inode = _IMAGE_RECORD.unpack_from(
+            self.mm, self.records_off + pos * _IMAGE_RECORD.size
+        )
+        start = self.strings_off + name_off
+        return os.fsdecode(self.mm[start:start + name_len]), size, mtime, inode
+
+    def _bisect_right(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < self._name_bytes(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def find(self, filename):
+        key = os.fsencode(filename)
+        pos = self._bisect_right(key) - 1
+        if pos >= 0 and self._name_bytes(pos) == key:
+            return pos
+        return -1
+
+    def items(self):
+        for pos in range(self.count):
+            name, size, _, _ = self.record(pos)
+            yield name, size
+
+    def iter_sorted(self, after=None):
+        # 组内记录本身就按文件名排序
+        start = 0 if after is None else self._bisect_right(os.fsencode(after))
+        for pos in range(start, self.count):
+            name, size, _, _ = self.record(pos)
+            yield name, size
+
+    def export(self):
+        """
+        write_snapshot 按记录顺序写入文件名, 组内文件名在字符串表中连续存放
+
+        Returns:
+            tuple: (记录区间的字节, 组内全部文件名的字节, 第一个文件名在字符串表中的偏移)
+        """
+        start = self.records_off
+        records = self.mm[start:start + self.count * _IMAGE_RECORD.size]
+        if not self.count:
+            return records, b"", 0
+        first, _ = _TEXT_RECORD.unpack_from(self.mm, start)
+        last, last_len = _TEXT_RECORD.unpack_from(
+            self.mm, start + (self.count - 1) * _IMAGE_RECORD.size
+        )
+        names = self.mm[self.strings_off + first:self.strings_off + last + last_len]
+        return records, names, first
+
+
+class CatalogSnapshot:
+    """
+    以只读 mmap 方式打开的索引文件
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self.mm
+
+        magic, version, _, generation, n_groups, strings_off = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Invalid catalog snapshot '{path}'")
+        self.generation = generation
+
+        # {img_type: {orientation: _MappedImageBucket}}
+        self.image_buckets = {}
+        # {img_type: 类型版本}
+        self.type_generations = {}
+        # {text_type: [filename, ...]}
+        self.text_names = {}
+
+        offset = _HEADER.size
+        for _ in range(n_groups):
+            kind, orientation, _, name_off, name_len, count, records_off = (
+                _GROUP.unpack_from(mm, offset)
+            )
+            offset += _GROUP.size
+            start = strings_off + name_off
+            group_name = os.fsdecode(mm[start:start + name_len])
+
+            if kind == KIND_IMAGE:
+                orientations = self.image_buckets.setdefault(group_name, {})
+                if orientation == NO_ORIENTATION:
+                    self.type_generations[group_name] = count
+                else:
+                    orientations[ORIENTATION_NAMES[orientation]] = _MappedImageBucket(
+                        mm, strings_off, records_off, count
+                    )
+            else:
+                names = []
+                for pos in range(count):
+                    n_off, n_len = _TEXT_RECORD.unpack_from(
+                        mm, records_off + pos * _TEXT_RECORD.size
+                    )
+                    n_start = strings_off + n_off
+                    names.append(os.fsdecode(mm[n_start:n_start + n_len]))
+                self.text_names[group_name] = names
+
+        self.image_types = tuple(sorted(self.image_buckets))
+        self.text_types = tuple(sorted(self.text_names))
+
+
+def _collect(image_catalog, text_catalog):
+    """
+    在索引锁内复制一份一致的数据, 序列化在锁外进行; 映射的组只读, 不需要复制
+    """
+    images = []
+    with image_catalog.lock:
+        for img_type, orientations in image_catalog.buckets.items():
+            groups = {}
+            for orientation, bucket in orientations.items():
+                if isinstance(bucket, _MappedImageBucket):
+                    groups[orientation] = bucket
+                else:
+                    groups[orientation] = [bucket.record(pos) for pos in range(len(bucket))]
+            type_generation = image_catalog.type_generation(img_type) & 0xFFFFFFFF
+            images.append((img_type, type_generation, groups))
+
+    texts = []
+    with text_catalog.lock:
+        for text_type, bucket in text_catalog.buckets.items():
+            texts.append((text_type, list(bucket.names)))
+    return images, texts
+
+
+def _rebase(records, delta):
+    """
+    把图片记录中的文件名偏移 (每条记录的第一个字段) 统一加上 delta
+    """
+    words = array("I", records)
+    if sys.byteorder != "little":
+        words.byteswap()
+    step = _IMAGE_RECORD.size // words.itemsize
+    words[::step] = array("I", [offset + delta for offset in words[::step]])
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words.tobytes()
+
+
+def write_snapshot(path, generation, image_catalog, text_catalog):
+    """
+    序列化索引并以原子替换的方式写入 path
+    """
+    images, texts = _collect(image_catalog, text_catalog)
+
+    strings = bytearray()
+    groups = []
+    records = bytearray()
+
+    def add_string(value):
+        data = os.fsencode(value)
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    for img_type, type_generation, orientations in sorted(images, key=lambda item: item[0]):
+        name_off, name_len = add_string(img_type)
+        groups.append((KIND_IMAGE, NO_ORIENTATION, name_off, name_len, type_generation, 0))
+        for orientation, rows in orientations.items():
+            if isinstance(rows, _MappedImageBucket):
+                # 已排序的映射组整段复制, 只调整文件名偏移
+                data, names, first = rows.export()
+                groups.append((
+                    KIND_IMAGE, ORIENTATION_CODES[orientation],
+                    name_off, name_len, len(rows), len(records),
+                ))
+                records.extend(_rebase(data, len(strings) - first))
+                strings.extend(names)
+                continue
+            rows = sorted((os.fsencode(row[0]), row) for row in rows)
+            groups.append((
+                KIND_IMAGE, ORIENTATION_CODES[orientation],
+                name_off, name_len, len(rows), len(records),
+            ))
+            for encoded, (_, size, mtime, inode) in rows:
+                records.extend(_IMAGE_RECORD.pack(len(strings), len(encoded), size, mtime, inode))
+                strings.extend(encoded)
+
+    for text_type, names in sorted(texts):
+        name_off, name_len = add_string(text_type)
+        groups.append((KIND_TEXT, NO_ORIENTATION, name_off, name_len, len(names), len(records)))
+        for name in sorted(names):
+            n_off, n_len = add_string(name)
+            records.extend(_TEXT_RECORD.pack(n_off, n_len))
+
+    records_base = _HEADER.size + _GROUP.size * len(groups)
+    strings_off = records_base + len(records)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, generation, len(groups), strings_off))
+        for kind, orientation, name_off, name_len, count, rel_off in groups:
+            f.write(_GROUP.pack(
+                kind, orientation, 0, name_off, name_len, count, records_base + rel_off
+            ))
+        f.write(records)
+        f.write(strings)
+    os.replace(tmp_path, path)
+
+
+# 启动快照: snapshot 为 CatalogSnapshot, *_stamps 为保存时 {类型: 目录状态}
+BootSnapshot = namedtuple("BootSnapshot", ["snapshot", "image_stamps", "text_stamps"])
+
+
+def _stamps_path(path):
+    return os.path.splitext(path)[0] + ".json"
+
+
+def _boot_config(image_base, text_base, allowed_extensions):
+    # 这些配置变化后快照中的索引不再适用
+    return {
+        "image_base": image_base,
+        "text_base": text_base,
+        "extensions": sorted(ext.lower() for ext in allowed_extensions),
+    }
+
+
+def load_boot_snapshot(path, image_base, text_base, allowed_extensions):
+    """
+    映射上次启动时保存的索引快照
+
+    Returns:
+        BootSnapshot: 文件不存在、版本或配置不同、与目录状态文件不匹配时返回 None
+    """
+    try:
+        with open(_stamps_path(path), "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("version") != BOOT_VERSION or state.get("config") != _boot_config(
+            image_base, text_base, allowed_extensions
+        ):
+            return None
+        st = os.stat(path)
+        if state.get("snapshot") != [st.st_ino, st.st_size, st.st_mtime_ns]:
+            return None
+        snapshot = CatalogSnapshot(path)
+        return BootSnapshot(snapshot, state["image"], state["text"])
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        return None
+
+
+def save_boot_snapshot(path, image_catalog, text_catalog, boot=None):
+    """
+    保存索引快照和各类型的目录状态 (先写快照再写状态文件), 供下次启动时加载;
+    所有类型都沿用了 boot 中的记录时不需要重写
+
+    Returns:
+        bool: 是否写入
+    """
+    if boot is not None and (boot.image_stamps, boot.text_stamps) == (
+        image_catalog.dir_stamps, text_catalog.dir_stamps
+    ):
+        return False
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    write_snapshot(path, 0, image_catalog, text_catalog)
+    st = os.stat(path)
+    state = {
+        "version": BOOT_VERSION,
+        "config": _boot_config(
+            image_catalog.image_base, text_catalog.text_base, image_catalog.allowed_extensions
+        ),
+        "snapshot": [st.st_ino, st.st_size, st.st_mtime_ns],
+        "image": image_catalog.dir_stamps,
+        "text": text_catalog.dir_stamps,
+    }
+    stamps_path = _stamps_path(path)
+    tmp_path = f"{stamps_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, stamps_path)
+    return True
+
+
+def boot_summary(boot, image_catalog, text_catalog):
+    """
+    启动报告中的快照使用情况
+
+    Returns:
+        dict: {"image_types": [沿用快照的类型数, 类型总数], "text_types": [...]}
+    """
+    def reused(stamps, catalog):
+        saved = {} if boot is None else stamps
+        count = sum(1 for t, stamp in catalog.dir_stamps.items() if saved.get(t) == stamp)
+        return [count, len(catalog.types)]
+
+    return {
+        "image_types": reused(boot and boot.image_stamps, image_catalog),
+        "text_types": reused(boot and boot.text_stamps, text_catalog),
+    }
+
+
+def _open_generation_file(directory):
+    path = os.path.join(directory, GENERATION_NAME)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size < mmap.PAGESIZE:
+            os.ftruncate(fd, mmap.PAGESIZE)
+        return mmap.mmap(fd, mmap.PAGESIZE)
+    finally:
+        os.close(fd)
+
+
+class SnapshotPublisher:
+    """
+    主进程侧: 发布索引文件, 目录变化后合并一小段时间内的变更再发布
+    """
+
+    def __init__(self, directory, image_catalog, text_catalog, delay=0.5):
+        self.directory = directory
+        self.image_catalog = image_catalog
+        self.text_catalog = text_catalog
+        self.delay = delay
+        os.makedirs(directory, exist_ok=True)
+        self.generation_mm = _open_generation_file(directory)
+        self._event = threading.Event()
+        self._thread = None
+
+    def publish(self):
+        generation = _GENERATION.unpack_from(self.generation_mm, 0)[0] + 1
+        write_snapshot(
+            os.path.join(self.directory, SNAPSHOT_NAME),
+            generation, self.image_catalog, self.text_catalog,
+        )
+        # 先替换文件再更新代数, 工作进程看到新代数时文件一定已经就绪
+        _GENERATION.pack_into(self.generation_mm, 0, generation)
+        return generation
+
+    def notify(self):
+        self._event.set()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="catalog-publisher", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            time.sleep(self.delay)
+            self._event.clear()
+            try:
+                self.publish()
+            except OSError:
+                # 下一次变化时重试
+                pass
+
+
+class SnapshotReader:
+    """
+    工作进程侧: 跟随 catalog.gen 中的代数, 变化时重新映射索引文件
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.generation_mm = _open_generation_file(directory)
+        self.seen = None
+        self.snapshot = None
+
+    def current(self):
+        generation = _GENERATION.unpack_from(self.generation_mm, 0)[0]
+        if generation != self.seen:
+            try:
+                self.snapshot = CatalogSnapshot(os.path.join(self.directory, SNAPSHOT_NAME))
+                self.seen = generation
+            except (OSError, ValueError):
+                # 文件暂不可用时继续使用旧的映射
+                if self.snapshot is None:
+                    raise
+        return self.snapshot
+
+
+def serve_master(app, directory, delay=0.5):
+    """
+    gunicorn when_ready 钩子中调用: 主进程负责监听目录并发布共享索引
+    """
+    image_catalog = app.extensions["image_catalog"]
+    text_catalog = app.extensions["text_catalog"]
+    publisher = SnapshotPublisher(directory, image_catalog, text_catalog, delay)
+    publisher.publish()
+    publisher.start()
+
+    watcher = app.extensions["catalog_watcher"]
+    # 工作进程不再各自监听, 只有主进程在监听
+    watcher.follow_forks = False
+    watcher.listeners.append(publisher.notify)
+    watcher.ensure_running()
+    # 派生索引也只由主进程对齐, 工作进程读取保存的索引文件
+    for name in DERIVED_INDEXES:
+        index = app.extensions.get(name)
+        if index is not None:
+            index.lead(image_catalog, watcher)
+
+    app.extensions["catalog_publisher"] = publisher
+    app.extensions["shared_catalog_dir"] = directory
+    return publisher
+
+
+def attach_worker(app):
+    """
+    gunicorn post_fork 钩子中调用: 工作进程改为读取主进程发布的共享索引
+    """
+    from .img import img_utils
+    from .text import text_utils
+
+    directory = app.extensions.get("shared_catalog_dir")
+    if directory is None:
+        return
+    reader = SnapshotReader(directory)
+    image_catalog = app.extensions["image_catalog"]
+    text_catalog = app.extensions["text_catalog"]
+    app.extensions["image_catalog"] = img_utils.SharedImageCatalog(
+        image_catalog.image_base, image_catalog.allowed_extensions, reader
+    )
+    app.extensions["text_catalog"] = text_utils.SharedTextCatalog(
+        text_catalog.text_base, reader
+    )
+    app.extensions.pop("catalog_publisher", None)
+    for name in DERIVED_INDEXES:
+        index = app.extensions.get(name)
+        if index is not None:
+            index.follow()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+多工作进程共享的限流计数存储 (limits 的 shm:// 存储后端)
+
+memory:// 存储在每个 gunicorn 工作进程中各有一份计数, 客户端实际可用的次数是
+requests_per_minute 的 N 倍; 这里把计数放在所有进程共同映射的文件中:
+
+    - 文件按 set 划分, 限流键的哈希决定所在的 set
+    - 每个 set 内为每个进程 (列) 预留若干个计数槽, 每个进程只写自己的列,
+      进程之间不需要加锁; 读取时把同一个键在各列中的计数相加
+    - 计数槽为 (tag, window, expiry, counts), counts 的高 32 位为当前窗口计数,
+      低 32 位为上一个窗口计数, 以一次 8 字节写入同时更新
+
+按滑动窗口计数 (sliding-window-counter) 策略判断: 上一个窗口的计数按剩余比例加权,
+再加上当前窗口的计数; 并发进程同时通过检查时与 memory:// 一样在写入后复查并回退
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from functools import lru_cache
+from math import floor
+from limits.storage import SlidingWindowCounterSupport, Storage
+
+
+MAGIC = b"HCRBRLM\0"
+VERSION = 1
+
+# 头部占一页: magic, version, set 数量, 每列槽数, 列数, 之后为各列所属进程的 pid
+_HEADER = struct.Struct("<8sIIII")
+HEADER_SIZE = mmap.PAGESIZE
+# 每个计数槽 4 个 u64
+_CELL_FIELDS = 4
+_COUNT_SHIFT = 32
+_COUNT_MASK = (1 << _COUNT_SHIFT) - 1
+
+
+@lru_cache(maxsize=65536)
+def _tag(key):
+    """
+    限流键的 64 位哈希, 0 保留表示空槽
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") | 1
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedMemoryStorage(Storage, SlidingWindowCounterSupport):
+    """
+    基于共享 mmap 文件的限流存储
+
+        storage_uri = "shm:///path/to/ratelimit.bin"
+
+    Args:
+        uri (str): shm:// 加文件的绝对路径
+        sets (int): set 数量, 同时活跃的客户端越多需要越大
+        ways (int): 每个进程在每个 set 中的计数槽数
+        writers (int): 列数, 不少于会处理请求的进程数
+    """
+
+    STORAGE_SCHEME = ["shm"]
+
+    def __init__(self, uri=None, wrap_exceptions=False, sets=4096, ways=4, writers=32, **options):
+        self.path = uri.split("://", 1)[1]
+        self.sets = int(sets)
+        self.ways = int(ways)
+        self.writers = int(writers)
+        # 一个 set 内所有列的计数槽, 以 u64 为单位
+        self._row = self.writers * self.ways * _CELL_FIELDS
+        self._base = HEADER_SIZE // 8
+        self.mm = self._open()
+        self._q = memoryview(self.mm).cast("Q")
+        self._column = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return OSError
+
+    def _open(self):
+        """
+        映射存储文件, 文件不存在或布局不同时重新初始化; 已有文件保留计数,
+        非 preload 模式下后启动的工作进程不会清空其他进程的计数
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        size = HEADER_SIZE + self.sets * self._row * 8
+        header = _HEADER.pack(MAGIC, VERSION, self.sets, self.ways, self.writers)
+        if _HEADER.size + 8 * self.writers > HEADER_SIZE:
+            raise ValueError(f"Too many rate limit writers: {self.writers}")
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size != size or os.pread(fd, _HEADER.size, 0) != header:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, header, 0)
+            return mmap.mmap(fd, size)
+        finally:
+            # mmap 复制了文件描述符, 需显式解锁
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _after_fork(self):
+        self._column = None
+        self._lock = threading.Lock()
+
+    def _claim_column(self):
+        """
+        为当前进程分配一列: 优先使用空闲列或已退出进程留下的列 (其中的计数继续有效)
+        """
+        pid = os.getpid()
+        pids_off = _HEADER.size
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            pids = struct.unpack_from(f"<{self.writers}Q", self.mm, pids_off)
+            if pid in pids:
+                column = pids.index(pid)
+            else:
+                free = [i for i, owner in enumerate(pids) if owner == 0 or not _is_alive(owner)]
+                # 列数不足时与其他进程共用一列, 并发写入可能丢失少量计数
+                column = free[0] if free else pid % self.writers
+                struct.pack_into("<Q", self.mm, pids_off + 8 * column, pid)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._column = column
+        return column
+
+    def _set_base(self, tag):
+        return self._base + (tag % self.sets) * self._row
+
+    def _cells(self, tag):
+        """
+        返回各列中属于该键的计数槽偏移
+        """
+        base = self._set_base(tag)
+        tags = self._q[base:base + self._row:_CELL_FIELDS].tolist()
+        cells = []
+        i = -1
+        while True:
+            try:
+                i = tags.index(tag, i + 1)
+            except ValueError:
+                return cells
+            cells.append(base + i * _CELL_FIELDS)
+
+    def _counts(self, tag, window):
+        """
+        Returns:
+            tuple: (上一个窗口计数, 当前窗口计数), 各列之和
+        """
+        q = self._q
+        previous = current = 0
+        for p in self._cells(tag):
+            cell_window = q[p + 1]
+            counts = q[p + 3]
+            if cell_window == window:
+                current += counts >> _COUNT_SHIFT
+                previous += counts & _COUNT_MASK
+            elif cell_window == window - 1:
+                previous += counts >> _COUNT_SHIFT
+        return previous, current
+
+    def _add(self, tag, window, expiry, amount):
+        """
+        在当前进程的列中累加计数
+        """
+        q = self._q
+        with self._lock:
+            column = self._column
+            if column is None:
+                column = self._claim_column()
+            base = self._set_base(tag) + column * self.ways * _CELL_FIELDS
+            ways = q[base:base + self.ways * _CELL_FIELDS:_CELL_FIELDS].tolist()
+            try:
+                p = base + ways.index(tag) * _CELL_FIELDS
+            except ValueError:
+                # 替换窗口最早结束的槽 (空槽为 0)
+                p = min(
+                    (base + i * _CELL_FIELDS for i in range(self.ways)),
+                    key=lambda cell: (q[cell + 1] + 1) * q[cell + 2],
+                )
+                q[p] = 0
+                q[p + 1] = window
+                q[p + 2] = expiry
+                q[p + 3] = 0
+                q[p] = tag
+
+            counts = q[p + 3]
+            cell_window = q[p + 1]
+            if cell_window == window:
+                current = max(0, (counts >> _COUNT_SHIFT) + amount)
+                q[p + 3] = (current << _COUNT_SHIFT) | (counts & _COUNT_MASK)
+            else:
+                # 进入新窗口, 原当前窗口的计数成为上一个窗口的计数
+                previous = counts >> _COUNT_SHIFT if cell_window == window - 1 else 0
+                q[p + 3] = (max(0, amount) << _COUNT_SHIFT) | previous
+                q[p + 2] = expiry
+                q[p + 1] = window
+
+    # 固定窗口 (fixed-window) 策略: 窗口按 expiry 对齐
+
+    def incr(self, key, expiry, amount=1):
+        tag = _tag(key)
+        window = int(time.time() // expiry)
+        self._add(tag, window, int(expiry), amount)
+        return self._counts(tag, window)[1]
+
+    def get(self, key):
+        tag = _tag(key)
+        cells = self._cells(tag)
+        if not cells:
+            return 0
+        expiry = self._q[cells[0] + 2]
+        return self._counts(tag, int(time.time() // expiry))[1] if expiry else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        cells = self._cells(_tag(key))
+        if not cells or not self._q[cells[0] + 2]:
+            return now
+        expiry = self._q[cells[0] + 2]
+        return (int(now // expiry) + 1) * expiry
+
+    def check(self):
+        return True
+
+    def reset(self):
+        self.mm[HEADER_SIZE:] = bytes(len(self.mm) - HEADER_SIZE)
+        return None
+
+    def clear(self, key):
+        # 清除所有列中的计数, 仅用于管理操作
+        for p in self._cells(_tag(key)):
+            self._q[p + 3] = 0
+
+    # 滑动窗口计数 (sliding-window-counter) 策略
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        tag = _tag(key)
+        window = int(now // expiry)
+        weight = 1 - (now % expiry) / expiry
+
+        previous, current = self._counts(tag, window)
+        if floor(previous * weight + current) + amount > limit:
+            return False
+        self._add(tag, window, int(expiry), amount)
+
+        previous, current = self._counts(tag, window)
+        if floor(previous * weight + current) > limit:
+            # 其他进程同时通过了检查, 回退本次计数
+            self._add(tag, window, int(expiry), -amount)
+            return False
+        return True
+
+    def get_sliding_window(self, key, expiry):
+        now = time.time()
+        previous, current = self._counts(_tag(key), int(now // expiry))
+        previous_ttl = (1 - (now % expiry) / expiry) * expiry if previous else 0.0
+        current_ttl = (1 - (now / expiry) % 1) * expiry + expiry
+        return previous, previous_ttl, current, current_ttl
+
+    def clear_sliding_window(self, key, expiry):
+        self.clear(key)
+
+
+def storage_uri(path):
+    return f"shm://{os.path.abspath(path)}"
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+不重复的随机序列 (洗牌袋)
+
+客户端开启 session 模式后, 随机图片/文本按该客户端自己的一个随机排列依次返回,
+在取完该类型的全部内容之前不会重复. 排列不需要保存: 由种子决定的 Feistel 置换可以
+直接算出第 i 个位置的元素, 客户端状态只有 (种子, 位置, 总数), 编码为一个短字符串:
+
+    ?session=cookie     状态保存在 Cookie 中, 之后的请求不带参数也会继续
+    ?session=new        开始新的序列, 下一次请求的状态在 X-Shuffle-Session 响应头
+                        (JSON 接口同时在 session 字段) 中返回, 客户端下次以 ?session=<状态> 请求;
+                        一次请求用到多个序列时 (如 /api/random), 各序列的状态以逗号连接
+
+总数变化 (增删文件) 或序列取完后自动换用新的种子; 一次批量请求不会跨过一轮的末尾
+"""
+import hashlib
+import random
+from flask import after_this_request, g, request
+from .toml_config import SHUFFLE_COOKIE, SHUFFLE_COOKIE_MAX_AGE
+
+
+SESSION_HEADER = "X-Shuffle-Session"
+_M64 = (1 << 64) - 1
+_ROUNDS = 4
+
+
+def _mix(x):
+    # splitmix64
+    x = (x + 0x9E3779B97F4A7C15) & _M64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _M64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _M64
+    return x ^ (x >> 31)
+
+
+class ShufflePermutation:
+    """
+    [0, size) 上由种子决定的随机排列, 按位置直接计算元素, O(1) 内存
+
+    在不小于 size 的 2 的幂上做 Feistel 置换, 结果超出 size 时继续置换 (cycle walking),
+    平均不超过 4 次
+    """
+
+    __slots__ = ("size", "half", "mask", "keys")
+
+    def __init__(self, size, seed):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        bits += bits & 1
+        self.half = bits // 2
+        self.mask = (1 << self.half) - 1
+        keys = []
+        key = seed
+        for _ in range(_ROUNDS):
+            key = _mix(key)
+            keys.append(key)
+        self.keys = keys
+
+    def _permute(self, x):
+        half, mask = self.half, self.mask
+        left, right = x >> half, x & mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix(right ^ key) & mask)
+        return (left << half) | right
+
+    def __getitem__(self, position):
+        x = self._permute(position)
+        while x >= self.size:
+            x = self._permute(x)
+        return x
+
+
+def _encode(seed, position, size):
+    return f"{seed:x}-{position:x}-{size:x}"
+
+
+def _decode(token):
+    try:
+        seed, position, size = (int(part, 16) for part in token.split("-"))
+    except (AttributeError, ValueError):
+        return None
+    if seed > _M64:
+        return None
+    return seed, position, size
+
+
+def _key_id(key):
+    # 类型名可能包含非 ASCII 字符, Cookie 名和状态中使用其哈希
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=6).hexdigest()
+
+
+def _cookie_name(key):
+    return "shuffle_" + _key_id(key)
+
+
+def _parse_session(value):
+    """
+    解析 ?session=<状态>: 以逗号分隔的 "<key_id>:<状态>", 不带 key_id 的状态适用于任意序列
+
+    Returns:
+        dict: {key_id 或 None: 状态}
+    """
+    tokens = {}
+    for part in value.split(","):
+        key_id, sep, token = part.rpartition(":")
+        tokens[key_id if sep else None] = token
+    return tokens
+
+
+class ShuffleBag:
+    """
+    一个客户端在一个 类型/方向 上的洗牌状态
+
+    Args:
+        token (str): 当前状态, 为 None 或无效时开始新的序列
+        cookie_name (str): 状态保存在该 Cookie 中, 为 None 时通过响应头返回
+        key_id (str): 序列的标识, 返回给客户端的状态带有该前缀
+    """
+
+    def __init__(self, token, cookie_name=None, key_id=None):
+        self.token = token
+        self.cookie_name = cookie_name
+        self.key_id = key_id
+
+    def draw(self, size, k=1):
+        """
+        返回序列中接下来的至多 k 个位置 [0, size)
+
+        只在当前这一轮排列中选择: 剩余不足 k 个时只返回剩余的部分, 下一次调用再开始新的一轮,
+        同一批结果中不会出现重复
+
+        Returns:
+            list: 位置列表
+        """
+        state = _decode(self.token)
+        if state is None or state[2] != size or state[1] >= size:
+            state = (random.getrandbits(64), 0, size)
+        seed, position, _ = state
+        end = min(position + k, size)
+        self.token = _encode(seed, end, size)
+        permutation = ShufflePermutation(size, seed)
+        return [permutation[i] for i in range(position, end)]
+
+    def session_value(self):
+        """
+        返回给客户端的状态, 客户端下次以 ?session=<状态> 请求
+        """
+        if self.token is None or self.key_id is None:
+            return self.token
+        return f"{self.key_id}:{self.token}"
+
+    def save(self, response):
+        if self.token is not None:
+            response.set_cookie(
+                self.cookie_name, self.token,
+                max_age=SHUFFLE_COOKIE_MAX_AGE, httponly=True, samesite="Lax",
+            )
+        return response
+
+
+def _save_header(response):
+    token = session_token()
+    if token is not None:
+        response.headers[SESSION_HEADER] = token
+    return response
+
+
+def current_bag(key):
+    """
+    返回当前请求在 key (如 "img/<type>/<orientation>") 上的洗牌状态, 未开启 session 模式时返回 None;
+    响应时自动写回新的状态, 同一请求中相同的 key 共用一个状态
+    """
+    bags = g.get("shuffle_bags")
+    if bags is None:
+        bags = g.shuffle_bags = {}
+    bag = bags.get(key)
+    if bag is not None:
+        return bag
+
+    session = request.args.get("session")
+    cookie_name = _cookie_name(key)
+    if session is None:
+        token = request.cookies.get(cookie_name)
+        if token is None and not SHUFFLE_COOKIE:
+            return None
+        bag = ShuffleBag(token, cookie_name)
+    elif session == "cookie":
+        bag = ShuffleBag(request.cookies.get(cookie_name), cookie_name)
+    else:
+        key_id = _key_id(key)
+        tokens = {} if session == "new" else _parse_session(session)
+        bag = ShuffleBag(tokens.get(key_id, tokens.get(None)), key_id=key_id)
+
+    if bag.cookie_name is not None:
+        after_this_request(bag.save)
+    elif not any(other.cookie_name is None for other in bags.values()):
+        # 响应头只写一次, 包含本次请求用到的全部序列
+        after_this_request(_save_header)
+    bags[key] = bag
+    return bag
+
+
+def session_token(scope=None):
+    """
+    ?session= 模式下客户端下一次请求应携带的状态, 供 JSON 接口返回; 其他情况返回 None
+
+    Args:
+        scope (str): 可选, 只返回该范围 (如 "img/<type>"、"text/<type>") 内的序列;
+            默认返回本次请求用到的全部序列
+
+    Returns:
+        str: 多个序列的状态以逗号分隔, 可以原样作为 ?session= 的值
+    """
+    bags = g.get("shuffle_bags") or {}
+    tokens = [
+        bag.session_value()
+        for key, bag in bags.items()
+        if bag.cookie_name is None and bag.token is not None
+        and (scope is None or key == scope or key.startswith(scope + "/"))
+    ]
+    return ",".join(tokens) or None
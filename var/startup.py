@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+启动耗时报告
+
+Init_module 中的每个初始化步骤以 timer.phase(name) 计时, 完成后汇总为启动报告,
+保存在 app.extensions["startup_report"] 中并写入日志 (gunicorn 在 when_ready 中输出);
+`python start.py --startup-report` 在本进程中加载一次应用并打印报告
+"""
+import logging
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Args:
+        started (float): 可选, 入口模块开始导入时的 time.perf_counter(), 用于统计导入耗时
+    """
+
+    def __init__(self, started=None):
+        now = time.perf_counter()
+        self.started = now if started is None else started
+        # [(阶段名, 秒), ...]
+        self.phases = []
+        # 附加信息, 如启动快照的使用情况
+        self.notes = {}
+        if started is not None:
+            self.phases.append(("imports", now - started))
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def report(self):
+        """
+        Returns:
+            dict: {"total": 秒, "phases": {阶段名: 秒}, "notes": {...}}
+        """
+        return {
+            "total": round(time.perf_counter() - self.started, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases},
+            "notes": dict(self.notes),
+        }
+
+    def finish(self, app):
+        report = self.report()
+        app.extensions["startup_report"] = report
+        logger.info("Startup finished in %.3fs: %s", report["total"], ", ".join(
+            f"{name} {seconds:.3f}s" for name, seconds in report["phases"].items()
+        ))
+        return report
+
+
+def format_report(report):
+    """
+    按耗时从大到小排列的文本报告
+    """
+    lines = [f"启动耗时 {report['total'] * 1000:.1f} ms"]
+    for name, seconds in sorted(report["phases"].items(), key=lambda item: -item[1]):
+        lines.append(f"  {name:<18} {seconds * 1000:8.1f} ms")
+    for key, value in report["notes"].items():
+        lines.append(f"  {key}: {value}")
+    return "\n".join(lines)
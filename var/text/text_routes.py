@@ -2,41 +2,54 @@
 
 from flask import Blueprint, jsonify, current_app
 from . import text_utils as utils
+from ..response_cache import cached_json
+from ..batch import batch_size
+from ..shuffle import current_bag, session_token
 
 bp = Blueprint('text_routes', __name__)
 
 @bp.route('/api/text/types')
 def get_text_types_api():
-    return jsonify({
-        'types': utils.get_text_types(),
-        'count': len(utils.get_text_types())
-    })
+    def build():
+        types = utils.get_text_types()
+        return {
+            'types': types,
+            'count': len(types)
+        }
+
+    return cached_json('text_types', utils.get_catalog().generation, build)
 
 @bp.route('/api/text/<text_type>/count')
 def get_text_count_api(text_type):
-    count = utils.get_text_count_by_type(text_type)
+    catalog = utils.get_catalog()
     # 检查类型是否存在
-    if count == 0 and text_type not in utils.get_text_types():
+    if catalog.get_bucket(text_type) is None:
         return jsonify({
             'error': 'Invalid text type',
             'type': text_type
         }), 404
-    
-    return jsonify({
-        'count': count,
+
+    return cached_json(f'text_count:{text_type}', catalog.generation, lambda: {
+        'count': utils.get_text_count_by_type(text_type),
         'type': text_type
     })
 
 @bp.route('/api/text/count')
 def get_all_text_types_count_api():
-    count_data = utils.get_all_text_types_count()
-    return jsonify(count_data)
+    return cached_json(
+        'text_count', utils.get_catalog().generation, utils.get_all_text_types_count
+    )
 
 @bp.route('/random_text/<text_type>')
 def get_random_text_api(text_type):
-    random_text = utils.get_random_text_by_type(text_type)
+    """
+    Query:
+        n: 指定时不放回地随机选择 n 行, 返回 JSON 数组
+    """
+    n = batch_size()
+    texts = random_text_items(text_type, n or 1)
     # 检查类型是否存在以及是否有文本
-    if random_text is None:
+    if texts is None:
         # 检查是否是类型不存在
         if text_type not in utils.get_text_types():
             return jsonify({
@@ -49,8 +62,20 @@ def get_random_text_api(text_type):
                 'error': 'No text available',
                 'type': text_type
             }), 404
-    
-    return jsonify({
-        'type': text_type,
-        'text': random_text
-    })
\ No newline at end of file
+    if n is not None:
+        return jsonify(texts)
+
+    rv = texts[0]
+    token = session_token()
+    if token is not None:
+        rv['session'] = token
+    return jsonify(rv)
+
+def random_text_items(text_type, n=1):
+    """
+    不放回地随机选择至多 n 行文本, 返回 /random_text 格式的列表; 类型不存在或没有文本时返回 None
+    """
+    texts = utils.get_random_texts_by_type(text_type, n, current_bag(f'text/{text_type}'))
+    if not texts:
+        return None
+    return [{'type': text_type, 'text': text} for text in texts]
@@ -1,103 +1,470 @@
 # -*- coding: utf-8 -*-
 
+import mmap
 import os
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_right
 from flask import current_app
+from ..metrics import timed_scan
+
+
+# 修改时间距今不足该值 (纳秒) 的目录不记录状态, 同 img_utils.RACY_NS
+RACY_NS = 2 * 10 ** 9
+
+
+class _LineIndex:
+    """
+    单个文本文件的行偏移索引
+
+    starts/ends 记录每个非空行的起止字节偏移, 读取时按偏移 pread 所需的行,
+    不再每次 readlines() 整个文件; 文件只在建立索引和读取时短暂打开,
+    索引数量再多也不会长期占用文件描述符
+    """
+
+    __slots__ = ("path", "size", "mtime_ns", "starts", "ends")
+
+    def __init__(self, path):
+        self.path = path
+        self.starts = array("Q")
+        self.ends = array("Q")
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self.size = st.st_size
+            self.mtime_ns = st.st_mtime_ns
+            if not st.st_size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = 0
+                while pos < self.size:
+                    end = mm.find(b"\n", pos)
+                    if end < 0:
+                        end = self.size
+                    # 空白行不参与随机选择
+                    if end > pos and not mm[pos:end].isspace():
+                        self.starts.append(pos)
+                        self.ends.append(end)
+                    pos = end + 1
+
+    def __len__(self):
+        return len(self.starts)
+
+    def is_stale(self, st=None):
+        if st is None:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                return True
+        return st.st_size != self.size or st.st_mtime_ns != self.mtime_ns
+
+    def lines(self, numbers):
+        """
+        读取若干行
+
+        Args:
+            numbers (list): 行号
+
+        Returns:
+            list: 与 numbers 对应的文本; 文件在建立索引后被修改或删除时返回 None
+        """
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            if self.is_stale(os.fstat(fd)):
+                return None
+            texts = []
+            for i in numbers:
+                start = self.starts[i]
+                data = os.pread(fd, self.ends[i] - start, start)
+                texts.append(data.decode("utf-8", errors="replace").strip())
+            return texts
+        finally:
+            os.close(fd)
+
+
+class _LineTable:
+    """
+    某个类型下所有文件的行索引快照, cumulative 为各文件行数的前缀和,
+    用于在该类型的全部行中均匀选择
+    """
+
+    __slots__ = ("indexes", "cumulative")
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.cumulative = array("Q")
+        total = 0
+        for index in indexes:
+            total += len(index)
+            self.cumulative.append(total)
+
+    @property
+    def total(self):
+        return self.cumulative[-1] if self.cumulative else 0
+
+    def line(self, n):
+        i = bisect_right(self.cumulative, n)
+        start = self.cumulative[i - 1] if i else 0
+        return self.indexes[i], n - start
+
+
+class _TextBucket:
+    """
+    单个类型目录下的 .txt 文件索引
+    """
+
+    __slots__ = ("names", "positions", "table", "dirty")
+
+    def __init__(self):
+        self.names = []
+        self.positions = {}
+        # 行索引快照, 文件增删改后标记为 dirty, 下次取文本时重建
+        self.table = None
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, filename):
+        if filename in self.positions:
+            return
+        self.positions[filename] = len(self.names)
+        self.names.append(filename)
+
+    def remove(self, filename):
+        pos = self.positions.pop(filename, None)
+        if pos is None:
+            return False
+        moved = self.names.pop()
+        if moved != filename:
+            self.names[pos] = moved
+            self.positions[moved] = pos
+        return True
+
+
+class TextCatalog:
+    """
+    文本目录索引
+
+    启动时扫描一次 TEXT_BASE, 之后由目录监听增量更新
+    """
+
+    def __init__(self, text_base):
+        self.text_base = text_base
+        self.buckets = {}
+        self.types = ()
+        self.generation = 0
+        self.lock = threading.Lock()
+        # {text_type: 扫描时类型目录的修改时间}, 用于判断启动快照中的记录是否仍然有效
+        self.dir_stamps = {}
+
+    def scan(self, boot=None):
+        """
+        完整扫描 TEXT_BASE 并重建索引
+
+        Args:
+            boot (BootSnapshot): 可选, 上次保存的启动快照; 目录修改时间与保存时相同的类型
+                直接使用快照中的文件列表
+        """
+        buckets = {}
+        dir_stamps = {}
+        with timed_scan("text", "full"):
+            if os.path.isdir(self.text_base):
+                recent = time.time_ns() - RACY_NS
+                for type_entry in os.scandir(self.text_base):
+                    if not type_entry.is_dir():
+                        continue
+                    text_type = type_entry.name
+                    try:
+                        stamp = type_entry.stat().st_mtime_ns
+                    except OSError:
+                        continue
+                    if stamp > recent:
+                        # 刚刚修改过的目录不记录状态, 下次启动时重新扫描
+                        stamp = None
+                    if (boot is not None and stamp is not None
+                            and boot.text_stamps.get(text_type) == stamp
+                            and text_type in boot.snapshot.text_names):
+                        bucket = _TextBucket()
+                        for name in boot.snapshot.text_names[text_type]:
+                            bucket.add(name)
+                        buckets[text_type] = bucket
+                    else:
+                        buckets[text_type] = self._scan_dir(type_entry.path)
+                    if stamp is not None:
+                        dir_stamps[text_type] = stamp
+
+        with self.lock:
+            self.buckets = buckets
+            self.types = tuple(sorted(buckets))
+            self.generation += 1
+            self.dir_stamps = dir_stamps
+
+    def _scan_dir(self, type_dir):
+        bucket = _TextBucket()
+        for entry in os.scandir(type_dir):
+            if entry.name.endswith(".txt") and entry.is_file():
+                bucket.add(entry.name)
+        return bucket
+
+    def sync(self):
+        """
+        与共享索引对齐, 本进程自行维护的索引无需处理
+        """
+
+    def get_bucket(self, text_type):
+        return self.buckets.get(text_type)
+
+    def watch_dirs(self):
+        """
+        需要监听的目录: TEXT_BASE 以及每个类型目录
+        """
+        dirs = [self.text_base]
+        dirs.extend(os.path.join(self.text_base, t) for t in self.types)
+        return dirs
+
+    def apply_change(self, dir_path, name):
+        """
+        根据 dir_path/name 的当前状态增量更新索引
+
+        Returns:
+            list: 新出现、需要加入监听的目录
+        """
+        path = os.path.join(dir_path, name)
+        new_dirs = []
+        with self.lock:
+            if dir_path == self.text_base:
+                # 类型目录的增删
+                if os.path.isdir(path):
+                    if name not in self.buckets:
+                        self.buckets[name] = self._scan_dir(path)
+                        new_dirs.append(path)
+                elif self.buckets.pop(name, None) is None:
+                    return new_dirs
+                self.types = tuple(sorted(self.buckets))
+            else:
+                bucket = self.buckets.get(os.path.basename(dir_path))
+                if bucket is None or not name.endswith(".txt"):
+                    return new_dirs
+                if os.path.isfile(path):
+                    bucket.add(name)
+                elif not bucket.remove(name):
+                    return new_dirs
+                bucket.dirty = True
+            self.generation += 1
+            changed_type = name if dir_path == self.text_base else os.path.basename(dir_path)
+            self.dir_stamps.pop(changed_type, None)
+        return new_dirs
+
+    def resync_dir(self, dir_path):
+        """
+        将单个目录与磁盘内容对齐, 只处理增删的差异部分
+        """
+        with timed_scan("text", "resync"):
+            try:
+                names = set(os.listdir(dir_path))
+            except OSError:
+                names = set()
+
+            if dir_path == self.text_base:
+                known = set(self.buckets)
+            else:
+                bucket = self.buckets.get(os.path.basename(dir_path))
+                if bucket is None:
+                    return []
+                names = {n for n in names if n.endswith(".txt")}
+                known = set(bucket.positions)
+
+            new_dirs = []
+            for name in names.symmetric_difference(known):
+                new_dirs.extend(self.apply_change(dir_path, name))
+        return new_dirs
+
+    def line_table(self, text_type):
+        """
+        返回类型的行索引快照, 必要时重建; 未变化的文件沿用原有索引
+        """
+        bucket = self.buckets.get(text_type)
+        if bucket is None:
+            return None
+        table = bucket.table
+        if table is not None and not bucket.dirty:
+            return table
+
+        with self.lock:
+            if bucket.table is not None and not bucket.dirty:
+                return bucket.table
+            with timed_scan("text", "line_index"):
+                previous = {}
+                if bucket.table is not None:
+                    previous = {index.path: index for index in bucket.table.indexes}
+                type_dir = os.path.join(self.text_base, text_type)
+                indexes = []
+                for name in bucket.names:
+                    path = os.path.join(type_dir, name)
+                    index = previous.get(path)
+                    if index is None or index.is_stale():
+                        try:
+                            index = _LineIndex(path)
+                        except (OSError, ValueError):
+                            continue
+                    indexes.append(index)
+                bucket.table = _LineTable(indexes)
+            bucket.dirty = False
+            return bucket.table
+
+
+class SharedTextCatalog(TextCatalog):
+    """
+    工作进程中的只读索引, 文件列表来自主进程发布的共享索引文件,
+    行索引仍在各进程内按需建立
+    """
+
+    def __init__(self, text_base, reader):
+        super().__init__(text_base)
+        self.reader = reader
+        self.sync()
+
+    def sync(self):
+        snapshot = self.reader.current()
+        if snapshot.generation == self.generation:
+            return
+        buckets = {}
+        for text_type, names in snapshot.text_names.items():
+            bucket = _TextBucket()
+            for name in names:
+                bucket.add(name)
+            # 沿用旧的行索引, 重建时未变化的文件不会重新扫描
+            previous = self.buckets.get(text_type)
+            if previous is not None:
+                bucket.table = previous.table
+            buckets[text_type] = bucket
+        with self.lock:
+            self.buckets = buckets
+            self.types = snapshot.text_types
+            self.generation = snapshot.generation
+
+
+def init_catalog(app, boot=None):
+    """
+    构建文本索引并挂载到 app.extensions, 在 Init_module 中调用一次
+
+    Args:
+        boot (BootSnapshot): 可选, 见 TextCatalog.scan()
+    """
+    catalog = TextCatalog(app.config["TEXT_BASE"])
+    catalog.scan(boot)
+    app.extensions["text_catalog"] = catalog
+    return catalog
+
+def get_catalog():
+    catalog = current_app.extensions["text_catalog"]
+    catalog.sync()
+    return catalog
 
 def get_text_types():
     """
     获取所有文本类型
     """
-    text_base = current_app.config['TEXT_BASE']
-    types = []
-    for item in os.listdir(text_base):
-        if os.path.isdir(os.path.join(text_base, item)):
-            types.append(item)
-    return sorted(types)
+    return list(get_catalog().types)
 
 def get_text_count_by_type(text_type):
     """
     获取指定类型的文本文件统计
-    
+
     Args:
         text_type (str): 文本类型
-    
+
     Returns:
         int: 该类型下的文本文件数量
     """
-    text_base = current_app.config['TEXT_BASE']
-    type_dir = os.path.join(text_base, text_type)
-    
-    # 检查类型目录是否存在
-    if not os.path.exists(type_dir) or not os.path.isdir(type_dir):
-        return 0
-    
-    # 统计.txt文件数量
-    count = 0
-    for item in os.listdir(type_dir):
-        if os.path.isfile(os.path.join(type_dir, item)) and item.endswith('.txt'):
-            count += 1
-    
-    return count
+    bucket = get_catalog().get_bucket(text_type)
+    return len(bucket) if bucket is not None else 0
 
 def get_all_text_types_count():
     """
     获取所有类型的文本文件统计
-    
+
     Returns:
         dict: 包含各类型文本文件数量和总计数量的字典
     """
-    text_base = current_app.config['TEXT_BASE']
+    catalog = get_catalog()
     types_count = {}
     total_count = 0
-    
-    # 获取所有文本类型
-    types = get_text_types()
-    
+
     # 统计每种类型的文件数量
-    for text_type in types:
-        count = get_text_count_by_type(text_type)
+    for text_type in catalog.types:
+        count = len(catalog.buckets[text_type])
         types_count[text_type] = count
         total_count += count
-    
+
     return {
         'types': types_count,
         'count': total_count
     }
 
-def get_random_text_by_type(text_type):
+def get_random_text_by_type(text_type, bag=None):
     """
     获取指定类型的随机文本
-    
+
+    在该类型所有文件的全部非空行中均匀选择, 不会偏向小文件中的行
+
     Args:
         text_type (str): 文本类型
-    
+        bag (ShuffleBag): 可选, 按客户端的洗牌序列选择, 取完全部行之前不重复
+
     Returns:
         str: 随机文本内容
     """
-    import random
-    
-    text_base = current_app.config['TEXT_BASE']
-    type_dir = os.path.join(text_base, text_type)
-    
-    # 检查类型目录是否存在
-    if not os.path.exists(type_dir) or not os.path.isdir(type_dir):
-        return None
-    
-    # 获取所有.txt文件
-    txt_files = [f for f in os.listdir(type_dir) if f.endswith('.txt')]
-    
-    # 检查是否有.txt文件
-    if not txt_files:
-        return None
-    
-    # 随机选择一个.txt文件
-    random_file = random.choice(txt_files)
-    file_path = os.path.join(type_dir, random_file)
-    
-    # 读取文件内容并随机选择一行
-    with open(file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        if lines:
-            return random.choice(lines).strip()
-    
-    return None
\ No newline at end of file
+    texts = get_random_texts_by_type(text_type, 1, bag)
+    return texts[0] if texts else None
+
+def get_random_texts_by_type(text_type, k, bag=None):
+    """
+    不放回地随机选择指定类型的至多 k 行文本
+
+    Args:
+        text_type (str): 文本类型
+        k (int): 数量
+        bag (ShuffleBag): 可选, 按客户端的洗牌序列选择, 一轮剩余不足 k 行时只返回剩余的部分
+
+    Returns:
+        list: 文本列表; 类型不存在或没有可用的文本行时返回 None
+    """
+    catalog = get_catalog()
+
+    for _ in range(2):
+        table = catalog.line_table(text_type)
+        # 检查是否有.txt文件以及可用的文本行
+        if table is None or not table.total:
+            return None
+
+        count = min(k, table.total)
+        if bag is not None:
+            numbers = bag.draw(table.total, count)
+        else:
+            numbers = random.sample(range(table.total), count)
+        # 同一文件中的行只打开一次文件读取
+        picks = {}
+        for pos, n in enumerate(numbers):
+            index, i = table.line(n)
+            picks.setdefault(id(index), (index, []))[1].append((pos, i))
+        texts = [None] * len(numbers)
+        for index, items in picks.values():
+            read = index.lines([i for _, i in items])
+            if read is None:
+                break
+            for (pos, _), text in zip(items, read):
+                texts[pos] = text
+        else:
+            return texts
+        # 文件在两次监听事件之间被改写时, 重建索引后再选一次
+        bucket = catalog.get_bucket(text_type)
+        if bucket is not None:
+            bucket.dirty = True
+
+    return None
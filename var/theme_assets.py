@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+主题静态资源 (/css, /js) 的预压缩与内存服务
+
+启动时读取 THEME_DIR/misstatement/asses 下的全部文件, 为每个文件生成带内容哈希的文件名
+和 gzip/brotli/zstd 压缩版本, 之后的请求按 Accept-Encoding 直接从内存返回:
+
+    /css/misstatement.css           原文件名, 带 ETag 重新验证
+    /css/misstatement.1a2b3c4d.css  带哈希的文件名, 内容不变, 可以长期缓存
+
+页面中引用的 /css、/js 地址在页面缓存中替换为带哈希的文件名 (见 theme_cache);
+`python start.py --build-assets` 可以提前把压缩结果写入 asset_dir, 启动时直接读取
+"""
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import threading
+import time
+from flask import current_app, request
+from .theme_cache import compress_variants, choose_encoding
+
+
+# URL 前缀与 misstatement 下目录的对应关系
+ASSET_ROUTES = {"css": "asses/css", "js": "asses/js"}
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# 带哈希的文件名中的哈希部分
+_HASH_PART = re.compile(r"\.[0-9a-f]{10}(?=\.[^./]*$|$)")
+
+MANIFEST_NAME = "manifest.json"
+# 预压缩文件的扩展名
+ENCODING_SUFFIXES = {"identity": "", "gzip": ".gz", "br": ".br", "zstd": ".zst"}
+
+
+def _stat_key(st):
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _hashed_url(url, digest):
+    head, _, name = url.rpartition("/")
+    stem, dot, ext = name.rpartition(".")
+    if not dot:
+        return f"{url}.{digest}"
+    return f"{head}/{stem}.{digest}.{ext}"
+
+
+class _Asset:
+    """
+    一个静态资源文件及其各编码版本
+    """
+
+    __slots__ = ("url", "hashed_url", "path", "stat_key", "mimetype", "variants", "etag")
+
+    def __init__(self, url, path, stat_key, data, variants=None):
+        self.url = url
+        self.path = path
+        self.stat_key = stat_key
+        digest = hashlib.blake2b(data, digest_size=8).hexdigest()
+        self.etag = digest
+        self.hashed_url = _hashed_url(url, digest[:10])
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.variants = variants or compress_variants(data)
+
+
+class ThemeAssets:
+    """
+    Args:
+        theme_dir (str): misstatement 目录
+        asset_dir (str): 预压缩结果所在目录, 为空时总是在内存中生成
+        check_interval (float): 检查源文件是否变化的最短间隔（秒）
+    """
+
+    def __init__(self, theme_dir, asset_dir=None, check_interval=2.0):
+        self.theme_dir = theme_dir
+        self.asset_dir = asset_dir
+        self.check_interval = check_interval
+        # {url: _Asset}, 包含原文件名和带哈希的文件名
+        self.by_url = {}
+        # {原文件名 url: 带哈希的 url}
+        self.manifest = {}
+        # 资源变化时递增, 页面缓存据此重新生成引用地址
+        self.generation = 0
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _sources(self):
+        """
+        遍历源文件
+
+        Returns:
+            list: [(url, path, stat), ...]
+        """
+        sources = []
+        for prefix, rel_dir in ASSET_ROUTES.items():
+            base = os.path.join(self.theme_dir, rel_dir)
+            for root, _, files in os.walk(base):
+                for name in files:
+                    path = os.path.join(root, name)
+                    rel = os.path.relpath(path, base).replace(os.sep, "/")
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    sources.append((f"/{prefix}/{rel}", path, st))
+        return sorted(sources)
+
+    def _load_prebuilt(self):
+        """
+        读取 build() 写入的清单, 返回 {url: 清单条目}
+        """
+        if not self.asset_dir:
+            return {}
+        try:
+            with open(os.path.join(self.asset_dir, MANIFEST_NAME), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _read_prebuilt(self, entry):
+        variants = {}
+        for encoding, filename in entry["files"].items():
+            with open(os.path.join(self.asset_dir, filename), "rb") as f:
+                variants[encoding] = f.read()
+        return variants
+
+    def load(self):
+        """
+        加载全部资源; 预压缩结果与源文件一致时直接读取, 否则重新压缩
+        """
+        prebuilt = self._load_prebuilt()
+        current = {asset.url: asset for asset in self.by_url.values()}
+        by_url = {}
+        manifest = {}
+        for url, path, st in self._sources():
+            stat_key = _stat_key(st)
+            asset = current.get(url)
+            if asset is None or asset.stat_key != stat_key:
+                asset = None
+                entry = prebuilt.get(url)
+                try:
+                    if entry is not None and entry["stat"] == stat_key:
+                        variants = self._read_prebuilt(entry)
+                        asset = _Asset(url, path, stat_key, variants["identity"], variants)
+                    else:
+                        with open(path, "rb") as f:
+                            asset = _Asset(url, path, stat_key, f.read())
+                except (OSError, KeyError):
+                    continue
+            by_url[url] = asset
+            by_url[asset.hashed_url] = asset
+            manifest[url] = asset.hashed_url
+
+        with self._lock:
+            changed = manifest != self.manifest
+            self.by_url = by_url
+            self.manifest = manifest
+            if changed:
+                self.generation += 1
+            self._checked = time.monotonic()
+        return self
+
+    def refresh(self):
+        """
+        距离上次检查超过 check_interval 时, 重新检查源文件
+        """
+        if time.monotonic() - self._checked < self.check_interval:
+            return
+        self._checked = time.monotonic()
+        sources = self._sources()
+        known = {asset.url: asset.stat_key for asset in self.by_url.values()}
+        if {url: _stat_key(st) for url, _, st in sources} != known:
+            self.load()
+
+    def get(self, url):
+        """
+        Returns:
+            tuple: (_Asset, 是否为带哈希的地址), 不存在时返回 (None, False)
+        """
+        self.refresh()
+        asset = self.by_url.get(url)
+        if asset is None:
+            # 旧页面引用的上一版本哈希, 返回当前内容但不允许长期缓存
+            asset = self.by_url.get(_HASH_PART.sub("", url, count=1))
+            if asset is None:
+                return None, False
+        return asset, url == asset.hashed_url
+
+    def build(self):
+        """
+        把压缩结果和清单写入 asset_dir, 供下次启动直接读取
+
+        Returns:
+            int: 资源数量
+        """
+        self.load()
+        os.makedirs(self.asset_dir, exist_ok=True)
+        manifest = {}
+        for url, asset in self.by_url.items():
+            if url != asset.url:
+                continue
+            base_name = asset.hashed_url.lstrip("/").replace("/", "_")
+            files = {}
+            for encoding, data in asset.variants.items():
+                filename = base_name + ENCODING_SUFFIXES[encoding]
+                tmp_path = os.path.join(self.asset_dir, f"{filename}.{os.getpid()}.tmp")
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, os.path.join(self.asset_dir, filename))
+                files[encoding] = filename
+            manifest[url] = {"hashed": asset.hashed_url, "stat": asset.stat_key, "files": files}
+
+        tmp_path = os.path.join(self.asset_dir, f"{MANIFEST_NAME}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, os.path.join(self.asset_dir, MANIFEST_NAME))
+
+        # 删除已经不在清单中的旧文件
+        keep = {name for entry in manifest.values() for name in entry["files"].values()}
+        keep.add(MANIFEST_NAME)
+        for name in os.listdir(self.asset_dir):
+            if name not in keep:
+                os.remove(os.path.join(self.asset_dir, name))
+        return len(manifest)
+
+    def rewrite_url(self, url):
+        """
+        页面中的资源地址替换为带哈希的地址, 不是已知资源时原样返回
+        """
+        return self.manifest.get(url, url)
+
+
+def init_theme_assets(app, theme_dir, asset_dir=None, check_interval=2.0):
+    assets = ThemeAssets(theme_dir, asset_dir, check_interval).load()
+    app.extensions["theme_assets"] = assets
+    return assets
+
+
+def get_theme_assets():
+    return current_app.extensions["theme_assets"]
+
+
+def asset_response(url):
+    """
+    从内存返回静态资源, 资源不存在时返回 None
+    """
+    asset, immutable = get_theme_assets().get(url)
+    if asset is None:
+        return None
+    encoding = choose_encoding(asset.variants)
+    etag = asset.etag if encoding == "identity" else f"{asset.etag}-{encoding}"
+
+    rv = current_app.response_class(mimetype=asset.mimetype)
+    rv.vary.add("Accept-Encoding")
+    rv.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+    rv.set_etag(etag)
+    if request.if_none_match.contains_weak(etag):
+        rv.status_code = 304
+        return rv
+    if encoding != "identity":
+        rv.content_encoding = encoding
+    rv.set_data(asset.variants[encoding])
+    return rv
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+主题页面缓存
+
+首页、帮助页和错误页面只在首次使用或文件变化后读取一次, 按需要替换主机地址的位置
+预先切分; 原样返回的页面生成一次全部 gzip/brotli/zstd 压缩版本, 按主机渲染的页面
+拼接一次后只在请求选择某个编码时以低压缩等级压缩该编码, 之后同一主机的请求直接返回缓存的
+字节串, 限流时的 429 页面不再读取磁盘
+"""
+import gzip
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# 需要替换为绝对地址的位置: href="/ 和 src="/ 中 / 的前面
+_SUBSTITUTION_POINT = re.compile(r'(?<=href=")(?=/)|(?<=src=")(?=/)')
+# 页面中引用的站内地址, 替换为静态资源带哈希的地址
+_LOCAL_URL = re.compile(r'(?<=href=")/[^"]*(?=")|(?<=src=")/[^"]*(?=")')
+
+# 每个页面缓存的主机数, Host 请求头由客户端决定, 需要限制数量
+MAX_HOSTS = 16
+
+# (gzip, brotli, zstd) 的压缩等级: 内容变化时才生成一次的结果使用最高等级;
+# 按主机渲染的页面可由任意 Host 请求头在请求中触发 (包括 429 页面), 使用低等级
+BEST_LEVELS = (9, 11, 19)
+FAST_LEVELS = (6, 4, 3)
+# 按需压缩时尚不知道各编码的体积, Accept-Encoding 权重相同时按此顺序 (通常的压缩率) 选择
+_ON_DEMAND_ORDER = ("br", "zstd", "gzip")
+
+
+def _compress(data, encoding, levels):
+    """
+    以 levels 中对应的等级压缩为 encoding, 编码不可用时返回 None
+    """
+    gzip_level, brotli_level, zstd_level = levels
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data, quality=brotli_level)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=zstd_level).compress(data)
+    return None
+
+
+def compress_variants(data, levels=BEST_LEVELS):
+    """
+    生成各编码版本, 结果会被缓存, 只在内容变化时生成一次
+
+    Args:
+        data (bytes): 原文
+        levels (tuple): (gzip, brotli, zstd) 的压缩等级, 默认为最高压缩率
+
+    Returns:
+        dict: {编码: 字节串}, 只保留比原文小的压缩结果
+    """
+    variants = {"identity": data}
+    for encoding in ("gzip", "br", "zstd"):
+        compressed = _compress(data, encoding, levels)
+        if compressed is not None and len(compressed) < len(data):
+            variants[encoding] = compressed
+    return variants
+
+
+class OnDemandVariants(dict):
+    """
+    {编码: 字节串}, 只在第一次取某个编码时压缩该编码并缓存
+
+    Args:
+        data (bytes): 原文
+        levels (tuple): (gzip, brotli, zstd) 的压缩等级
+    """
+
+    def __init__(self, data, levels=FAST_LEVELS):
+        super().__init__(identity=data)
+        self.levels = levels
+
+    def encodings(self):
+        """
+        可用的编码, 按 _ON_DEMAND_ORDER 排列
+        """
+        return [
+            encoding for encoding in _ON_DEMAND_ORDER
+            if encoding == "gzip"
+            or (encoding == "br" and brotli is not None)
+            or (encoding == "zstd" and zstandard is not None)
+        ]
+
+    def __missing__(self, encoding):
+        compressed = _compress(self["identity"], encoding, self.levels)
+        if compressed is None:
+            raise KeyError(encoding)
+        # 多个线程同时压缩同一编码时结果相同, 覆盖即可
+        self[encoding] = compressed
+        return compressed
+
+
+def choose_encoding(variants):
+    """
+    按 Accept-Encoding 选择编码, 同等权重时优先选择体积较小的版本;
+    OnDemandVariants 尚未压缩, 同等权重时按 _ON_DEMAND_ORDER 选择
+    """
+    accept = request.accept_encodings
+    if isinstance(variants, OnDemandVariants):
+        candidates = [(encoding, -rank) for rank, encoding in enumerate(variants.encodings())]
+    else:
+        candidates = [(encoding, -len(data)) for encoding, data in variants.items() if encoding != "identity"]
+    best = "identity"
+    best_key = None
+    for encoding, tiebreak in candidates:
+        quality = accept.quality(encoding)
+        if quality <= 0:
+            continue
+        key = (quality, tiebreak)
+        if best_key is None or key > best_key:
+            best, best_key = encoding, key
+    return best
+
+
+class _Page:
+    """
+    一个主题页面: 切分好的片段以及按主机缓存的渲染结果
+    """
+
+    __slots__ = ("path", "stat_key", "checked", "asset_generation", "segments", "rendered")
+
+    def __init__(self, path, assets=None):
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            content = f.read().decode("utf-8")
+        self.path = path
+        self.stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        self.checked = time.monotonic()
+        self.asset_generation = None
+        if assets is not None:
+            self.asset_generation = assets.generation
+            content = _LOCAL_URL.sub(lambda m: assets.rewrite_url(m.group(0)), content)
+        self.segments = _SUBSTITUTION_POINT.split(content)
+        # {base_url: (variants, etag)}
+        self.rendered = OrderedDict()
+
+    def is_stale(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return (st.st_mtime_ns, st.st_size, st.st_ino) != self.stat_key
+
+    def render(self, base_url):
+        """
+        Args:
+            base_url (str): 替换到 href="/ 和 src="/ 前面的地址, None 表示原样返回
+
+        Returns:
+            tuple: (variants, etag)
+        """
+        rendered = self.rendered.get(base_url)
+        if rendered is not None:
+            return rendered
+        data = (base_url or "").join(self.segments).encode("utf-8")
+        # 按主机渲染的页面只在请求选择某个编码时压缩该编码, 任意 Host 请求头不会触发全部编码的压缩
+        variants = compress_variants(data) if base_url is None else OnDemandVariants(data)
+        rendered = (variants, hashlib.blake2b(data, digest_size=8).hexdigest())
+        # 多个线程同时渲染同一主机时结果相同, 覆盖即可
+        self.rendered[base_url] = rendered
+        while len(self.rendered) > MAX_HOSTS:
+            self.rendered.popitem(last=False)
+        return rendered
+
+
+class ThemePageCache:
+    """
+    {页面文件名: _Page}
+
+    Args:
+        directory (str): 页面所在目录 (THEME_DIR/misstatement)
+        check_interval (float): 检查文件是否变化的最短间隔（秒）
+        assets (ThemeAssets): 静态资源, 资源变化后页面随之更新引用地址
+    """
+
+    def __init__(self, directory, check_interval=2.0, assets=None):
+        self.directory = directory
+        self.check_interval = check_interval
+        # ThemeAssets, 页面中的 /css、/js 地址替换为带哈希的文件名
+        self.assets = assets
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        返回页面, 文件不存在时返回 None
+        """
+        page = self._pages.get(name)
+        if page is not None:
+            now = time.monotonic()
+            if now - page.checked < self.check_interval:
+                return page
+            page.checked = now
+            if self.assets is not None:
+                self.assets.refresh()
+            if not page.is_stale() and (
+                self.assets is None or page.asset_generation == self.assets.generation
+            ):
+                return page
+
+        with self._lock:
+            current = self._pages.get(name)
+            if current is not None and current is not page:
+                return current
+            try:
+                page = _Page(os.path.join(self.directory, name), self.assets)
+            except (OSError, UnicodeDecodeError):
+                self._pages.pop(name, None)
+                return None
+            self._pages[name] = page
+            return page
+
+    def render(self, name, base_url=None):
+        page = self.get(name)
+        if page is None:
+            return None
+        return page.render(base_url)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+def init_theme_cache(app, directory, check_interval=2.0, assets=None):
+    cache = ThemePageCache(directory, check_interval, assets)
+    app.extensions["theme_cache"] = cache
+    return cache
+
+
+def get_theme_cache():
+    return current_app.extensions["theme_cache"]
+
+
+def page_response(rendered, status=200, cache_control=None):
+    """
+    以缓存的页面构建响应
+
+    Args:
+        rendered (tuple): ThemePageCache.render 的返回值
+        status (int): 状态码, 只有 200 响应支持 ETag 条件请求
+        cache_control (str): Cache-Control 响应头
+    """
+    variants, etag = rendered
+    encoding = choose_encoding(variants)
+
+    rv = current_app.response_class(mimetype="text/html", status=status)
+    rv.vary.add("Accept-Encoding")
+    if cache_control:
+        rv.headers["Cache-Control"] = cache_control
+    if status == 200:
+        # 不同编码的内容不同, ETag 也需要区分
+        if encoding != "identity":
+            etag = f"{etag}-{encoding}"
+        rv.set_etag(etag)
+        if request.if_none_match.contains_weak(etag):
+            rv.status_code = 304
+            return rv
+
+    if encoding != "identity":
+        rv.content_encoding = encoding
+    rv.set_data(variants[encoding])
+    return rv
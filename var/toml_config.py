@@ -4,8 +4,10 @@ import os
 
 
 
-# 获取配置文件路径
-config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.toml')
+# 获取配置文件路径, 可通过环境变量 HCANRANBAPI_CONFIG 指定其他配置文件（如基准测试）
+config_path = os.environ.get('HCANRANBAPI_CONFIG') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'config.toml'
+)
 
 # 读取TOML配置
 with open(config_path, 'rb') as f:
@@ -19,5 +21,41 @@ TEXT_BASE = os.path.join(PROJECT_ROOT, config['paths']['text_base'])
 ALLOWED_EXTENSIONS = set(config['extensions']['allowed'])
 THEME_DIR = os.path.join(PROJECT_ROOT, config['paths']['theme_dir'])
 LIMITER_BAPC = config['limiter']['requests_per_minute']
+LIMITER_STORAGE = config['limiter']['storage']
+LIMITER_SHARED_FILE = os.path.join(PROJECT_ROOT, config['limiter']['shared_file'])
+LIMITER_SHARED_SETS = config['limiter']['shared_sets']
+LIMITER_SHARED_WRITERS = config['limiter']['shared_writers'] or (os.cpu_count() or 1) * 2 + 1
+WATCHER_BACKEND = config['watcher']['backend']
+WATCHER_POLL_INTERVAL = config['watcher']['poll_interval']
+CATALOG_SHARED = config['catalog']['shared']
+CATALOG_SNAPSHOT_DIR = os.path.join(PROJECT_ROOT, config['catalog']['snapshot_dir'])
+CATALOG_PUBLISH_DELAY = config['catalog']['publish_delay']
+CATALOG_PERSIST = config['catalog']['persist']
+CATALOG_BOOT_SNAPSHOT = os.path.join(PROJECT_ROOT, config['catalog']['boot_snapshot'])
+IMAGE_CACHE_BUDGET = config['cache']['image_bytes_budget']
+IMAGE_CACHE_MAX_ITEM = config['cache']['image_max_item_bytes']
+DERIVE_CACHE_DIR = os.path.join(PROJECT_ROOT, config['derive']['cache_dir'])
+DERIVE_MAX_CACHE_BYTES = config['derive']['max_cache_bytes']
+DERIVE_MAX_DIMENSION = config['derive']['max_dimension']
+DERIVE_DEFAULT_QUALITY = config['derive']['default_quality']
+DERIVE_WORKERS = config['derive']['workers']
+DERIVE_VARIANTS = config['derive']['variants']
+METADATA_INDEX_FILE = os.path.join(PROJECT_ROOT, config['metadata']['index_file'])
+METADATA_DOMINANT_COLOR = config['metadata']['dominant_color']
+METADATA_AUTO_ORIENTATION = config['metadata']['auto_orientation']
+DEDUP_INDEX_FILE = os.path.join(PROJECT_ROOT, config['dedup']['index_file'])
+DEDUP_SERVE_CANONICAL = config['dedup']['serve_canonical']
+DEDUP_NEAR_DISTANCE = config['dedup']['near_distance']
+WEIGHTS_MODE = config['weights']['mode']
+WEIGHTS_FILE = os.path.join(PROJECT_ROOT, config['weights']['file'])
+WEIGHTS_EXPLICIT = config['weights']['explicit']
+WEIGHTS_POPULARITY_HALF_LIFE = config['weights']['popularity_half_life']
+WEIGHTS_POPULARITY_INTERVAL = config['weights']['popularity_interval']
+SHUFFLE_COOKIE = config['shuffle']['cookie']
+SHUFFLE_COOKIE_MAX_AGE = config['shuffle']['cookie_max_age']
+THEME_CHECK_INTERVAL = config['theme']['check_interval']
+THEME_ASSET_DIR = os.path.join(PROJECT_ROOT, config['theme']['asset_dir'])
+METRICS_ENABLED = config['metrics']['enabled']
+METRICS_DIR = os.path.join(PROJECT_ROOT, config['metrics']['directory'])
 STWQMC_NAME = config['app']['name']
 STWQMC_VERSION = config['app']['version']
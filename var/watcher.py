@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+目录监听: 将 usr/img、usr/text 下的文件增删改以增量方式应用到内存索引
+
+Linux 下使用 inotify, 其他平台或 inotify 不可用时退回到轮询目录修改时间
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+
+
+# inotify 常量 (见 <sys/inotify.h>)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class _InotifyBackend:
+    """
+    基于 inotify 的监听, 每个事件只对对应的单个文件做一次 stat
+    """
+
+    name = "inotify"
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add(self, dir_path, catalog):
+        wd = self._add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = (dir_path, catalog)
+
+    def poll(self, timeout):
+        """
+        读取一批事件并去重
+
+        Returns:
+            tuple: (需要 stat 的 (catalog, dir, name) 集合, 是否发生队列溢出)
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set(), False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set(), False
+
+        changes = set()
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            watch = self.watches.get(wd)
+            if watch is None or not name:
+                # 目录自身的删除/移动由上层目录的事件处理
+                continue
+            dir_path, catalog = watch
+            changes.add((catalog, dir_path, os.fsdecode(name)))
+        return changes, overflow
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        self.watches.clear()
+
+
+class _PollingBackend:
+    """
+    轮询目录修改时间, 只对发生变化的目录做差异对齐
+    """
+
+    name = "poll"
+
+    def __init__(self):
+        self.watches = {}
+
+    def add(self, dir_path, catalog):
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return
+        self.watches[dir_path] = (mtime, catalog)
+
+    def changed_dirs(self):
+        changed = []
+        for dir_path, (mtime, catalog) in list(self.watches.items()):
+            try:
+                current = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                # 目录已删除, 由上层目录的对齐处理
+                del self.watches[dir_path]
+                continue
+            if current != mtime:
+                self.watches[dir_path] = (current, catalog)
+                changed.append((catalog, dir_path))
+        return changed
+
+    def close(self):
+        self.watches.clear()
+
+
+class CatalogWatcher:
+    """
+    在后台线程中监听若干索引的目录, 并把变化增量应用到索引上
+
+    索引需要提供 watch_dirs / apply_change / resync_dir 三个方法以及 generation 计数
+    """
+
+    def __init__(self, catalogs, backend="auto", poll_interval=2.0):
+        self.catalogs = list(catalogs)
+        self.backend_name = backend
+        self.poll_interval = poll_interval
+        self.backend = None
+        # 索引发生变化后调用的回调
+        self.listeners = []
+        # fork 出的子进程是否各自重新启动监听
+        self.follow_forks = True
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _create_backend(self):
+        if self.backend_name in ("auto", "inotify"):
+            try:
+                return _InotifyBackend()
+            except (OSError, AttributeError):
+                if self.backend_name == "inotify":
+                    raise
+        return _PollingBackend()
+
+    def start(self):
+        self.backend = self._create_backend()
+        for catalog in self.catalogs:
+            for dir_path in catalog.watch_dirs():
+                self.backend.add(dir_path, catalog)
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="catalog-watcher", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def ensure_running(self):
+        """
+        守护进程化等 fork 之后, 确保当前进程中的监听线程在运行
+        """
+        if self.backend_name == "off":
+            return self
+        if self._thread is None or not self._thread.is_alive():
+            if self.backend is not None:
+                self.backend.close()
+            self.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.poll_interval + 1)
+        if self.backend is not None:
+            self.backend.close()
+
+    def after_fork(self):
+        """
+        fork 之后子进程中没有监听线程, 且继承的 inotify 句柄与父进程共享, 需要重新创建
+        """
+        if self.backend is not None:
+            self.backend.close()
+        self._thread = None
+        if self.follow_forks:
+            self.start()
+
+    def _watch_new(self, catalog, new_dirs):
+        for dir_path in new_dirs:
+            self.backend.add(dir_path, catalog)
+            # 监听建立前目录里可能已经有文件
+            self._watch_new(catalog, catalog.resync_dir(dir_path))
+
+    def _resync_all(self):
+        for catalog in self.catalogs:
+            for dir_path in catalog.watch_dirs():
+                self._watch_new(catalog, catalog.resync_dir(dir_path))
+
+    def _generations(self):
+        return sum(catalog.generation for catalog in self.catalogs)
+
+    def _run(self):
+        backend = self.backend
+        while not self._stop.is_set():
+            before = self._generations()
+            try:
+                if isinstance(backend, _InotifyBackend):
+                    changes, overflow = backend.poll(self.poll_interval)
+                    if overflow:
+                        self._resync_all()
+                        continue
+                    for catalog, dir_path, name in changes:
+                        self._watch_new(catalog, catalog.apply_change(dir_path, name))
+                else:
+                    if self._stop.wait(self.poll_interval):
+                        break
+                    for catalog, dir_path in backend.changed_dirs():
+                        self._watch_new(catalog, catalog.resync_dir(dir_path))
+            except OSError:
+                # inotify 句柄已关闭或目录在处理过程中被删除
+                if self._stop.is_set() or backend is not self.backend:
+                    break
+                self._stop.wait(self.poll_interval)
+            if self._generations() != before:
+                for listener in self.listeners:
+                    listener()
+
+
+def start_watcher(app, catalogs, backend="auto", poll_interval=2.0):
+    """
+    启动目录监听并挂载到 app.extensions
+
+    gunicorn 以 preload_app 方式 fork 工作进程时, 默认在每个子进程中重新启动监听;
+    启用共享索引后改为只在主进程中监听 (见 shared_catalog.serve_master)
+    """
+    watcher = CatalogWatcher(catalogs, backend, poll_interval)
+    app.extensions["catalog_watcher"] = watcher
+    if backend == "off":
+        return watcher
+    watcher.start()
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=watcher.after_fork)
+    return watcher